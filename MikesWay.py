@@ -1,21 +1,159 @@
 
 import os
+import numpy as np
 import pandas as pd
 import logging
 
+from catalog_loader import enable_copy_on_write, load_catalog, read_header, select_columns
+from image_columns import explode_images
+from workspace import parse_workspace
+from intermediates import read_output
+from instrumentation import instrumented, step
+
 # Set up logging configuration
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def process_mikes_way(input_file):
+@instrumented
+def interleave_variants(parent_rows, variant_rows, group_column='group_skus.0'):
+    """
+    Order each parent row (by first appearance of its sku) followed by the variants whose
+    `group_column` holds that sku, keeping the input order within each group.
+
+    Done as one stable sort on (parent position, parent-before-variant) instead of filtering
+    the variants once per parent. Returns the ordered frame and a boolean mask over
+    `variant_rows` marking the variants that matched no parent (they are not included).
+    """
+    parent_skus = pd.Index(parent_rows['sku'].unique())
+    if len(parent_skus) == 0:
+        return pd.DataFrame(), np.ones(len(variant_rows), dtype=bool)
+
+    parent_position = parent_skus.get_indexer(parent_rows['sku'])
+    variant_position = parent_skus.get_indexer(variant_rows[group_column])
+    matched = variant_position >= 0
+
+    combined = pd.concat([parent_rows, variant_rows[matched]], ignore_index=True)
+    position = np.concatenate([parent_position, variant_position[matched]])
+    is_variant = np.concatenate([np.zeros(len(parent_rows), dtype=np.int8), np.ones(matched.sum(), dtype=np.int8)])
+
+    # np.lexsort is stable and sorts by its last key first
+    order = np.lexsort((is_variant, position))
+    return combined.take(order).reset_index(drop=True), ~matched
+
+def join_on_sku(left, frames):
     """
-    Process a product spreadsheet in Mike's Way format.
+    Left-join each of `frames` onto `left` by 'sku' in one pass: every frame is indexed by sku once,
+    aligned to the rows of `left` and then all of them are concatenated side by side, so the wide
+    result is built once instead of being copied by every merge. Same rows and columns as chaining
+    pd.merge(..., on='sku', how='left'), which is still used from the first frame whose SKUs repeat,
+    whose sku dtype differs (other than text in object or string columns) or whose columns clash
+    (where merge multiplies rows or adds suffixes).
+    """
+    left = left.reset_index(drop=True)
+    keys = pd.Index(left['sku'])
+    parts = [left]
+    columns = set(left.columns)
+    for i, frame in enumerate(frames):
+        other_columns = set(frame.columns) - {'sku'}
+        # Text SKUs match whether they are held as object or string columns
+        same_keys = frame['sku'].dtype == left['sku'].dtype or (pd.api.types.is_string_dtype(frame['sku']) and
+                                                                pd.api.types.is_string_dtype(left['sku']))
+        if not same_keys or not frame['sku'].is_unique or other_columns & columns:
+            joined = pd.concat(parts, axis=1)
+            for rest in frames[i:]:
+                joined = pd.merge(joined, rest, on='sku', how='left')
+            return joined
+        columns |= other_columns
+        parts.append(frame.set_index('sku').reindex(keys).set_axis(left.index))
+    return pd.concat(parts, axis=1)
+
+# Export columns build_mikes_way() reads from the original input
+def input_columns(header):
+    return select_columns(header, ['variant.sku', 'variant.name', 'variant.barcode', 'variant.images'])
+
+def build_mikes_way(group_skus_df, parent_attrs_df, parents_df, variant_attrs_df, original_df, addvariants_df=None,
+                    max_alternates=None):
+    """
+    Build the Mike's Way frame (each parent row followed by its variants) from the
+    intermediate frames, the original input and, when available, addvariants.csv.
+    `max_alternates` caps the number of alternate image columns.
+    """
+    # Create mapping for pricing data
+    if addvariants_df is not None:
+        pricing_map = addvariants_df[['sku', 'pricing_item.price.amount', 'pricing_item.msrp.amount']].dropna(subset=['sku'])
+    else:
+        logging.warning("addvariants.csv not found, pricing data may be missing")
+        pricing_map = pd.DataFrame(columns=['sku', 'pricing_item.price.amount', 'pricing_item.msrp.amount'])
+
+    # Create a mapping dataframe with sku, variant.name, variant.barcode, and variant.images
+    name_barcode_map = original_df[['variant.sku', 'variant.name', 'variant.barcode', 'variant.images']].dropna(subset=['variant.sku'])
+    name_barcode_map = name_barcode_map.rename(columns={'variant.sku': 'sku'})
+    
+    # Process images from the original data
+    # Split images into main and alternate columns
+    with step('MikesWay.split_images', len(name_barcode_map)) as record:
+        image_df = explode_images(name_barcode_map['variant.images'], max_alternates=max_alternates, strip=True)
+        name_barcode_map = pd.concat([name_barcode_map.drop(columns=['variant.images']), image_df], axis=1)
+        record['rows_out'] = len(name_barcode_map)
+
+    # Image columns plus the name and barcode every row takes from the input
+    image_cols = [col for col in name_barcode_map.columns if col == 'main' or col.startswith('images.default')]
+    merge_cols = ['sku', 'variant.name', 'variant.barcode'] + image_cols
+
+    # Variant rows: the variants with their parent attributes, joined with group_skus information,
+    # variant attributes, name, barcode and images from the input, and pricing from addvariants
+    with step('MikesWay.merge_variants', len(parent_attrs_df)) as record:
+        variant_rows = join_on_sku(parent_attrs_df, [group_skus_df, variant_attrs_df, name_barcode_map[merge_cols],
+                                                     pricing_map])
+        record['rows_out'] = len(variant_rows)
+
+    variant_rows['barcode'] = variant_rows['variant.barcode']
+    # Ensure we use the variant.name from the input file for unique product names
+    variant_rows['name'] = variant_rows['variant.name']
+    # Remove the temporary columns
+    variant_rows = variant_rows.drop(['variant.name', 'variant.barcode'], axis=1, errors='ignore')
+
+    # Parent rows, identified as product in the group column (they use their sku as barcode if no match is found)
+    with step('MikesWay.merge_parents', len(parents_df)) as record:
+        parent_rows = join_on_sku(parents_df.assign(group='product'), [name_barcode_map[merge_cols], pricing_map])
+        record['rows_out'] = len(parent_rows)
+
+    parent_rows['barcode'] = parent_rows['variant.barcode'].fillna(parent_rows['sku'])
+    # Ensure parent rows also use the correct name from the input file
+    parent_rows['name'] = parent_rows['variant.name'].fillna(parent_rows['fields.name'])
+    # Remove the temporary columns
+    parent_rows = parent_rows.drop(['variant.name', 'variant.barcode'], axis=1, errors='ignore')
+
+    # Identify as variant in the group column
+    variant_rows['group'] = 'variant'
+    
+    # Group variants by their parent: each parent row followed by its variants
+    result_df, orphan_mask = interleave_variants(parent_rows, variant_rows)
+
+    # If there are any variants without a parent in our output, add them at the end
+    orphan_variants = variant_rows[orphan_mask]
+    if not orphan_variants.empty:
+        result_df = pd.concat([result_df, orphan_variants], ignore_index=True)
+
+    # Reorder columns to put group_skus.0 immediately after sku column
+    if 'group_skus.0' in result_df.columns and 'sku' in result_df.columns:
+        # Get all columns except sku and group_skus.0
+        other_cols = [col for col in result_df.columns if col != 'sku' and col != 'group_skus.0']
+        # Reorder with sku first, then group_skus.0, then all other columns
+        cols = ['sku', 'group_skus.0'] + other_cols
+        result_df = result_df[cols]
+
+    return result_df
+
+def process_mikes_way(workspace):
+    """
+    Process a product spreadsheet in Mike's Way format, reading the earlier stages' outputs
+    from the workspace's output directory.
     """
     logging.info("Starting MikesWay CSV generation")
 
     # Create output directory if it doesn't exist
-    output_dir = './output'
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    output_dir = workspace.output_dir
+    workspace.ensure_output_dir()
 
     try:
         # Load data from CSV files
@@ -25,10 +163,10 @@ def process_mikes_way(input_file):
         variant_attrs_path = os.path.join(output_dir, 'variantattributes.csv')
 
         if all(os.path.exists(p) for p in [group_skus_path, parent_attrs_path, parents_path, variant_attrs_path]):
-            group_skus_df = pd.read_csv(group_skus_path)
-            parent_attrs_df = pd.read_csv(parent_attrs_path)
-            parents_df = pd.read_csv(parents_path)
-            variant_attrs_df = pd.read_csv(variant_attrs_path)
+            group_skus_df = read_output(workspace, 'group_skus.csv')
+            parent_attrs_df = read_output(workspace, 'parentattributesonvarients.csv')
+            parents_df = read_output(workspace, 'parents.csv')
+            variant_attrs_df = read_output(workspace, 'variantattributes.csv')
 
             logging.info(f"Loaded group_skus.csv: {len(group_skus_df)} rows")
             logging.info(f"Loaded parentattributesonvarients.csv: {len(parent_attrs_df)} rows")
@@ -36,128 +174,18 @@ def process_mikes_way(input_file):
             logging.info(f"Loaded variantattributes.csv: {len(variant_attrs_df)} rows")
 
             # Load original input data to get variant.name and variant.barcode
-            input_file_path = os.path.join('./input', os.listdir('./input')[0])
-            original_df = pd.read_csv(input_file_path)
+            original_df = load_catalog(workspace.input_file, input_columns(read_header(workspace.input_file)))
 
             # Load addvariants.csv to get pricing data in correct format
             addvariants_path = os.path.join(output_dir, 'addvariants.csv')
             if os.path.exists(addvariants_path):
-                addvariants_df = pd.read_csv(addvariants_path)
+                addvariants_df = read_output(workspace, 'addvariants.csv')
                 logging.info(f"Loaded addvariants.csv: {len(addvariants_df)} rows")
-                
-                # Create mapping for pricing data
-                pricing_map = addvariants_df[['sku', 'pricing_item.price.amount', 'pricing_item.msrp.amount']].dropna(subset=['sku'])
             else:
-                logging.warning("addvariants.csv not found, pricing data may be missing")
-                pricing_map = pd.DataFrame(columns=['sku', 'pricing_item.price.amount', 'pricing_item.msrp.amount'])
-
-            # Create a mapping dataframe with sku, variant.name, variant.barcode, and variant.images
-            name_barcode_map = original_df[['variant.sku', 'variant.name', 'variant.barcode', 'variant.images']].dropna(subset=['variant.sku'])
-            name_barcode_map = name_barcode_map.rename(columns={'variant.sku': 'sku'})
-            
-            # Process images from the original data
-            # Split images into mainimage and alt columns
-            name_barcode_map['variant.images'] = name_barcode_map['variant.images'].fillna('')
-            name_barcode_map['images_list'] = name_barcode_map['variant.images'].str.split(',')
-            
-            # Create columns for main image and alternates
-            max_images = name_barcode_map['images_list'].apply(lambda x: len(x) if isinstance(x, list) else 0).max()
-            image_columns = ['main'] + [f'images.default.{i}.alternate.url' for i in range(1, max_images)]
-            
-            # Fill in image columns
-            for i, col in enumerate(image_columns):
-                name_barcode_map[col] = name_barcode_map['images_list'].apply(
-                    lambda x: x[i].strip() if isinstance(x, list) and i < len(x) and x[i].strip() != '' else None
-                )
-            
-            # Drop temporary columns
-            name_barcode_map = name_barcode_map.drop(columns=['images_list', 'variant.images'])
-
-            # Create parent rows
-            parent_rows = parents_df.copy()
-            # Identify as product (parent) in the group column
-            parent_rows['group'] = 'product'
-
-            # Create variant rows
-            variant_rows = parent_attrs_df.copy()
-
-            # Add group_skus information
-            variant_rows = pd.merge(variant_rows, group_skus_df, on='sku', how='left')
-
-            # Add variant attributes
-            variant_rows = pd.merge(variant_rows, variant_attrs_df, on='sku', how='left')
-
-            # Add name, barcode, and pricing from original data and addvariants
-            # For variant rows
-            # Get all image columns
-            image_cols = [col for col in name_barcode_map.columns if col == 'main' or col.startswith('images.default')]
-            merge_cols = ['sku', 'variant.name', 'variant.barcode'] + image_cols
-            
-            variant_rows = pd.merge(variant_rows, name_barcode_map[merge_cols], 
-                                  on='sku', how='left')
-            # Add pricing data
-            variant_rows = pd.merge(variant_rows, pricing_map, 
-                                  on='sku', how='left')
-            
-            variant_rows['barcode'] = variant_rows['variant.barcode']
-            # Ensure we use the variant.name from the input file for unique product names
-            variant_rows['name'] = variant_rows['variant.name']
-            # Remove the temporary columns
-            variant_rows = variant_rows.drop(['variant.name', 'variant.barcode'], axis=1, errors='ignore')
-
-            # For parent rows (will use sku as barcode if no match found)
-            # Get all image columns
-            image_cols = [col for col in name_barcode_map.columns if col == 'main' or col.startswith('images.default')]
-            merge_cols = ['sku', 'variant.name', 'variant.barcode'] + image_cols
-            
-            parent_rows = pd.merge(parent_rows, name_barcode_map[merge_cols], 
-                                 on='sku', how='left')
-            # Add pricing data to parent rows
-            parent_rows = pd.merge(parent_rows, pricing_map, 
-                                 on='sku', how='left')
-                                 
-            parent_rows['barcode'] = parent_rows['variant.barcode'].fillna(parent_rows['sku'])
-            # Ensure parent rows also use the correct name from the input file
-            parent_rows['name'] = parent_rows['variant.name'].fillna(parent_rows['fields.name'])
-            # Remove the temporary columns
-            parent_rows = parent_rows.drop(['variant.name', 'variant.barcode'], axis=1, errors='ignore')
-
-            # Identify as variant in the group column
-            variant_rows['group'] = 'variant'
-            
-            # Group variants by their parent
-            result_df = pd.DataFrame()
-            
-            # Get all unique parent SKUs
-            parent_skus = parent_rows['sku'].unique()
-            
-            # For each parent, add parent row followed by its variants
-            for parent_sku in parent_skus:
-                # Get parent row
-                parent = parent_rows[parent_rows['sku'] == parent_sku]
-                
-                # Get variant rows that belong to this parent
-                parent_group_sku = parent_sku  # The parent SKU is variant-X format
-                variants = variant_rows[variant_rows['group_skus.0'] == parent_group_sku]
-                
-                # Combine parent and its variants
-                combined = pd.concat([parent, variants], ignore_index=True)
-                
-                # Add to result
-                result_df = pd.concat([result_df, combined], ignore_index=True)
-
-            # If there are any variants without a parent in our output, add them at the end
-            orphan_variants = variant_rows[~variant_rows['group_skus.0'].isin(parent_skus)]
-            if not orphan_variants.empty:
-                result_df = pd.concat([result_df, orphan_variants], ignore_index=True)
-
-            # Reorder columns to put group_skus.0 immediately after sku column
-            if 'group_skus.0' in result_df.columns and 'sku' in result_df.columns:
-                # Get all columns except sku and group_skus.0
-                other_cols = [col for col in result_df.columns if col != 'sku' and col != 'group_skus.0']
-                # Reorder with sku first, then group_skus.0, then all other columns
-                cols = ['sku', 'group_skus.0'] + other_cols
-                result_df = result_df[cols]
+                addvariants_df = None
+
+            result_df = build_mikes_way(group_skus_df, parent_attrs_df, parents_df, variant_attrs_df,
+                                        original_df, addvariants_df)
 
             # Save to MikesWay.csv
             output_file = os.path.join(output_dir, 'MikesWay.csv')
@@ -177,9 +205,6 @@ def process_mikes_way(input_file):
         return False
 
 if __name__ == "__main__":
+    enable_copy_on_write()
     # This script can be run standalone if needed
-    if os.path.exists('./input') and len(os.listdir('./input')) == 1:
-        input_file = os.path.join('./input', os.listdir('./input')[0])
-        process_mikes_way(input_file)
-    else:
-        logging.error("No input file found in ./input directory")
+    process_mikes_way(parse_workspace("Build MikesWay.csv from the other stages' outputs"))
@@ -1,79 +1,99 @@
 
-import os
+import argparse
+import numpy as np
 import pandas as pd
 import logging
 
-# Set input and output directories
-input_directory = './input/'
-output_directory = './output/'
+from catalog_loader import enable_copy_on_write, load_catalog, read_header, select_columns
+from workspace import Workspace, add_workspace_arguments
+from intermediates import write_output
+from image_columns import explode_images, image_column_names
+from streaming import (DEFAULT_CHUNKSIZE, DtypeScan, HashedValues, check_duplicate_skus, kept_variant_rows,
+                       read_chunks, write_chunk)
+from instrumentation import instrumented
+from validation import ValidationError, duplicate_skus_error
 
 # Set up logging configuration
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Check if input directory exists and fetch file
-def load_file_from_directory(input_directory):
-    files = os.listdir(input_directory)
-    if len(files) != 1:
-        logging.error("There are no files or more than one file in the directory.")
-        exit()
-    return pd.read_csv(os.path.join(input_directory, files[0]), low_memory=False)
-
 # Remove rows where 'variant.name' contains 'Sample product'
+@instrumented
 def filter_sample_product(df):
     logging.info("Filtering rows where 'variant.name' contains 'Sample product'")
     return df[~df['variant.name'].str.contains('Sample product', na=False)]
 
 # Clean NaN or empty string 'variant.sku' and duplicates in 'variant.sku' and 'variant.barcode'
+@instrumented
 def clean_sku_and_barcode(df):
     logging.info("Cleaning 'variant.sku' and 'variant.barcode' columns")
     df = df[df['variant.sku'].notna() & (df['variant.sku'] != '')]  # Drop empty 'variant.sku'
     duplicated_skus = df['variant.sku'].dropna()[df['variant.sku'].duplicated(keep=False)]
     if not duplicated_skus.empty:
-        logging.error("Duplicates found in 'variant.sku'. Please contact management!")
-        logging.error(f"Duplicated 'variant.sku' values: {duplicated_skus.unique()}")
-        exit(1)
+        raise duplicate_skus_error(duplicated_skus)
     df['variant.barcode'] = pd.to_numeric(df['variant.barcode'], errors='coerce')
     df.loc[df['variant.barcode'].duplicated(keep=False), 'variant.barcode'] = None  # Remove duplicates
     return df
 
+# Rows from which format_price_column formats each distinct price once instead of every cell
+DIRECT_FORMAT_ROWS = 100_000
+
+# Format a price column as '{:.2f}' strings, leaving missing and malformed cells empty (NaN)
+def format_price_column(values):
+    prices = pd.to_numeric(values, errors='coerce').astype(float)
+    malformed = prices.isna() & values.notna()
+    if malformed.any():
+        logging.warning(f"{malformed.sum()} malformed values in '{values.name}' were left empty: "
+                        f"{values[malformed].unique()[:10].tolist()}")
+
+    # Prices repeat heavily across a catalog: format each distinct value once and broadcast the strings back.
+    # Factorizing the raw float bits keeps -0.0 apart from 0.0, so every string matches '{:.2f}'.format exactly.
+    # On small columns, or when most prices are distinct, that costs more than it saves and every cell is
+    # formatted directly instead
+    if len(prices) < DIRECT_FORMAT_ROWS:
+        return prices.map('{:.2f}'.format, na_action='ignore').rename(values.name)
+    present = prices.notna().to_numpy()
+    codes, uniques = pd.factorize(prices.to_numpy()[present].view(np.int64))
+    if len(uniques) > len(codes) // 2:
+        return prices.map('{:.2f}'.format, na_action='ignore').rename(values.name)
+    labels = np.array(['{:.2f}'.format(amount) for amount in uniques.view(np.float64)], dtype=object)
+
+    formatted = np.full(len(prices), np.nan, dtype=object)
+    formatted[present] = labels[codes]
+    return pd.Series(formatted, index=values.index, name=values.name)
+
 # Format pricing columns
+@instrumented
 def format_pricing(df):
     logging.info("Formatting 'variant.price' and 'variant.compare_price' columns")
-    df['variant.price'] = df['variant.price'].apply(lambda x: '{:.2f}'.format(x) if pd.notna(x) else x)
-    df['variant.compare_price'] = df['variant.compare_price'].apply(lambda x: '{:.2f}'.format(x) if pd.notna(x) else x)
+    df['variant.price'] = format_price_column(df['variant.price'])
+    df['variant.compare_price'] = format_price_column(df['variant.compare_price'])
     df['variant.compare_price'] = df['variant.compare_price'].fillna(df['variant.price'])  # Copy price to compare_price if NaN
     # Ensure barcode is properly formatted
-    df['variant.barcode'] = df['variant.barcode'].astype(str).replace('nan', '')
+    df['variant.barcode'] = df['variant.barcode'].astype(str).mask(df['variant.barcode'].isna(), '')
     # Select only the required columns
     required_columns = ['variant.name', 'variant.sku', 'variant.barcode', 'variant.price', 'variant.compare_price', 'variant.images']
     df = df[required_columns]
     return df
 
-# Dynamically split images into mainimage, alt1, alt2, ..., altN
-def split_images(df):
+# Dynamically split images into main, images.default.1.alternate.url, ..., images.default.N.alternate.url
+@instrumented
+def split_images(df, max_alternates=None):
     logging.info("Splitting 'variant.images' into multiple image columns")
-    df['variant.images'] = df['variant.images'].fillna('')
-    df['images_list'] = df['variant.images'].str.split(',')
+    image_df = explode_images(df['variant.images'], max_alternates=max_alternates, trailing_empty_columns=1)
 
-    # Dynamically create columns for images, starting with 'mainimage'
-    max_images = df['images_list'].apply(len).max()
-    image_columns = ['mainimage'] + [f'alt{i}' for i in range(1, max_images + 1)]
-
-    # Create new columns for each image
-    for i, col in enumerate(image_columns):
-        df[col] = df['images_list'].apply(lambda x: x[i] if isinstance(x, list) and i < len(x) else None)
-    
-    # Drop temporary columns
-    df = df.drop(columns=['images_list', 'variant.images'])
+    # Replace 'variant.images' with the image columns at the end of the frame
+    df = pd.concat([df.drop(columns=['variant.images']), image_df], axis=1)
     return df
 
 # Insert 'group' column after 'variant.compare_price'
+@instrumented
 def insert_group_column(df):
     logging.info("Inserting 'group' column after 'variant.compare_price'")
     df.insert(df.columns.get_loc('variant.compare_price') + 1, 'group', 'variant')
     return df
 
 # Rename the columns as per the requirement
+@instrumented
 def rename_columns(df):
     logging.info("Renaming columns to match the required format")
     # First rename the columns
@@ -83,44 +103,117 @@ def rename_columns(df):
         'variant.barcode': 'upc',
         'variant.price': 'pricing_item.price.amount',
         'variant.compare_price': 'pricing_item.msrp.amount',
-        'mainimage': 'main'
     })
     
-    # Rename all alt columns to the format images.default.#.alternate.url
-    alt_columns = [col for col in df.columns if col.startswith('alt')]
-    for col in alt_columns:
-        # Extract the number from the alt column name (e.g., alt1 -> 1)
-        num = ''.join(filter(str.isdigit, col))
-        new_col_name = f'images.default.{num}.alternate.url'
-        df = df.rename(columns={col: new_col_name})
-    
     # Make sure UPC values are preserved and not converted to NaN
     df['upc'] = df['upc'].astype(str).replace('nan', '')
     return df
 
-# Main function to run all steps
-def main():
-    logging.info("Starting data processing")
+# Export columns transform() reads
+def input_columns(header):
+    return select_columns(header, ['variant.name', 'variant.sku', 'variant.barcode', 'variant.price',
+                                   'variant.compare_price', 'variant.images'])
 
-    # Load the CSV file
-    df = load_file_from_directory(input_directory)
-    
-    # Apply transformations in sequence
+# Apply all transformations in sequence to a loaded export
+def transform(df, max_alternates=None):
     df = filter_sample_product(df)
     df = clean_sku_and_barcode(df)
     df = format_pricing(df)
-    df = split_images(df)
+    df = split_images(df, max_alternates)
     df = insert_group_column(df)
     df = rename_columns(df)
+    return df
 
-    # Ensure output directory exists and save the cleaned data
-    if not os.path.exists(output_directory):
-        os.makedirs(output_directory)
-    output_file = os.path.join(output_directory, 'addvariants.csv')
-    df.to_csv(output_file, index=False)
+def scan_catalog(input_file, chunksize, max_alternates=None, usecols=None):
+    """
+    First streaming pass: everything transform() needs from the whole file. That is the
+    read dtypes, duplicate SKUs and barcodes, and the number of alternate image columns.
+    Only 16 bytes per row are kept (a SKU hash and the barcode).
+    """
+    logging.info("Scanning for duplicate SKUs and barcodes")
+    dtypes = DtypeScan()
+    skus = HashedValues()
+    barcodes = []
+    max_commas = 0
+    for chunk in read_chunks(input_file, chunksize, usecols=usecols):
+        dtypes.observe(chunk)
+        chunk = kept_variant_rows(chunk)
+        skus.add(chunk['variant.sku'])
+        barcodes.append(pd.to_numeric(chunk['variant.barcode'], errors='coerce').dropna().to_numpy(dtype=float))
+        if len(chunk):
+            max_commas = max(max_commas, int(chunk['variant.images'].fillna('').astype(str).str.count(',').max()))
+
+    check_duplicate_skus(input_file, chunksize, dtypes, skus)
+
+    values, counts = np.unique(np.concatenate(barcodes) if barcodes else np.empty(0), return_counts=True)
+    n_alternates = max_commas if max_alternates is None else min(max_commas, max_alternates)
+    return dtypes.dtypes, values[counts > 1], n_alternates
+
+# clean_sku_and_barcode for one chunk, with the barcodes duplicated anywhere in the file from scan_catalog
+def clean_chunk_sku_and_barcode(df, duplicate_barcodes):
+    df = df[df['variant.sku'].notna() & (df['variant.sku'] != '')]
+    barcodes = pd.to_numeric(df['variant.barcode'], errors='coerce').astype(float)
+    # Like the whole-file version, the barcode comes out float even when nothing was duplicated
+    df['variant.barcode'] = barcodes.mask(barcodes.isin(duplicate_barcodes))
+    return df
+
+def transform_streaming(input_file, output_file, chunksize=DEFAULT_CHUNKSIZE, max_alternates=None):
+    """
+    Write the same addvariants.csv as transform() while holding only one chunk of rows at a time.
+    """
+    usecols = input_columns(read_header(input_file))
+    dtypes, duplicate_barcodes, n_alternates = scan_catalog(input_file, chunksize, max_alternates, usecols)
+    image_columns = image_column_names(n_alternates + 1)
+
+    rows = 0
+    for i, chunk in enumerate(read_chunks(input_file, chunksize, dtypes, usecols)):
+        df = filter_sample_product(chunk)
+        df = clean_chunk_sku_and_barcode(df, duplicate_barcodes)
+        df = format_pricing(df)
+        df = split_images(df, max_alternates)
+        # Every chunk gets the image columns of the widest row in the file
+        df = df.reindex(columns=list(df.columns[:df.columns.get_loc('main')]) + image_columns)
+        df = insert_group_column(df)
+        df = rename_columns(df)
+        write_chunk(df, output_file, first=(i == 0))
+        rows += len(df)
+    return rows
+
+# Main function to run all steps
+def main(workspace=None, chunksize=None):
+    # Command-line runs name their input and output with --input/--output
+    if workspace is None:
+        parser = add_workspace_arguments(argparse.ArgumentParser(description="Build addvariants.csv from a catalog export"))
+        parser.add_argument('--chunksize', type=int,
+                            help=f"Stream the input this many rows at a time (e.g. {DEFAULT_CHUNKSIZE}) "
+                                 "instead of loading it whole")
+        args = parser.parse_args()
+        workspace = Workspace.from_args(args)
+        chunksize = args.chunksize
+    logging.info("Starting data processing")
+
+    workspace.ensure_output_dir()
+    output_file = workspace.output_path('addvariants.csv')
+
+    if chunksize:
+        transform_streaming(workspace.input_file, output_file, chunksize)
+    else:
+        # Load the CSV file
+        df = load_catalog(workspace.input_file, input_columns(read_header(workspace.input_file)))
+
+        # Apply transformations in sequence
+        df = transform(df)
+
+        # Save the cleaned data
+        write_output(workspace, 'addvariants.csv', df)
     
     logging.info(f"Successfully filtered the data! The filtered data is saved to {output_file}")
 
 # Run the main function
 if __name__ == "__main__":
-    main()
+    enable_copy_on_write()
+    try:
+        main()
+    except ValidationError as e:
+        logging.error(str(e))
+        exit(1)
@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import shutil
+import zipfile
+import logging
+import argparse
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import jobs
+import pipeline
+from catalog_loader import catalog_cache, enable_copy_on_write
+from workspace import Workspace, output_directory
+
+# Set up logging configuration
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Written next to the per-catalog output directories of a batch
+MANIFEST_NAME = 'manifest.json'
+
+
+# One worker process per core unless BATCH_WORKERS says otherwise
+def default_workers():
+    workers = os.environ.get('BATCH_WORKERS')
+    return int(workers) if workers else os.cpu_count() or 1
+
+
+# Start method of the worker processes. Web batches start their pool from a JobQueue thread while other
+# threads (jobs, logging, the server) may hold locks a forked child would inherit locked, so workers come
+# from a fork server (or are spawned where there is none) instead
+def worker_context():
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return multiprocessing.get_context(method)
+
+
+# A name no other catalog of the batch has: 'shop', then 'shop-2', 'shop-3', ...
+def unique_name(name, taken):
+    candidate, n = name, 1
+    while candidate in taken:
+        n += 1
+        candidate = f'{name}-{n}'
+    taken.add(candidate)
+    return candidate
+
+
+def collect_catalogs(paths, extract_dir):
+    """
+    The catalogs named by `paths`, as (name, CSV path) pairs in the order given: CSV files as
+    they are, the CSVs in a directory, and the CSVs in a zip, extracted under `extract_dir`.
+    Names are the file names without '.csv', made unique; each becomes an output directory.
+    """
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found.extend(os.path.join(path, name) for name in sorted(os.listdir(path)) if name.lower().endswith('.csv'))
+        elif zipfile.is_zipfile(path):
+            with zipfile.ZipFile(path) as archive:
+                members = [member for member in archive.infolist()
+                           if not member.is_dir() and member.filename.lower().endswith('.csv')
+                           and not member.filename.startswith('__MACOSX/')]
+                for i, member in enumerate(members):
+                    # Only the base name is used, so members can't be written outside extract_dir
+                    target = os.path.join(extract_dir, f'{os.path.basename(path)}-{i}', os.path.basename(member.filename))
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    with archive.open(member) as src, open(target, 'wb') as dest:
+                        shutil.copyfileobj(src, dest)
+                    found.append(target)
+        elif path.lower().endswith('.csv'):
+            found.append(path)
+        else:
+            logging.warning(f"Skipping {path}: not a CSV file, a directory or a zip")
+
+    taken = set()
+    return [(unique_name(os.path.splitext(os.path.basename(path))[0], taken), path) for path in found]
+
+
+def migrate_catalog(name, input_file, output_dir, options):
+    """
+    Run the pipeline for one catalog of a batch, in a worker process, and return its manifest
+    entry: status, log, output files, rows and the wall, CPU and parse time in seconds.
+    """
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    workspace = Workspace(input_file, output_dir)
+    status, log_messages = jobs.execute_job(workspace, options)
+    parse_stats = catalog_cache.stats(input_file) or {}
+    return {
+        'name': name,
+        'input': os.path.basename(input_file),
+        'status': status,
+        'rows': parse_stats.get('rows'),
+        'seconds': time.perf_counter() - start,
+        'cpu_seconds': time.process_time() - cpu_start,
+        'parse_seconds': parse_stats.get('parse_seconds'),
+        'files': sorted(os.listdir(output_dir)) if os.path.exists(output_dir) else [],
+        'log': log_messages,
+    }
+
+
+def run_batch(catalogs, output_dir, options, workers=None, log_messages=None, events=None):
+    """
+    Migrate each (name, CSV path) catalog into its own directory `output_dir/<name>` on a pool of
+    `workers` processes (default_workers() when None), then write the manifest: every catalog's
+    entry from migrate_catalog in input order, plus totals. Returns the manifest.
+    Each catalog is a stage of the progress events appended to `events`.
+    """
+    if log_messages is None:
+        log_messages = []
+    workers = max(1, min(workers or default_workers(), len(catalogs)))
+    log_messages.append(f"Migrating {len(catalogs)} catalogs on {workers} worker processes...")
+    pipeline.emit(events, 'pipeline_started', stages=[name for name, path in catalogs])
+    start = time.perf_counter()
+
+    entries = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=worker_context(),
+                             initializer=enable_copy_on_write) as executor:
+        futures = [executor.submit(migrate_catalog, name, path, os.path.join(output_dir, name), options)
+                   for name, path in catalogs]
+        for (name, path), future in zip(catalogs, futures):
+            try:
+                entry = future.result()
+            except Exception as e:
+                # The worker itself died (out of memory, say); the other catalogs still run
+                logging.error(f"Batch worker for {path} crashed: {e}")
+                entry = {'name': name, 'input': os.path.basename(path), 'status': 'failed',
+                         'seconds': None, 'files': [], 'log': [f"Error: {str(e)}"]}
+            entries.append(entry)
+            if entry['status'] == 'finished':
+                pipeline.emit_finished(events, name, entry['rows'], entry['rows'], entry['seconds'])
+                log_messages.append(f"✓ {name} completed in {entry['seconds']:.2f}s ({entry['rows']} rows).")
+            else:
+                pipeline.emit(events, 'stage_failed', name, seconds=entry['seconds'])
+                log_messages.append(f"✗ {name} failed: {entry['log'][-1] if entry['log'] else 'no log'}")
+
+    manifest = {
+        'catalogs': entries,
+        'finished': sum(entry['status'] == 'finished' for entry in entries),
+        'failed': sum(entry['status'] != 'finished' for entry in entries),
+        'workers': workers,
+        'seconds': time.perf_counter() - start,
+        'options': options,
+    }
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    log_messages.append(f"{manifest['finished']} of {len(entries)} catalogs migrated in {manifest['seconds']:.2f}s.")
+    return manifest
+
+
+def execute_batch(workspace, options, log_messages=None, events=None):
+    """
+    JobQueue task for an uploaded batch: every CSV and zip saved in the workspace's input
+    directory is migrated, and the output directory gets one directory per catalog plus the
+    manifest. Returns ('finished' | 'failed', log_messages) like jobs.execute_job; a batch
+    fails only when no catalog could be migrated.
+    """
+    if log_messages is None:
+        log_messages = []
+    input_dir = workspace.input_dir
+    uploads = [os.path.join(input_dir, name) for name in sorted(os.listdir(input_dir))]
+    try:
+        catalogs = collect_catalogs(uploads, os.path.join(input_dir, 'extracted'))
+        if not catalogs:
+            log_messages.append("Error: the upload contains no CSV files.")
+            return 'failed', log_messages
+        manifest = run_batch(catalogs, workspace.output_dir, options, log_messages=log_messages, events=events)
+    except Exception as e:
+        logging.exception(f"Batch in {input_dir} failed")
+        log_messages.append(f"Error: {str(e)}")
+        return 'failed', log_messages
+
+    if not manifest['finished']:
+        return 'failed', log_messages
+    log_messages.append("All processing complete. Files ready for download.")
+    return 'finished', log_messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate many catalogs at once, one worker process per core")
+    parser.add_argument('inputs', nargs='+', help="Catalog CSV files, directories of them or zips of them")
+    parser.add_argument('--output', default=output_directory,
+                        help="Directory for one output directory per catalog plus manifest.json")
+    parser.add_argument('--workers', type=int, help="Worker processes (default: one per core)")
+    parser.add_argument('--mikes-way', action='store_true', help="Also build MikesWay.csv")
+    parser.add_argument('--max-alternate-images', type=int, help="Keep at most this many alternate image columns")
+    args = parser.parse_args()
+
+    options = {'use_mikes_way': args.mikes_way, 'max_alternate_images': args.max_alternate_images}
+    log_messages = []
+    with tempfile.TemporaryDirectory(prefix='batch-') as extract_dir:
+        catalogs = collect_catalogs(args.inputs, extract_dir)
+        if not catalogs:
+            print("No CSV files found in the inputs.")
+            exit(1)
+        manifest = run_batch(catalogs, args.output, options, args.workers, log_messages)
+    print('\n'.join(log_messages))
+    if manifest['failed']:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,429 @@
+import os
+import sys
+import json
+import time
+import math
+import hashlib
+import argparse
+import logging
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+import catalog_loader
+import pipeline
+import synthetic_catalog
+import validation
+from workspace import Workspace
+from MikesWay import interleave_variants, join_on_sku
+from image_columns import explode_images
+from addvariants import format_price_column
+
+# Set up logging configuration
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def time_call(func, *args, repeat=3):
+    """Best wall time in seconds over `repeat` calls."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def scaling_exponent(sizes, seconds):
+    """Slope of log(time) against log(size) between the smallest and largest run; 1.0 is linear."""
+    if len(sizes) < 2 or seconds[0] <= 0:
+        return None
+    return math.log(seconds[-1] / seconds[0]) / math.log(sizes[-1] / sizes[0])
+
+
+def make_parent_variant_frames(n_variants, variants_per_parent=4, n_columns=20, seed=0):
+    """Parent rows in MikesWay shape plus their shuffled variant rows, ~2% of them orphans."""
+    rng = np.random.default_rng(seed)
+    n_parents = max(1, n_variants // variants_per_parent)
+    parent_skus = np.array([f'variant-{i}' for i in range(n_parents)], dtype=object)
+
+    group = parent_skus[rng.integers(0, n_parents, n_variants)]
+    group[rng.random(n_variants) < 0.02] = 'variant-orphan'
+
+    parent_rows = pd.DataFrame({'sku': parent_skus, 'group': 'product'})
+    variant_rows = pd.DataFrame({'sku': [f'SKU{i}' for i in range(n_variants)],
+                                 'group_skus.0': group,
+                                 'group': 'variant'})
+    for i in range(n_columns):
+        parent_rows[f'fields.attr_{i}'] = rng.integers(0, 10, n_parents).astype(str)
+        variant_rows[f'fields.attr_{i}'] = rng.integers(0, 10, n_variants).astype(str)
+    return parent_rows, variant_rows
+
+
+def legacy_interleave(parent_rows, variant_rows):
+    """The per-parent filter + concat loop process_mikes_way used before interleave_variants."""
+    result_df = pd.DataFrame()
+    for parent_sku in parent_rows['sku'].unique():
+        parent = parent_rows[parent_rows['sku'] == parent_sku]
+        variants = variant_rows[variant_rows['group_skus.0'] == parent_sku]
+        result_df = pd.concat([result_df, pd.concat([parent, variants], ignore_index=True)], ignore_index=True)
+    return result_df
+
+
+def bench_interleave(args):
+    sizes, seconds = [], []
+    print(f"{'variants':>10} {'seconds':>10} {'us/row':>8} {'legacy s':>10}")
+    for n in args.sizes:
+        parent_rows, variant_rows = make_parent_variant_frames(n)
+        elapsed = time_call(interleave_variants, parent_rows, variant_rows, repeat=args.repeat)
+        legacy = ''
+        if n <= args.legacy_max:
+            legacy = f"{time_call(legacy_interleave, parent_rows, variant_rows, repeat=1):10.3f}"
+        print(f"{n:>10} {elapsed:>10.3f} {elapsed / n * 1e6:>8.2f} {legacy:>10}")
+        sizes.append(n)
+        seconds.append(elapsed)
+
+    exponent = scaling_exponent(sizes, seconds)
+    if exponent is not None:
+        print(f"Scaling exponent: {exponent:.2f} (1.0 = linear, limit {args.max_exponent})")
+        if exponent > args.max_exponent:
+            logging.error("interleave_variants is scaling worse than near-linear")
+            return 1
+    return 0
+
+
+def make_prices(n_rows, distribution, seed=0):
+    """Price column with 10% missing cells: 'catalog' draws from a few thousand price points, 'unique' never repeats."""
+    rng = np.random.default_rng(seed)
+    if distribution == 'catalog':
+        prices = np.round(rng.integers(100, 20_000, n_rows) / 100 - 0.01, 2)
+    else:
+        prices = rng.random(n_rows) * 1000
+    prices[rng.random(n_rows) < 0.1] = np.nan
+    return pd.Series(prices, name='variant.price')
+
+
+def legacy_format_price(values):
+    """The per-element lambda format_pricing used before format_price_column."""
+    return values.apply(lambda x: '{:.2f}'.format(x) if pd.notna(x) else x)
+
+
+def bench_pricing(args):
+    print(f"{'rows':>10} {'distribution':>12} {'legacy s':>10} {'new s':>8} {'speedup':>8}")
+    for n in args.sizes:
+        for distribution in ('catalog', 'unique'):
+            prices = make_prices(n, distribution)
+            if not format_price_column(prices).equals(legacy_format_price(prices)):
+                logging.error(f"format_price_column output differs from the legacy formatting ({distribution}, {n} rows)")
+                return 1
+            legacy = time_call(legacy_format_price, prices, repeat=args.repeat)
+            new = time_call(format_price_column, prices, repeat=args.repeat)
+            print(f"{n:>10} {distribution:>12} {legacy:>10.3f} {new:>8.3f} {legacy / new:>7.1f}x")
+    return 0
+
+
+def parse_with_engine(path, engine):
+    """Parse stats for one engine plus a digest of the parsed frame's dtypes and CSV text."""
+    df, stats = catalog_loader.parse_catalog(path, engine=engine)
+    digest = hashlib.sha256(str(df.dtypes.tolist()).encode())
+    digest.update(df.to_csv(index=False).encode())
+    stats['digest'] = digest.hexdigest()
+    return stats
+
+
+def bench_parse(args):
+    engines = [engine for engine in catalog_loader.CSV_ENGINES if engine != 'pyarrow' or catalog_loader.pa is not None]
+    if 'pyarrow' not in engines:
+        logging.warning("pyarrow is not installed, timing the pandas parser only")
+    print(f"{'file':>30} {'engine':>8} {'seconds':>8} {'peak MB':>8} {'+MB':>6}")
+    for path in args.inputs:
+        digests = set()
+        for engine in engines:
+            best = None
+            for _ in range(args.repeat):
+                # A fresh process per parse, so the peak RSS is that parse's own
+                with ProcessPoolExecutor(max_workers=1) as pool:
+                    stats = pool.submit(parse_with_engine, path, engine).result()
+                if best is None or stats['parse_seconds'] < best['parse_seconds']:
+                    best = stats
+            digests.add(best['digest'])
+            peak = best['peak_rss_bytes'] / 1024 ** 2 if best['peak_rss_bytes'] is not None else float('nan')
+            growth = best['peak_rss_growth_bytes'] / 1024 ** 2 if best['peak_rss_growth_bytes'] is not None else float('nan')
+            print(f"{path[-30:]:>30} {engine:>8} {best['parse_seconds']:>8.2f} {peak:>8.0f} {growth:>6.0f}")
+        if len(digests) > 1:
+            logging.error(f"The engines parsed {path} differently")
+            return 1
+    return 0
+
+
+# Start a new peak-RSS measurement. Linux lets a process reset its high-water mark; elsewhere the peak
+# stays the one since the process started
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss_since_reset():
+    """Peak RSS in bytes since reset_peak_rss(), or since the process started where it can't be reset."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return catalog_loader.peak_rss_bytes()
+
+
+def time_stages(path, output_dir):
+    """
+    Run the pipeline's stages on `path` one at a time, as /upload does with Mike's Way on, and
+    return each stage's wall time, peak RSS and input rows per second. Meant for a fresh process,
+    so the peaks are this catalog's own.
+    """
+    options = {'use_mikes_way': True, 'max_alternate_images': None}
+    columns = pipeline.catalog_columns(path, use_mikes_way=True)
+    results = []
+
+    def measure(stage, func, rows=None):
+        reset_peak_rss()
+        start = time.perf_counter()
+        value = func()
+        seconds = time.perf_counter() - start
+        rows = len(value) if rows is None else rows
+        peak = peak_rss_since_reset()
+        results.append({'stage': stage, 'rows': rows, 'seconds': seconds,
+                        'peak_rss_mb': peak / 1024 ** 2 if peak is not None else None,
+                        'rows_per_second': rows / seconds if seconds > 0 else None})
+        return value
+
+    rows = len(measure('parse', lambda: catalog_loader.load_catalog(path, columns)))
+    measure('validation', lambda: validation.validate(catalog_loader.load_catalog(path, columns)), rows)
+    outputs = {}
+    for name, func in pipeline.STAGES + [('MikesWay', pipeline.run_mikes_way)]:
+        outputs.update(measure(name, lambda: func(catalog_loader.load_catalog(path, columns), outputs, options), rows))
+    catalog_loader.catalog_cache.evict(path)
+    measure('write', lambda: pipeline.write_outputs(outputs, Workspace(path, output_dir)), pipeline.output_rows(outputs))
+    return results
+
+
+# The commit being measured, when running from a git checkout
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def find_regressions(history, run, tolerance, min_seconds):
+    """
+    Stages of `run` slower, or with a higher peak RSS, than in the latest earlier run of the same
+    generated catalogs and CSV engine by more than `tolerance` (0.25 is 25%). Differences under `min_seconds` are
+    timer noise and don't count.
+    """
+    previous = {}
+    for earlier in history:
+        if earlier['generator'] == run['generator'] and earlier['csv_engine'] == run['csv_engine']:
+            for result in earlier['results']:
+                previous[(result['variants'], result['stage'])] = result
+
+    regressions = []
+    for result in run['results']:
+        before = previous.get((result['variants'], result['stage']))
+        if before is None:
+            continue
+        if (result['seconds'] > before['seconds'] * (1 + tolerance)
+                and result['seconds'] - before['seconds'] > min_seconds):
+            regressions.append(f"{result['stage']} at {result['variants']} variants: "
+                               f"{before['seconds']:.3f}s -> {result['seconds']:.3f}s")
+        if (result['peak_rss_mb'] is not None and before['peak_rss_mb'] is not None
+                and result['peak_rss_mb'] > before['peak_rss_mb'] * (1 + tolerance)):
+            regressions.append(f"{result['stage']} at {result['variants']} variants: "
+                               f"peak RSS {before['peak_rss_mb']:.0f} MB -> {result['peak_rss_mb']:.0f} MB")
+    return regressions
+
+
+def bench_scaling(args):
+    generator = {'variants_per_parent': args.variants_per_parent, 'images': args.images,
+                 'cardinality': args.cardinality, 'fill': args.fill, 'seed': args.seed}
+    run = {
+        'timestamp': time.time(),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'csv_engine': catalog_loader.default_engine(),
+        'generator': generator,
+        'results': [],
+    }
+
+    print(f"{'variants':>10} {'stage':>28} {'seconds':>8} {'peak MB':>8} {'rows/s':>10}")
+    with tempfile.TemporaryDirectory(prefix='benchmark-') as scratch:
+        data_dir = args.data_dir or scratch
+        os.makedirs(data_dir, exist_ok=True)
+        for n in args.sizes:
+            # Generated catalogs are kept in --data-dir and reused by later runs with the same settings
+            name = 'catalog-{}-{variants_per_parent}-{images}-{cardinality}-{fill}-{seed}.csv'.format(n, **generator)
+            path = os.path.join(data_dir, name)
+            if not os.path.exists(path):
+                # Renamed into place once complete, so an interrupted run leaves no partial catalog to reuse
+                synthetic_catalog.generate_catalog(path + '.partial', n, **generator)
+                os.replace(path + '.partial', path)
+            # A fresh process per catalog, so each stage's peak RSS is its own
+            with ProcessPoolExecutor(max_workers=1, initializer=catalog_loader.enable_copy_on_write) as pool:
+                results = pool.submit(time_stages, path, os.path.join(scratch, f'output-{n}')).result()
+            for result in results:
+                result['variants'] = n
+                rate = f"{result['rows_per_second']:.0f}" if result['rows_per_second'] else ''
+                print(f"{n:>10} {result['stage']:>28} {result['seconds']:>8.3f} {result['peak_rss_mb'] or 0:>8.0f} {rate:>10}")
+            run['results'].extend(results)
+
+    history = load_history(args.history)
+    regressions = find_regressions(history, run, args.tolerance, args.min_seconds)
+    history.append(run)
+    with open(args.history, 'w') as f:
+        json.dump(history, f, indent=2)
+    print(f"Recorded in {args.history} ({len(history)} runs)")
+
+    for regression in regressions:
+        logging.error(f"Regression: {regression}")
+    return 1 if regressions else 0
+
+
+def legacy_join_on_sku(left, frames):
+    """The chain of pd.merge calls build_mikes_way used before join_on_sku, each copying the growing frame."""
+    joined = left.copy()
+    for frame in frames:
+        joined = pd.merge(joined, frame, on='sku', how='left')
+    return joined
+
+
+def mikes_way_joins(path):
+    """
+    The two joins build_mikes_way makes on catalog `path`, as (left, frames) pairs: the variant
+    rows with group_skus, variant attributes, input names/images and pricing, and the parent rows
+    with the last two.
+    """
+    columns = pipeline.catalog_columns(path, use_mikes_way=True)
+    options = {'use_mikes_way': True, 'max_alternate_images': None}
+    outputs = {}
+    for name, func in pipeline.STAGES:
+        outputs.update(func(catalog_loader.load_catalog(path, columns), outputs, options))
+    original = catalog_loader.load_catalog(path, columns)
+    catalog_loader.catalog_cache.evict(path)
+
+    pricing = outputs['addvariants.csv'][['sku', 'pricing_item.price.amount', 'pricing_item.msrp.amount']].dropna(subset=['sku'])
+    names = original[['variant.sku', 'variant.name', 'variant.barcode', 'variant.images']].dropna(subset=['variant.sku'])
+    names = names.rename(columns={'variant.sku': 'sku'})
+    names = pd.concat([names.drop(columns=['variant.images']), explode_images(names['variant.images'], strip=True)], axis=1)
+    return [(outputs['parentattributesonvarients.csv'],
+             [outputs['group_skus.csv'], outputs['variantattributes.csv'], names, pricing]),
+            (outputs['parents.csv'].assign(group='product'), [names, pricing])]
+
+
+# Peak traced memory of func(*args) above what was allocated before it, and the bytes of its result frame
+def traced_peak(func, *args):
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        result = func(*args)
+        peak = tracemalloc.get_traced_memory()[1] - start
+    finally:
+        tracemalloc.stop()
+    return peak, result.memory_usage(index=False).sum()
+
+
+def bench_merge(args):
+    generator = {'variants_per_parent': args.variants_per_parent, 'images': args.images,
+                 'cardinality': args.cardinality, 'fill': args.fill, 'seed': args.seed}
+    print(f"{'variants':>10} {'join':>8} {'columns':>8} {'plan':>7} {'seconds':>8} {'peak MB':>8} {'result MB':>9} "
+          f"{'peak/result':>11}")
+    with tempfile.TemporaryDirectory(prefix='benchmark-') as scratch:
+        for n in args.sizes:
+            path = os.path.join(scratch, f'catalog-{n}.csv')
+            synthetic_catalog.generate_catalog(path, n, **generator)
+            for label, (left, frames) in zip(('variants', 'parents'), mikes_way_joins(path)):
+                expected = legacy_join_on_sku(left, frames)
+                if not join_on_sku(left, frames).equals(expected):
+                    logging.error(f"join_on_sku differs from the chained merges ({label}, {n} variants)")
+                    return 1
+                for plan, func in (('legacy', legacy_join_on_sku), ('planned', join_on_sku)):
+                    seconds = time_call(func, left, frames, repeat=args.repeat)
+                    peak, size = traced_peak(func, left, frames)
+                    print(f"{n:>10} {label:>8} {len(expected.columns):>8} {plan:>7} {seconds:>8.3f} "
+                          f"{peak / 1024 ** 2:>8.1f} {size / 1024 ** 2:>9.1f} {peak / size:>10.1f}x")
+            os.remove(path)
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Performance benchmarks for the migration pipeline")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    interleave = subparsers.add_parser('interleave', help="Parent/variant ordering used by MikesWay.csv")
+    interleave.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000],
+                            help="Numbers of variant rows to time")
+    interleave.add_argument('--legacy-max', type=int, default=10_000,
+                            help="Also time the old per-parent loop up to this many variants")
+    interleave.add_argument('--max-exponent', type=float, default=1.25,
+                            help="Fail when time grows faster than size**max_exponent")
+    interleave.add_argument('--repeat', type=int, default=3)
+    interleave.set_defaults(func=bench_interleave)
+
+    pricing = subparsers.add_parser('pricing', help="'{:.2f}' price formatting in addvariants.format_pricing")
+    pricing.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    pricing.add_argument('--repeat', type=int, default=3)
+    pricing.set_defaults(func=bench_pricing)
+
+    parse = subparsers.add_parser('parse', help="Catalog CSV parsing with each engine catalog_loader supports")
+    parse.add_argument('inputs', nargs='+', help="Catalog CSV files to parse")
+    parse.add_argument('--repeat', type=int, default=3)
+    parse.set_defaults(func=bench_parse)
+
+    scaling = subparsers.add_parser('scaling', help="Every stage on synthetic catalogs of increasing size (synthetic_catalog.py)")
+    scaling.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000],
+                         help="Numbers of variant rows to generate")
+    scaling.add_argument('--variants-per-parent', type=float, default=3.0)
+    scaling.add_argument('--images', type=int, default=4, help="Most image URLs on a variant")
+    scaling.add_argument('--cardinality', type=int, default=20, help="Distinct values per attribute column")
+    scaling.add_argument('--fill', type=float, default=0.3, help="Share of parent attribute cells with a value")
+    scaling.add_argument('--seed', type=int, default=0)
+    scaling.add_argument('--data-dir', help="Keep the generated catalogs here and reuse them (default: regenerate)")
+    scaling.add_argument('--history', default='benchmark_history.json', help="JSON file every run is appended to")
+    scaling.add_argument('--tolerance', type=float, default=0.25,
+                         help="Fail when a stage is this much slower or bigger than in the previous run")
+    scaling.add_argument('--min-seconds', type=float, default=0.05,
+                         help="Ignore slowdowns smaller than this many seconds")
+    scaling.set_defaults(func=bench_scaling)
+
+    merge = subparsers.add_parser('merge', help="MikesWay's sku joins, planned as one pass vs chained pd.merge calls")
+    merge.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000], help="Variant rows per catalog")
+    merge.add_argument('--variants-per-parent', type=float, default=3.0)
+    merge.add_argument('--images', type=int, default=10, help="Most image URLs on a variant (each one is a column)")
+    merge.add_argument('--cardinality', type=int, default=20, help="Distinct values per attribute column")
+    merge.add_argument('--fill', type=float, default=0.3, help="Share of parent attribute cells with a value")
+    merge.add_argument('--seed', type=int, default=0)
+    merge.add_argument('--repeat', type=int, default=3)
+    merge.set_defaults(func=bench_merge)
+
+    args = parser.parse_args()
+    catalog_loader.enable_copy_on_write()
+    exit(args.func(args))
+
+
+if __name__ == "__main__":
+    main()
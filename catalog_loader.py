@@ -0,0 +1,443 @@
+import os
+import sys
+import time
+import threading
+import logging
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from pandas.api.types import infer_dtype
+
+# Optional: the pyarrow CSV engine parses on several threads
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
+
+# Set up logging configuration
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+class CatalogCache:
+    """
+    Parses each catalog CSV once and hands every caller a read-only view of the parsed frame.
+
+    Entries are keyed by absolute path, modification time, size and the columns parsed, so a
+    file that is replaced on disk is parsed again. A frame of every column also serves requests
+    for a subset of them. At most `max_entries` frames are kept, least recently used first out.
+    Frames are stored with compact_dtypes() applied.
+    """
+
+    def __init__(self, max_entries=4):
+        self.max_entries = max_entries
+        self._frames = OrderedDict()
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def _key(self, path, usecols=None):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        return path, stat.st_mtime_ns, stat.st_size, tuple(usecols) if usecols is not None else None
+
+    def load(self, path, usecols=None):
+        """View of `path` parsed with only the `usecols` columns (all of them when None)."""
+        key = self._key(path, usecols)
+        full_key = key[:3] + (None,)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        # Only one thread parses a given file; the others wait and then share its result
+        with key_lock:
+            with self._lock:
+                if key in self._frames:
+                    self._frames.move_to_end(key)
+                    return self._frames[key].copy(deep=False)
+                if full_key in self._frames:
+                    self._frames.move_to_end(full_key)
+                    full = self._frames[full_key]
+                    return full[[column for column in full.columns if column in set(usecols)]]
+
+            df, stats = parse_catalog(path, usecols)
+            df, compact_stats = compact_dtypes(df)
+            stats.update(compact_stats)
+
+            with self._lock:
+                self._frames[key] = df
+                self._stats[key[0]] = stats
+                while len(self._frames) > self.max_entries:
+                    old_key, _ = self._frames.popitem(last=False)
+                    self._key_locks.pop(old_key, None)
+            return df.copy(deep=False)
+
+    def stats(self, path):
+        """Parse statistics for the most recent parse of `path`, or None if it was never parsed."""
+        with self._lock:
+            return self._stats.get(os.path.abspath(path))
+
+    def evict(self, path):
+        path = os.path.abspath(path)
+        with self._lock:
+            for key in [k for k in self._frames if k[0] == path]:
+                del self._frames[key]
+                self._key_locks.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self._stats.clear()
+            self._key_locks.clear()
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process so far, or None where the platform doesn't report it."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def current_rss_bytes():
+    """Resident set size of this process now, or None where /proc isn't available."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+# 'c' is the pandas parser; 'pyarrow' needs pyarrow and is the default when it is installed.
+# CATALOG_CSV_ENGINE=c forces the pandas parser.
+CSV_ENGINES = ('c', 'pyarrow')
+
+
+def default_engine():
+    engine = os.environ.get('CATALOG_CSV_ENGINE')
+    if engine:
+        return engine
+    return 'pyarrow' if pa is not None else 'c'
+
+
+# The only tokens the pandas parser reads as booleans; pyarrow would also take '1' and '0'
+TRUE_VALUES = ['True', 'TRUE', 'true']
+FALSE_VALUES = ['False', 'FALSE', 'false']
+
+# The tokens the pandas parser reads as missing (its default na_values), for pyarrow to read the same way
+NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN', '<NA>', 'N/A',
+             'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null']
+
+
+def read_csv_c(path, usecols=None):
+    return pd.read_csv(path, low_memory=False, usecols=usecols)
+
+
+def _float_column(values):
+    """
+    NumPy copy of a pyarrow double column when the pandas parser would have read the same
+    floats, else None. pyarrow also reads '+5' and integers past 2**53 as doubles, and rounds
+    digits past the 15th differently, so those columns are left to the pandas parser.
+    """
+    floats = values.to_numpy(zero_copy_only=False)
+    present = floats[~values.is_null().to_numpy(zero_copy_only=False)]
+    if not np.isfinite(present).all() or (np.abs(present) >= 2 ** 53).any():
+        return None
+    if len(present) and (present == np.round(present)).all():
+        return None
+    distinct = np.unique(present)
+    small = (distinct != 0) & (np.abs(distinct) < 1e-7)
+    if small.any() or any(value != float(f'{value:.15g}') for value in distinct):
+        return None
+    return floats
+
+
+def _has_hex_fields(path, block_size=16 * 1024 * 1024):
+    """
+    Whether any field of the file may start with '0x': pyarrow reads those as hexadecimal
+    integers where the pandas parser keeps the text. Errs on the side of True.
+    """
+    with open(path, 'rb') as f:
+        tail = b''
+        for block in iter(lambda: f.read(block_size), b''):
+            data = tail + block
+            for marker in (b'0x', b'0X'):
+                start = data.find(marker)
+                while start != -1:
+                    if start == 0 or data[start - 1:start] in b', \t\r\n"+-':
+                        return True
+                    start = data.find(marker, start + 1)
+            tail = data[-2:]
+    return False
+
+
+def _numpy_column(values, hex_fields=False):
+    """
+    The column the pandas parser produces for a pyarrow column (ChunkedArray), or None when
+    that can't be told from the parsed values (dates, times, undecodable text, some floats,
+    integers when the file has hex-looking fields).
+    """
+    kind = values.type
+    nulls = values.null_count
+    # A column with no values at all: object when the file has no rows, else float
+    if pa.types.is_null(kind):
+        return np.full(len(values), np.nan) if len(values) else np.empty(0, dtype=object)
+    if pa.types.is_int64(kind):
+        if hex_fields:
+            return None
+        if not nulls:
+            return values.to_numpy()
+        # With blanks the pandas parser reads the column as floats, which only match the integers below 2**53
+        if pc.max(pc.abs(values)).as_py() >= 2 ** 53:
+            return None
+        return pc.cast(values, pa.float64()).to_numpy(zero_copy_only=False)
+    if pa.types.is_boolean(kind):
+        if not nulls:
+            return values.to_numpy(zero_copy_only=False)
+        return np.array([np.nan if value is None else value for value in values.to_pylist()], dtype=object)
+    if pa.types.is_string(kind) or pa.types.is_large_string(kind):
+        # One Python string per distinct value, shared by the rows that repeat it, as the pandas parser does
+        encoded = pc.dictionary_encode(values.combine_chunks())
+        distinct = np.append(encoded.dictionary.to_numpy(zero_copy_only=False), np.nan)
+        # Missing values take the NaN appended last
+        return distinct[encoded.indices.fill_null(-1).to_numpy()]
+    if pa.types.is_float64(kind):
+        return _float_column(values)
+    return None
+
+
+def read_csv_pyarrow(path, usecols=None):
+    """
+    Parse with pyarrow's multithreaded reader into Arrow columns, then hand back the frame
+    read_csv_c would: the stages rely on NumPy dtypes and NaN for missing values. Columns whose
+    pandas-parser result can't be derived from the Arrow values are parsed again with it, and
+    a file pyarrow can't read at all (short rows, say) goes to the pandas parser whole.
+
+    pyarrow.csv is called directly rather than through read_csv(engine='pyarrow'), which can't
+    be told that quoted values span lines, as descriptions in the exports do.
+    """
+    expected = pd.read_csv(path, nrows=0, usecols=usecols).columns.tolist()
+    # Repeated header names are renamed by the pandas parser only
+    if len(set(expected)) != len(expected) or any(column.startswith('Unnamed: ') for column in expected):
+        return read_csv_c(path, usecols)
+    try:
+        table = pa_csv.read_csv(path,
+                                parse_options=pa_csv.ParseOptions(newlines_in_values=True),
+                                convert_options=pa_csv.ConvertOptions(include_columns=expected,
+                                                                      null_values=NA_VALUES,
+                                                                      strings_can_be_null=True,
+                                                                      true_values=TRUE_VALUES,
+                                                                      false_values=FALSE_VALUES))
+    except pa.ArrowException as e:
+        logging.info(f"pyarrow could not parse {os.path.basename(path)} ({e}), using the pandas parser")
+        return read_csv_c(path, usecols)
+
+    hex_fields = any(pa.types.is_int64(kind) for kind in table.schema.types) and _has_hex_fields(path)
+    columns = {}
+    reparse = []
+    for column in expected:
+        converted = _numpy_column(table.column(column), hex_fields)
+        if converted is None:
+            reparse.append(column)
+        columns[column] = converted
+        # Free each Arrow column once converted, and hand the memory back from pyarrow's pool
+        table = table.drop_columns([column])
+    del table
+    pa.default_memory_pool().release_unused()
+
+    if reparse:
+        logging.info(f"Parsing {len(reparse)} columns with the pandas parser: {reparse[:10]}")
+        c_df = read_csv_c(path, reparse)
+        for column in reparse:
+            columns[column] = c_df[column]
+    # copy=False keeps one array per column instead of copying them into consolidated blocks
+    return pd.DataFrame(columns, columns=expected, copy=False)
+
+
+def parse_catalog(path, usecols=None, engine=None):
+    """
+    Parse a catalog CSV (only the `usecols` columns, if given) with `engine` (default_engine()
+    when None) and return the frame plus its parse statistics: engine, rows, columns parsed and
+    in the file, parse time in seconds, the process peak RSS afterwards and how much the parse
+    raised it. Both engines return the same frame.
+    """
+    engine = engine or default_engine()
+    if engine not in CSV_ENGINES:
+        raise ValueError(f"Unknown CSV engine: {engine}")
+    if engine == 'pyarrow' and pa is None:
+        logging.warning("pyarrow is not installed, using the pandas CSV parser")
+        engine = 'c'
+
+    peak_before = peak_rss_bytes()
+    start = time.perf_counter()
+    df = read_csv_pyarrow(path, usecols) if engine == 'pyarrow' else read_csv_c(path, usecols)
+    parse_seconds = time.perf_counter() - start
+    peak_after = peak_rss_bytes()
+
+    stats = {
+        'path': path,
+        'engine': engine,
+        'rows': len(df),
+        'columns': len(df.columns),
+        'file_columns': len(read_header(path)) if usecols is not None else len(df.columns),
+        'parse_seconds': parse_seconds,
+        'peak_rss_bytes': peak_after,
+        'peak_rss_growth_bytes': peak_after - peak_before if peak_after is not None else None,
+    }
+    logging.info(f"Parsed {os.path.basename(path)}: {format_parse_stats(stats)}")
+    return df, stats
+
+
+def format_parse_stats(stats):
+    message = f"{stats['rows']} rows, {stats['columns']} columns"
+    if stats['file_columns'] != stats['columns']:
+        message += f" of {stats['file_columns']}"
+    message += f" in {stats['parse_seconds']:.2f}s ({stats['engine']} parser)"
+    if stats['peak_rss_bytes'] is not None:
+        message += (f" (peak RSS {stats['peak_rss_bytes'] / 1024 ** 2:.1f} MB,"
+                    f" +{stats['peak_rss_growth_bytes'] / 1024 ** 2:.1f} MB while parsing)")
+    if stats.get('compacted_columns'):
+        message += f", {format_compaction(stats)}"
+    return message
+
+
+# A text column is stored as a categorical when its rows with a value outnumber its distinct
+# values at least this many times. CATALOG_CATEGORY_RATIO overrides it; 0 turns compaction off.
+DEFAULT_CATEGORY_RATIO = 5.0
+
+# Integer ids, read as floats wherever a row leaves them blank, and the SKUs, unique per row
+ID_COLUMNS = ('id', 'variant.id', 'variant.product_id')
+SKU_COLUMNS = ('sku', 'variant.sku')
+
+# Free text the stages fill with values the column may not hold (images and barcodes with '', names with
+# the parent's 'name', which becomes 'fields.name'), split or merge on; these stay plain object columns,
+# as a categorical refuses values outside its categories
+FREE_TEXT_COLUMNS = ('name', 'variant.name', 'variant.barcode', 'variant.images')
+
+
+def category_ratio():
+    ratio = os.environ.get('CATALOG_CATEGORY_RATIO')
+    return float(ratio) if ratio else DEFAULT_CATEGORY_RATIO
+
+
+def _nullable_int_dtype(values):
+    """The narrowest nullable integer dtype holding every value of a numeric column, or None."""
+    present = values[~np.isnan(values)]
+    if not len(present) or (present != np.round(present)).any():
+        return None
+    for dtype in ('Int8', 'Int16', 'Int32', 'Int64'):
+        limits = np.iinfo(dtype.lower())
+        if limits.min <= present.min() and present.max() <= limits.max:
+            return dtype
+    return None
+
+
+def compact_dtypes(df, ratio=None):
+    """
+    Store a parsed catalog in less memory without changing what any stage writes: text columns
+    whose values repeat at least `ratio` times (category_ratio() when None) become categoricals,
+    except the free text of FREE_TEXT_COLUMNS, the id columns the narrowest nullable integers that
+    hold them, and the SKUs the string dtype, Arrow-backed when pyarrow is installed. Returns the frame and the columns' memory before and
+    after, counting each distinct string of a text column once, as the parsers share them.
+    """
+    ratio = category_ratio() if ratio is None else ratio
+    if ratio <= 0:
+        return df, {}
+    start = time.perf_counter()
+    string_dtype = pd.StringDtype('pyarrow' if pa is not None else 'python')
+    columns = {}
+    changed = before = after = 0
+    for column in df.columns:
+        values = columns[column] = df[column]
+        name = column.strip()
+        compacted = None
+        if name in ID_COLUMNS and values.dtype.kind in 'if':
+            dtype = _nullable_int_dtype(values.to_numpy(dtype=float))
+            if dtype is not None:
+                compacted = values.astype(dtype)
+                size = values.memory_usage(index=False)
+        elif values.dtype == object and infer_dtype(values, skipna=True) == 'string':
+            if name in SKU_COLUMNS:
+                compacted = values.astype(string_dtype)
+                size = values.memory_usage(index=False, deep=True)
+            elif name not in FREE_TEXT_COLUMNS:
+                codes, categories = pd.factorize(values, sort=True)
+                if len(categories) and (codes >= 0).sum() / len(categories) >= ratio:
+                    compacted = pd.Series(pd.Categorical.from_codes(codes, categories=categories),
+                                          index=values.index, name=column)
+                    size = values.memory_usage(index=False) + categories.memory_usage(deep=True)
+        if compacted is not None:
+            columns[column] = compacted
+            changed += 1
+            before += size
+            after += compacted.memory_usage(index=False, deep=True)
+
+    stats = {
+        'compacted_columns': changed,
+        'compact_seconds': time.perf_counter() - start,
+        'compacted_bytes_before': before,
+        'compacted_bytes_after': after,
+    }
+    if changed:
+        df = pd.DataFrame(columns, columns=df.columns, copy=False)
+        logging.info(f"Compacted dtypes: {format_compaction(stats)}")
+    return df, stats
+
+
+def format_compaction(stats):
+    return (f"{stats['compacted_columns']} columns compacted from {stats['compacted_bytes_before'] / 1024 ** 2:.1f}"
+            f" to {stats['compacted_bytes_after'] / 1024 ** 2:.1f} MB in {stats['compact_seconds']:.2f}s")
+
+
+# Shared cache used by every stage in this process
+catalog_cache = CatalogCache()
+
+
+# Views handed out by the cache share memory with the cached frame. Copy-on-Write makes
+# any write to a view copy the touched column first, so no stage can modify the cached
+# frame another stage is still reading. pandas options are process-wide, so the entry
+# points (script main()s, job and batch workers) turn it on once rather than this import.
+def enable_copy_on_write():
+    pd.set_option('mode.copy_on_write', True)
+
+
+def load_catalog(path, usecols=None):
+    return catalog_cache.load(path, usecols)
+
+
+# Column names of a catalog CSV, read without parsing any rows
+def read_header(path):
+    return pd.read_csv(path, nrows=0).columns.tolist()
+
+
+class MissingColumnError(ValueError):
+    """The export lacks a column a stage can't run without."""
+
+    def __init__(self, column, stage=None):
+        needed_by = f" (needed by {stage})" if stage else ''
+        super().__init__(f"catalog is missing required column '{column}'{needed_by}")
+        self.column = column
+        self.stage = stage
+
+
+def select_columns(header, names=(), ranges=(), stage=None):
+    """
+    Header columns a stage reads, in file order: the `names` it uses plus every column of each
+    (first, last) range, `last` excluded; a `last` of None runs to the end of the header.
+    Names match after stripping whitespace, as the stages do, and missing ones are skipped.
+    The ends of the ranges are required: a missing one raises MissingColumnError naming `stage`.
+    """
+    stripped = [column.strip() for column in header]
+    keep = [name in names for name in stripped]
+    for first, last in ranges:
+        for column in (first, last):
+            if column is not None and column not in stripped:
+                raise MissingColumnError(column, stage)
+        start = stripped.index(first)
+        end = stripped.index(last) if last is not None else len(header)
+        keep[start:end] = [True] * (end - start)
+    return [column for column, kept in zip(header, keep) if kept]
+
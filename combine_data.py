@@ -2,13 +2,16 @@
 import pandas as pd
 import os
 
-def combine_product_data():
+from workspace import parse_workspace
+
+def combine_product_data(workspace=None):
+    if workspace is None:
+        workspace = parse_workspace("Combine the stage outputs into MikesWay.csv", needs_input=False)
     print("Starting data combination process...")
     
     # Create output directory if it doesn't exist
-    output_dir = './output'
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    output_dir = workspace.output_dir
+    workspace.ensure_output_dir()
     
     # Load the CSV files
     try:
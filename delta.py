@@ -0,0 +1,169 @@
+import os
+import json
+import logging
+import numpy as np
+import pandas as pd
+
+import instrumentation
+
+# Outputs written as deltas, all keyed by their 'sku' column
+DELTA_FILES = ('addvariants.csv', 'parents.csv', 'group_skus.csv', 'parentattributesonvarients.csv',
+               'variantattributes.csv', 'target_pts.csv', 'MikesWay.csv')
+
+# Outputs holding parent rows: besides their own changes they get the parent row of every changed variant
+PARENT_FILES = ('parents.csv', 'MikesWay.csv')
+
+# Outputs whose changes make a variant's parent row part of the delta
+VARIANT_FILES = ('addvariants.csv', 'group_skus.csv', 'parentattributesonvarients.csv', 'variantattributes.csv')
+
+# Every added, changed and removed SKU of a delta run, per output file
+CHANGES_FILE = 'changes.csv'
+
+
+def fingerprints(df):
+    """
+    Content fingerprint of each SKU in an output frame: a 64-bit hash of its row's values, indexed
+    by the SKU as text. A SKU with several rows (one per parent row sharing an id) gets one hash of
+    all of them, in order.
+    """
+    hashes = pd.Series(pd.util.hash_pandas_object(df, index=False).to_numpy(), index=df['sku'].astype(str).to_numpy())
+    repeated = hashes.index.duplicated(keep=False)
+    if not repeated.any():
+        return hashes
+    combined = hashes[repeated].groupby(level=0, sort=False).agg(lambda h: np.uint64(hash(tuple(h)) & (2 ** 64 - 1)))
+    return pd.concat([hashes[~repeated], combined.astype(np.uint64)])
+
+
+class FingerprintStore:
+    """
+    What the previous delta run of a catalog produced, kept in `directory`: the columns and the
+    SKU fingerprints of each output in DELTA_FILES, and the parent SKU of every variant.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.columns = {}
+        if os.path.exists(self._path('columns.json')):
+            with open(self._path('columns.json')) as f:
+                self.columns = json.load(f)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _fingerprint_path(self, file_name):
+        return self._path(os.path.splitext(file_name)[0] + '.fingerprints.csv')
+
+    def fingerprints(self, file_name):
+        """The previous run's fingerprints of `file_name`, or None when it didn't write that file."""
+        if file_name not in self.columns or not os.path.exists(self._fingerprint_path(file_name)):
+            return None
+        df = pd.read_csv(self._fingerprint_path(file_name), dtype={'sku': str, 'fingerprint': np.uint64},
+                         keep_default_na=False)
+        return pd.Series(df['fingerprint'].to_numpy(), index=df['sku'].to_numpy())
+
+    def parents(self):
+        """The previous run's parent SKU of each variant SKU (group_skus.csv)."""
+        if not os.path.exists(self._path('parents.json')):
+            return pd.Series(dtype=object)
+        with open(self._path('parents.json')) as f:
+            return pd.Series(json.load(f), dtype=object)
+
+    def save(self, columns, file_fingerprints, parents):
+        """Replace the stored run; the column lists go last, so a save cut short leaves no file half-recorded."""
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        for file_name, values in file_fingerprints.items():
+            pd.DataFrame({'sku': values.index, 'fingerprint': values.to_numpy()}).to_csv(
+                self._fingerprint_path(file_name), index=False)
+        with open(self._path('parents.json'), 'w') as f:
+            json.dump(parents.to_dict(), f)
+        with open(self._path('columns.json'), 'w') as f:
+            json.dump(columns, f)
+        self.columns = columns
+
+
+# Parent SKU of every variant SKU in a group_skus.csv frame, the first when there are several
+def variant_parents(group_skus):
+    parents = pd.Series(group_skus['group_skus.0'].astype(str).to_numpy(), index=group_skus['sku'].astype(str).to_numpy())
+    return parents[~parents.index.duplicated()]
+
+
+def compare(new, old, same_columns=True):
+    """Added, changed and removed SKUs between two fingerprint Series; every common SKU is changed when the columns differ."""
+    added = new.index.difference(old.index, sort=False)
+    removed = old.index.difference(new.index, sort=False)
+    common = new.index.intersection(old.index, sort=False)
+    if same_columns:
+        common = common[new[common].to_numpy() != old[common].to_numpy()]
+    return added, common, removed
+
+
+def write_delta(outputs, workspace, state_dir, log_messages=None):
+    """
+    Write only what changed since the previous run recorded in `state_dir`:
+    - each output in DELTA_FILES gets the rows of its added and changed SKUs. parents.csv and
+      MikesWay.csv also get the parent row of each variant that changed in a VARIANT_FILES output.
+    - CHANGES_FILE lists every added, changed and removed SKU per output.
+    Other outputs are written whole. The first run, or an output whose columns changed, is
+    written in full. This run's fingerprints then replace the previous ones.
+    """
+    if log_messages is None:
+        log_messages = []
+    store = FingerprintStore(state_dir)
+    workspace.ensure_output_dir()
+
+    current = {}
+    emitted = {}
+    changes = []
+    changed_variants = set()
+    for file_name, data in outputs.items():
+        if file_name not in DELTA_FILES:
+            continue
+        current[file_name] = fingerprints(data)
+        previous = store.fingerprints(file_name)
+        same_columns = store.columns.get(file_name) == list(data.columns)
+        if previous is None:
+            previous = pd.Series(dtype=np.uint64)
+        elif not same_columns:
+            log_messages.append(f"The columns of {file_name} changed since the previous run; all of its rows are written.")
+        added, changed, removed = compare(current[file_name], previous, same_columns)
+        emitted[file_name] = added.append(changed)
+        for change, skus in (('added', added), ('changed', changed), ('removed', removed)):
+            changes.append(pd.DataFrame({'file': file_name, 'sku': skus, 'change': change}))
+        if file_name in VARIANT_FILES:
+            changed_variants.update(emitted[file_name])
+            changed_variants.update(removed)
+
+    # Parents of the changed variants, in this run or (for removed variants) the previous one
+    parents = variant_parents(outputs['group_skus.csv']) if 'group_skus.csv' in outputs else pd.Series(dtype=object)
+    previous_parents = store.parents()
+    affected_parents = set(parents[parents.index.isin(changed_variants)])
+    affected_parents.update(previous_parents[previous_parents.index.isin(changed_variants)])
+
+    for file_name, data in outputs.items():
+        output_file = workspace.output_path(file_name)
+        if isinstance(data, str):
+            with open(output_file, 'w') as f:
+                f.write(data)
+            continue
+        if file_name not in DELTA_FILES:
+            data.to_csv(output_file, index=False)
+            continue
+        skus = data['sku'].astype(str)
+        rows = skus.isin(emitted[file_name])
+        if file_name in PARENT_FILES:
+            rows |= skus.isin(affected_parents)
+        with instrumentation.step(f'write {file_name}', len(data)) as record:
+            data[rows.to_numpy()].to_csv(output_file, index=False)
+            record['rows_out'] = int(rows.sum())
+        log_messages.append(f"{file_name}: {rows.sum()} of {len(data)} rows written.")
+
+    changes = pd.concat(changes, ignore_index=True) if changes else pd.DataFrame(columns=['file', 'sku', 'change'])
+    changes.to_csv(workspace.output_path(CHANGES_FILE), index=False)
+    counts = changes['change'].value_counts()
+    log_messages.append(f"Delta since the previous run: {counts.get('added', 0)} added, {counts.get('changed', 0)} changed, "
+                        f"{counts.get('removed', 0)} removed (per output file, see {CHANGES_FILE}).")
+
+    store.save({file_name: list(outputs[file_name].columns) for file_name in current}, current, parents)
+    logging.info(f"Saved output fingerprints to {state_dir}")
+    return changes
@@ -2,9 +2,13 @@
 import os
 import pandas as pd
 
-def extract_product_groups():
+from workspace import parse_workspace
+
+def extract_product_groups(workspace=None):
     """Extract all items with group='product' from MikesWay.csv"""
-    output_dir = './output'
+    if workspace is None:
+        workspace = parse_workspace("Extract the product rows of MikesWay.csv", needs_input=False)
+    output_dir = workspace.output_dir
     mikesway_file = os.path.join(output_dir, 'MikesWay.csv')
     
     if not os.path.exists(mikesway_file):
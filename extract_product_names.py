@@ -2,18 +2,37 @@
 import os
 import pandas as pd
 
-def extract_variant_names():
-    # Load the input CSV file
-    input_dir = './input'
-    output_dir = './output'
+from catalog_loader import enable_copy_on_write, load_catalog, read_header, select_columns
+from workspace import parse_workspace
+from intermediates import read_output
+
+def build_variant_names(input_df, group_skus_df, mikesway_df):
+    """
+    Pair every variant row of MikesWay with its group_skus.0 parent and its variant.name
+    from the input export. Takes frames that are already in memory, e.g. the pipeline outputs.
+    """
+    # Filter MikesWay to only get rows where group='variant'
+    variant_rows = mikesway_df.loc[mikesway_df['group'] == 'variant', ['sku']]
+    print(f"Found {len(variant_rows)} rows with group='variant'")
     
-    # Get the input file
-    input_files = os.listdir(input_dir)
-    if len(input_files) == 0:
-        print("No input file found.")
-        return False
+    # Merge with group_skus to get the parent SKUs
+    variant_with_groups = pd.merge(variant_rows, group_skus_df[['sku', 'group_skus.0']], on='sku', how='inner')
+    print(f"Found {len(variant_with_groups)} variants with group_skus.0 values")
     
-    input_file = os.path.join(input_dir, input_files[0])
+    # Index the input names by variant.sku once, keeping the first row for each SKU
+    names = input_df[['variant.sku', 'variant.name']].dropna(subset=['variant.sku'])
+    names = names.drop_duplicates(subset='variant.sku').set_index('variant.sku')['variant.name']
+    
+    # Get the variant.name from the input file by matching variant.sku; variants without a match are skipped
+    result_df = variant_with_groups[variant_with_groups['sku'].isin(names.index)].reset_index(drop=True)
+    result_df['variant_name'] = result_df['sku'].map(names)
+    return result_df[['sku', 'group_skus.0', 'variant_name']]
+
+def extract_variant_names(workspace=None):
+    if workspace is None:
+        workspace = parse_workspace("Build variant_names.csv from the input export and MikesWay.csv")
+    input_file = workspace.input_file
+    output_dir = workspace.output_dir
     print(f"Processing file: {input_file}")
     
     # Load the group_skus.csv file to get products with group_skus.0 values
@@ -29,39 +48,15 @@ def extract_variant_names():
     
     # Read the input CSV, group_skus CSV, and MikesWay CSV
     try:
-        input_df = pd.read_csv(input_file, low_memory=False)
-        group_skus_df = pd.read_csv(group_skus_file)
+        input_df = load_catalog(input_file, select_columns(read_header(input_file), ['variant.sku', 'variant.name']))
+        group_skus_df = read_output(workspace, 'group_skus.csv')
         mikesway_df = pd.read_csv(mikesway_file)
         
         print(f"Input file loaded: {len(input_df)} rows")
         print(f"Group SKUs file loaded: {len(group_skus_df)} rows")
         print(f"MikesWay file loaded: {len(mikesway_df)} rows")
         
-        # Filter MikesWay to only get rows where group='variant'
-        variant_rows = mikesway_df[mikesway_df['group'] == 'variant']
-        print(f"Found {len(variant_rows)} rows with group='variant'")
-        
-        # Merge with group_skus to get the parent SKUs
-        variant_with_groups = pd.merge(variant_rows, group_skus_df, on='sku', how='inner')
-        print(f"Found {len(variant_with_groups)} variants with group_skus.0 values")
-        
-        # Get the variant.name from the input file by matching variant.sku
-        result_df = pd.DataFrame(columns=['sku', 'group_skus.0', 'variant_name'])
-        
-        for index, row in variant_with_groups.iterrows():
-            sku = row['sku']
-            group_sku = row['group_skus.0']
-            
-            # Find the matching row in the input file by variant.sku
-            matching_rows = input_df[input_df['variant.sku'] == sku]
-            
-            if not matching_rows.empty:
-                variant_name = matching_rows['variant.name'].values[0]
-                result_df = pd.concat([result_df, pd.DataFrame({
-                    'sku': [sku], 
-                    'group_skus.0': [group_sku], 
-                    'variant_name': [variant_name]
-                })], ignore_index=True)
+        result_df = build_variant_names(input_df, group_skus_df, mikesway_df)
         
         # Save the results to CSV
         output_file = os.path.join(output_dir, 'variant_names.csv')
@@ -81,4 +76,5 @@ def extract_variant_names():
         return False
 
 if __name__ == "__main__":
+    enable_copy_on_write()
     extract_variant_names()
@@ -3,10 +3,13 @@ import os
 import pandas as pd
 import logging
 
+from MikesWay import interleave_variants
+from workspace import parse_workspace
+
 # Set up logging configuration
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def generate_mikesway_csv():
+def generate_mikesway_csv(workspace=None):
     """
     Generates MikesWay.csv by combining data from:
     - group_skus.csv
@@ -14,12 +17,13 @@ def generate_mikesway_csv():
     - parents.csv
     - variantattributes.csv
     """
+    if workspace is None:
+        workspace = parse_workspace("Build MikesWay.csv from the other stages' outputs", needs_input=False)
     logging.info("Starting MikesWay CSV generation")
     
     # Create output directory if it doesn't exist
-    output_dir = './output'
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    output_dir = workspace.output_dir
+    workspace.ensure_output_dir()
     
     # Check if required files exist
     required_files = [
@@ -77,31 +81,8 @@ def generate_mikesway_csv():
         variant_rows['group'] = 'variant'
         
         # Combine parent and variant rows
-        # First, organize by parent-child relationships
-        result_df = pd.DataFrame()
-        
-        # Get unique parent SKUs
-        parent_skus = parent_rows['sku'].unique()
-        
-        # For each parent, add its rows followed by its children
-        for parent_sku in parent_skus:
-            # Get parent row
-            parent = parent_rows[parent_rows['sku'] == parent_sku].copy()
-            
-            # Extract parent ID from 'variant-X' format
-            parent_id = parent_sku.replace('variant-', '')
-            
-            # Get child rows for this parent
-            children = variant_rows[variant_rows['group_skus.0'] == parent_sku].copy()
-            
-            # Combine parent and children
-            combined = pd.concat([parent, children], ignore_index=True)
-            
-            # Add to result
-            if result_df.empty:
-                result_df = combined
-            else:
-                result_df = pd.concat([result_df, combined], ignore_index=True)
+        # First, organize by parent-child relationships: each parent followed by its children
+        result_df, _ = interleave_variants(parent_rows, variant_rows)
         
         # Add any variants without parents
         orphans = variant_rows[~variant_rows['sku'].isin(result_df['sku'])].copy()
@@ -122,7 +103,7 @@ def generate_mikesway_csv():
         
         # Create error file for debugging
         try:
-            with open('./output/mikesway_error.log', 'w') as f:
+            with open(workspace.output_path('mikesway_error.log'), 'w') as f:
                 f.write(f"Error: {str(e)}\n\n{error_traceback}")
         except:
             pass
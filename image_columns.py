@@ -0,0 +1,41 @@
+import logging
+import pandas as pd
+
+
+def image_column_names(n_alternates):
+    """'main' followed by images.default.1.alternate.url .. images.default.N.alternate.url."""
+    return ['main'] + [f'images.default.{i}.alternate.url' for i in range(1, n_alternates + 1)]
+
+
+def explode_images(images, max_alternates=None, strip=False, trailing_empty_columns=0):
+    """
+    Split a comma-separated 'variant.images' column into a 'main' column plus one
+    images.default.N.alternate.url column per alternate image. Every row is split once and
+    all image columns are built together, instead of one Python call per row per column.
+
+    - max_alternates: keep at most this many alternate columns; extra images on a row are
+      dropped, so one SKU with dozens of images doesn't widen every row of the file.
+    - strip: strip whitespace around each URL and leave blank entries empty (None).
+    - trailing_empty_columns: append this many always-empty alternate columns after the
+      real ones (addvariants.csv has always ended with one).
+    """
+    values = images.fillna('').astype(str).tolist()
+
+    # Split off at most max_alternates + 1 URLs; the unsplit remainder of longer rows is dropped
+    max_split = -1 if max_alternates is None else max_alternates + 1
+    keep = None if max_alternates is None else max_alternates + 1
+    if strip:
+        rows = [[url.strip() or None for url in value.split(',', max_split)[:keep]] for value in values]
+    else:
+        rows = [value.split(',', max_split)[:keep] for value in values]
+
+    if max_alternates is not None:
+        dropped = sum(1 for value in values if value.count(',') > max_alternates)
+        if dropped:
+            logging.warning(f"{dropped} rows have more than {max_alternates} alternate images; extra images were dropped")
+
+    exploded = pd.DataFrame(rows, index=images.index)
+    n_alternates = max(exploded.shape[1] - 1, 0) + trailing_empty_columns
+    exploded = exploded.reindex(columns=range(n_alternates + 1))
+    exploded.columns = image_column_names(n_alternates)
+    return exploded
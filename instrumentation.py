@@ -0,0 +1,192 @@
+import os
+import time
+import threading
+import functools
+import tracemalloc
+from contextlib import contextmanager
+import pandas as pd
+
+# INSTRUMENT_TRACEMALLOC=1 traces Python allocations so every step also reports its peak; this slows the
+# pipeline down noticeably, so it is off unless asked for
+if os.environ.get('INSTRUMENT_TRACEMALLOC') == '1' and not tracemalloc.is_tracing():
+    tracemalloc.start()
+
+_local = threading.local()
+
+
+def _stack(name):
+    if not hasattr(_local, name):
+        setattr(_local, name, [])
+    return getattr(_local, name)
+
+
+@contextmanager
+def collect():
+    """Collect the records of the steps run in this thread inside the block, as a list of dicts."""
+    records = []
+    _stack('collectors').append(records)
+    try:
+        yield records
+    finally:
+        _stack('collectors').pop()
+
+
+@contextmanager
+def step(name, rows_in=None):
+    """
+    Time the block as step `name` and yield its record, where the caller may set 'rows_out'.
+    Records wall and CPU seconds (this thread's) and, while tracemalloc is tracing, the peak of
+    traced memory above the start of the step. Does nothing outside collect().
+    """
+    collectors = _stack('collectors')
+    if not collectors:
+        yield {}
+        return
+    record = {'step': name, 'rows_in': rows_in, 'rows_out': None, 'wall_seconds': None, 'cpu_seconds': None,
+              'memory_peak_bytes': None}
+    steps = _stack('steps')
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        current, peak = tracemalloc.get_traced_memory()
+        # The peak is reset for this step, so an enclosing step keeps the one it reached so far
+        if steps:
+            steps[-1]['_peak'] = max(steps[-1]['_peak'], peak)
+        tracemalloc.reset_peak()
+        record['_start'], record['_peak'] = current, current
+    steps.append(record)
+    wall_start, cpu_start = time.perf_counter(), time.thread_time()
+    try:
+        yield record
+    finally:
+        record['wall_seconds'] = time.perf_counter() - wall_start
+        record['cpu_seconds'] = time.thread_time() - cpu_start
+        steps.pop()
+        if tracing:
+            peak = max(record.pop('_peak'), tracemalloc.get_traced_memory()[1])
+            record['memory_peak_bytes'] = peak - record.pop('_start')
+            if steps:
+                steps[-1]['_peak'] = max(steps[-1]['_peak'], peak)
+        collectors[-1].append(record)
+
+
+# Rows of a step's frame argument or result: a DataFrame or Series, or the first of a tuple
+def _rows(value):
+    if isinstance(value, tuple) and value:
+        value = value[0]
+    return len(value) if isinstance(value, (pd.DataFrame, pd.Series)) else None
+
+
+def instrumented(func):
+    """Run every call of `func` as a step named 'module.function', with rows in and out from its frames."""
+    name = f"{func.__module__}.{func.__name__}"
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _stack('collectors'):
+            return func(*args, **kwargs)
+        with step(name, _rows(args[0]) if args else None) as record:
+            result = func(*args, **kwargs)
+            record['rows_out'] = _rows(result)
+        return result
+
+    return wrapper
+
+
+def format_step(record):
+    """One job log line for a step record, e.g. 'addvariants.split_images: 1,000 -> 1,000 rows in 0.12s (CPU 0.11s)'."""
+    message = f"{record['step']}:"
+    if record['rows_in'] is not None or record['rows_out'] is not None:
+        rows_in = f"{record['rows_in']:,}" if record['rows_in'] is not None else '?'
+        rows_out = f"{record['rows_out']:,}" if record['rows_out'] is not None else '?'
+        message += f" {rows_in} -> {rows_out} rows"
+    message += f" in {record['wall_seconds']:.3f}s (CPU {record['cpu_seconds']:.3f}s)"
+    if record['memory_peak_bytes'] is not None:
+        message += f", traced peak +{record['memory_peak_bytes'] / 1024 ** 2:.1f} MB"
+    return message
+
+
+# Histogram buckets in seconds and bytes
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+BYTES_BUCKETS = tuple(1024 ** 2 * mb for mb in (1, 4, 16, 64, 256, 1024, 4096))
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = [(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for key, value in labels]
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+class Metrics:
+    """
+    Totals and histograms of finished jobs, aggregated from their progress events (the 'step'
+    and 'stage_finished' events pipeline.emit() records) and rendered in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> (type, help, {label tuple: value}); histograms hold [bucket counts, sum, count]
+        self._metrics = {}
+
+    def _value(self, name, kind, help_text, labels, default):
+        metric = self._metrics.setdefault(name, (kind, help_text, {}))
+        return metric[2].setdefault(tuple(labels), default)
+
+    def _increment(self, name, help_text, labels, amount=1):
+        values = self._metrics.setdefault(name, ('counter', help_text, {}))[2]
+        values[tuple(labels)] = values.get(tuple(labels), 0) + amount
+
+    def _observe(self, name, help_text, labels, value, buckets):
+        histogram = self._value(name, 'histogram', help_text, labels, [[0] * len(buckets), 0.0, 0, buckets])
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                histogram[0][i] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+    def observe_job(self, status, events):
+        """Count a finished job with `status` and add its steps and stages."""
+        with self._lock:
+            self._increment('migration_jobs_total', "Finished jobs by status", [('status', status)])
+            for event in events:
+                if event['event'] == 'step':
+                    labels = [('step', event['stage'])]
+                    self._observe('migration_step_seconds', "Wall time of instrumented pipeline steps", labels,
+                                  event['wall_seconds'], SECONDS_BUCKETS)
+                    self._increment('migration_step_cpu_seconds_total', "CPU time of instrumented pipeline steps",
+                                    labels, event['cpu_seconds'])
+                    for direction in ('in', 'out'):
+                        if event[f'rows_{direction}'] is not None:
+                            self._increment('migration_step_rows_total', "Rows into and out of pipeline steps",
+                                            labels + [('direction', direction)], event[f'rows_{direction}'])
+                    if event['memory_peak_bytes'] is not None:
+                        self._observe('migration_step_memory_peak_bytes',
+                                      "Peak traced memory of pipeline steps (INSTRUMENT_TRACEMALLOC=1)", labels,
+                                      event['memory_peak_bytes'], BYTES_BUCKETS)
+                elif event['event'] == 'stage_finished':
+                    self._observe('migration_stage_seconds', "Wall time of pipeline stages",
+                                  [('stage', event['stage'])], event['seconds'], SECONDS_BUCKETS)
+
+    def render(self):
+        """Every metric in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name, (kind, help_text, values) in sorted(self._metrics.items()):
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in sorted(values.items()):
+                    if kind != 'histogram':
+                        lines.append(f"{name}{_labels(labels)} {value}")
+                        continue
+                    counts, total, count, buckets = value
+                    for bound, bucket_count in zip(buckets, counts):
+                        lines.append(f"{name}_bucket{_labels(labels + (('le', str(bound)),))} {bucket_count}")
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {count}")
+                    lines.append(f"{name}_sum{_labels(labels)} {total}")
+                    lines.append(f"{name}_count{_labels(labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+
+# Metrics of the jobs this process has run or watched
+metrics = Metrics()
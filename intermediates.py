@@ -0,0 +1,124 @@
+import os
+import json
+import logging
+import numpy as np
+import pandas as pd
+
+# Optional: without pyarrow no Parquet copies are kept and later stages parse the CSVs
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Stage outputs that later stages read back; these get a Parquet copy alongside the CSV deliverable
+INTERMEDIATE_FILES = (
+    'addvariants.csv',
+    'parents.csv',
+    'group_skus.csv',
+    'parentattributesonvarients.csv',
+    'variantattributes.csv',
+)
+
+# Columns of the outputs that hold text even when every value looks like a number: SKUs, UPCs and
+# '{:.2f}' prices. Parsing a CSV copy reads them as text, as the stages wrote them ('8.70', not 8.7)
+TEXT_COLUMNS = ('sku', 'upc', 'group_skus.0', 'pricing_item.price.amount', 'pricing_item.msrp.amount')
+
+# Rows converted to Arrow at a time, so a copy never holds a second full frame in memory
+ROW_GROUP_SIZE = 100_000
+
+# Schema metadata key holding the size and mtime of the CSV a Parquet copy was written with
+CSV_STAT_KEY = b'migration.csv_stat'
+
+
+def intermediate_path(workspace, file_name):
+    return os.path.join(workspace.intermediate_dir, os.path.splitext(file_name)[0] + '.parquet')
+
+
+def _csv_stat(csv_path):
+    stat = os.stat(csv_path)
+    return json.dumps([stat.st_size, stat.st_mtime_ns]).encode()
+
+
+def save_intermediate(workspace, file_name, df):
+    """
+    Keep a Parquet copy of an output whose CSV was just written, so later stages get its
+    dtypes back instead of re-parsing the text. Frames Parquet can't hold (a column mixing
+    text and numbers) get no copy, and the CSV is read instead.
+    """
+    if pa is None or file_name not in INTERMEDIATE_FILES:
+        return
+    path = intermediate_path(workspace, file_name)
+    if not os.path.exists(workspace.intermediate_dir):
+        os.makedirs(workspace.intermediate_dir)
+    try:
+        table = pa.Table.from_pandas(df.iloc[:ROW_GROUP_SIZE], preserve_index=False)
+        schema = table.schema
+        # A column with no values in the first rows takes its type from the whole frame
+        for i, kind in enumerate(schema.types):
+            if pa.types.is_null(kind):
+                name = schema.names[i]
+                schema = schema.set(i, pa.Schema.from_pandas(df[[name]], preserve_index=False).field(name))
+        metadata = dict(schema.metadata or {})
+        metadata[CSV_STAT_KEY] = _csv_stat(workspace.output_path(file_name))
+        schema = schema.with_metadata(metadata)
+        with pq.ParquetWriter(path, schema) as writer:
+            writer.write_table(table.cast(schema))
+            del table
+            for start in range(ROW_GROUP_SIZE, len(df), ROW_GROUP_SIZE):
+                rows = df.iloc[start:start + ROW_GROUP_SIZE]
+                writer.write_table(pa.Table.from_pandas(rows, schema=schema, preserve_index=False))
+    except (pa.ArrowException, ValueError) as e:
+        logging.info(f"Not keeping a Parquet copy of {file_name}: {e}")
+        if os.path.exists(path):
+            os.remove(path)
+    pa.default_memory_pool().release_unused()
+
+
+def write_output(workspace, file_name, df):
+    """Write a stage's CSV deliverable and, for files later stages read, its Parquet copy."""
+    df.to_csv(workspace.output_path(file_name), index=False)
+    save_intermediate(workspace, file_name, df)
+
+
+def _to_frame(table):
+    """
+    The frame a Parquet copy was saved from. Parquet hands missing text back as None where
+    the stages expect NaN, so text columns with gaps are rebuilt: one string object per
+    distinct value, as read_csv shares them, and NaN for the gaps.
+    """
+    text = [name for name, kind in zip(table.column_names, table.schema.types)
+            if pa.types.is_string(kind) or pa.types.is_large_string(kind)]
+    df = table.drop_columns(text).to_pandas()
+    columns = {name: df[name] for name in df.columns}
+    for name in text:
+        encoded = pc.dictionary_encode(table.column(name).combine_chunks())
+        distinct = np.append(encoded.dictionary.to_numpy(zero_copy_only=False), np.nan)
+        columns[name] = distinct[encoded.indices.fill_null(-1).to_numpy()]
+    # Other object columns (True/False with gaps) come back with None too
+    for name in df.columns[df.dtypes == object]:
+        values = df[name].to_numpy(copy=True)
+        values[pd.isna(values)] = np.nan
+        columns[name] = values
+    return pd.DataFrame(columns, columns=table.column_names, copy=False)
+
+
+def read_output(workspace, file_name, columns=None):
+    """
+    An earlier stage's output, with only `columns` (the ones present) when given. Comes from
+    the Parquet copy with the dtypes the stage produced when that copy was written with the
+    CSV now on disk; a CSV written since (by a streaming run, say) is parsed instead, with
+    TEXT_COLUMNS kept as text so both give the same output.
+    """
+    csv_path = workspace.output_path(file_name)
+    path = intermediate_path(workspace, file_name)
+    if pa is not None and os.path.exists(path):
+        schema = pq.read_schema(path)
+        if (schema.metadata or {}).get(CSV_STAT_KEY) == _csv_stat(csv_path):
+            names = schema.names if columns is None else [name for name in schema.names if name in columns]
+            df = _to_frame(pq.read_table(path, columns=names))
+            pa.default_memory_pool().release_unused()
+            return df
+    return pd.read_csv(csv_path, usecols=None if columns is None else (lambda column: column in columns),
+                       dtype={column: str for column in TEXT_COLUMNS})
@@ -0,0 +1,268 @@
+import io
+import os
+import time
+import uuid
+import zipfile
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pipeline
+import instrumentation
+import profiling
+import validation
+from catalog_loader import enable_copy_on_write
+from workspace import Workspace
+
+
+class Job:
+    """One uploaded catalog going through the pipeline."""
+
+    def __init__(self, job_id, workspace, options):
+        self.id = job_id
+        self.workspace = workspace
+        self.options = options
+        self.log = []
+        # Progress events from pipeline.emit(), in order; read by the /jobs/<id>/events stream
+        self.events = []
+        self.future = None
+        self.result = None
+        # Set when a result cache is in use; `cached` means the outputs came from it
+        self.cache_key = None
+        self.cached = False
+        self.created_at = time.time()
+        self.finished_at = None
+
+    @property
+    def status(self):
+        if self.result is not None:
+            return self.result
+        if self.future is not None and self.future.running():
+            return 'running'
+        return 'queued'
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'log': list(self.log),
+            'cached': self.cached,
+            'created_at': self.created_at,
+            'finished_at': self.finished_at,
+        }
+
+
+# Zip compression for downloads: 'store' is fastest, 'deflate' makes the CSVs much smaller
+ZIP_COMPRESSION = {'store': zipfile.ZIP_STORED, 'deflate': zipfile.ZIP_DEFLATED}
+
+
+class _ZipOutput(io.RawIOBase):
+    """Non-seekable sink for ZipFile that keeps what was written until drain() hands it out."""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+# Every file in an output directory, paired with its name inside the download zip
+def output_files(output_dir):
+    files = []
+    for root, dirs, names in os.walk(output_dir):
+        # Hidden directories (Parquet copies of command-line runs) aren't part of the outputs
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for name in sorted(names):
+            file_path = os.path.join(root, name)
+            files.append((file_path, os.path.relpath(file_path, output_dir)))
+    return files
+
+
+def stream_zip(files, compression='deflate', compresslevel=None, chunk_size=1024 * 1024):
+    """
+    Yield a zip archive of `files` ((path, name in archive) pairs) piece by piece, reading each
+    file in `chunk_size` blocks. Nothing is written to disk and at most about one compressed
+    block is held in memory, so it can be sent as the HTTP response while it is built.
+    """
+    output = _ZipOutput()
+    with zipfile.ZipFile(output, 'w', ZIP_COMPRESSION[compression], compresslevel=compresslevel) as zipf:
+        for file_path, arcname in files:
+            # Sizes aren't known up front when streaming, so large files need zip64 headers from the start
+            large = os.path.getsize(file_path) > zipfile.ZIP64_LIMIT
+            with open(file_path, 'rb') as src, zipf.open(arcname, 'w', force_zip64=large) as dest:
+                while True:
+                    chunk = src.read(chunk_size)
+                    if not chunk:
+                        break
+                    dest.write(chunk)
+                    data = output.drain()
+                    if data:
+                        yield data
+            yield output.drain()
+    # Central directory
+    yield output.drain()
+
+
+def execute_job(workspace, options, log_messages=None, events=None):
+    """
+    Run the pipeline for one job. Runs in a worker thread or process, so it only takes plain
+    values and returns ('finished' | 'failed', log_messages). Progress events go to `events`.
+    With options['profile'] the run is profiled and the profile saved with the outputs.
+    """
+    if log_messages is None:
+        log_messages = []
+    arguments = (workspace, options.get('use_mikes_way', False), log_messages, options.get('max_alternate_images'))
+    try:
+        if options.get('profile'):
+            profiling.run_profiled(workspace.output_dir, log_messages, pipeline.run_pipeline, *arguments, events=events)
+        else:
+            pipeline.run_pipeline(*arguments, events=events)
+    except pipeline.PipelineError as e:
+        log_messages.append(f"✗ Error in {e.stage}:")
+        log_messages.append(str(e))
+        return 'failed', log_messages
+    except Exception as e:
+        logging.exception(f"Job for {workspace.input_file} failed")
+        log_messages.append(f"Error: {str(e)}")
+        return 'failed', log_messages
+
+    log_messages.append("All processing complete. Files ready for download.")
+    return 'finished', log_messages
+
+
+class JobQueue:
+    """
+    Runs uploads on a local pool of `workers` threads or processes (`executor` is 'thread' or
+    'process'). Jobs wait in the executor's own queue; no external broker is involved.
+    Every job gets its own temporary workspace under `root` (the system temp directory by
+    default), and only the `retention` most recent finished jobs are kept on disk.
+    With a result_cache.ResultCache, an upload that was already processed with the same
+    options is answered from the cache without running the pipeline; profiled jobs always run.
+    """
+
+    def __init__(self, workers=2, executor='thread', root=None, retention=20, cache=None):
+        if executor not in ('thread', 'process'):
+            raise ValueError(f"Unknown executor type: {executor}")
+        self.executor_type = executor
+        self.root = root
+        self.retention = retention
+        self.cache = cache
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._manager = None
+        if executor == 'process':
+            self._executor = ProcessPoolExecutor(max_workers=workers, initializer=enable_copy_on_write)
+            # Worker processes report progress events through lists shared by a manager process
+            self._manager = multiprocessing.Manager()
+        else:
+            # Worker threads share this process's pandas options; they are set once the first worker starts,
+            # so building a queue (as importing main does) leaves them alone
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job-worker',
+                                                initializer=enable_copy_on_write)
+
+    def create_job(self, filename, options):
+        """Create the job's workspace; the caller saves the upload to job.workspace.input_file and then calls enqueue()."""
+        job_id = uuid.uuid4().hex
+        job = Job(job_id, Workspace.temporary(filename, self.root, prefix=f'job-{job_id}-'), options)
+        if self._manager is not None:
+            job.events = self._manager.list()
+        with self._lock:
+            self.jobs[job_id] = job
+        return job
+
+    def enqueue(self, job, task=execute_job):
+        """
+        Run `job` with `task` (execute_job, or another function with its signature and return
+        value, such as batch.execute_batch). Only unprofiled execute_job runs are answered from the cache.
+        """
+        if self.cache is not None and task is execute_job and not job.options.get('profile'):
+            job.cache_key = self.cache.key(job.workspace.input_file, job.options)
+            if self.cache.get(job.cache_key, job.workspace.output_dir):
+                job.log.append(f"Found cached results for this file (sha256 {job.cache_key[:12]}), skipping processing.")
+                # The validation warnings of the run that was cached
+                report_file = job.workspace.output_path(validation.REPORT_FILE)
+                if os.path.exists(report_file):
+                    job.log.extend(validation.ValidationReport.load(report_file).format_lines('warning'))
+                job.log.append("All processing complete. Files ready for download.")
+                job.cached = True
+                job.finished_at = time.time()
+                job.result = 'finished'
+                instrumentation.metrics.observe_job(job.result, [])
+                self._prune()
+                return job
+
+        job.log.append("Queued for processing...")
+        # Worker threads can append to the job's log as it runs; worker processes hand theirs back at the end.
+        # Events reach the job as they happen either way
+        live_log = job.log if self.executor_type == 'thread' else None
+        job.future = self._executor.submit(task, job.workspace, job.options, live_log, job.events)
+        job.future.add_done_callback(lambda future: self._finish(job, future))
+        return job
+
+    def _finish(self, job, future):
+        try:
+            result, log_messages = future.result()
+        except Exception as e:
+            logging.error(f"Job {job.id} crashed: {e}")
+            result, log_messages = 'failed', job.log + [f"Error: {str(e)}"]
+        if log_messages is not job.log:
+            job.log[:] = log_messages
+        if result == 'finished' and job.cache_key is not None:
+            try:
+                self.cache.put(job.cache_key, job.workspace.output_dir)
+            except OSError as e:
+                logging.warning(f"Could not cache results of job {job.id}: {e}")
+        # The job's steps and stage timings go into the metrics /metrics serves
+        instrumentation.metrics.observe_job(result, list(job.events))
+        job.finished_at = time.time()
+        job.result = result
+        self._prune()
+
+    def _prune(self):
+        with self._lock:
+            finished = sorted((job for job in self.jobs.values() if job.result is not None),
+                              key=lambda job: job.finished_at)
+            expired = finished[:max(len(finished) - self.retention, 0)]
+            for job in expired:
+                del self.jobs[job.id]
+        for job in expired:
+            job.workspace.cleanup()
+
+    def status_counts(self):
+        """How many of the jobs held are queued, running, finished and failed."""
+        counts = {'queued': 0, 'running': 0, 'finished': 0, 'failed': 0}
+        with self._lock:
+            for job in self.jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+        return counts
+
+    def get(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def shutdown(self, wait=True):
+        """Stop the workers and remove every job's workspace."""
+        self._executor.shutdown(wait=wait)
+        if self._manager is not None:
+            self._manager.shutdown()
+        with self._lock:
+            remaining = list(self.jobs.values())
+            self.jobs.clear()
+        for job in remaining:
+            job.workspace.cleanup()
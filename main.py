@@ -1,8 +1,9 @@
-from flask import Flask, render_template, request, send_file, url_for
+from flask import Flask, Response, render_template, request
+from werkzeug.utils import secure_filename
 import os
-import shutil
-import zipfile
-import subprocess
+import json
+import time
+import atexit
 
 app = Flask(__name__)
 
@@ -16,11 +17,36 @@ import logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+import jobs
+import batch
+from catalog_loader import enable_copy_on_write
+import result_cache
+import instrumentation
+
+# Outputs of earlier uploads, reused when the same file is uploaded again with the same options.
+# RESULT_CACHE_MAX_MB=0 turns the cache off
+result_cache_max_mb = int(os.environ.get('RESULT_CACHE_MAX_MB', 1024))
+results = None
+if result_cache_max_mb > 0:
+    results = result_cache.ResultCache(os.environ.get('RESULT_CACHE_DIR', result_cache.cache_directory),
+                                       result_cache_max_mb * 1024 * 1024)
+
+# Background workers for uploads; JOB_EXECUTOR is 'thread' or 'process'. Each job runs in its
+# own temporary workspace under JOBS_DIR (the system temp directory if unset)
+job_queue = jobs.JobQueue(workers=int(os.environ.get('JOB_WORKERS', 2)),
+                          executor=os.environ.get('JOB_EXECUTOR', 'thread'),
+                          root=os.environ.get('JOBS_DIR'),
+                          cache=results)
+atexit.register(job_queue.shutdown)
+
+# Downloads are zipped on the fly; DOWNLOAD_COMPRESSION is 'deflate' (smaller) or 'store' (faster),
+# and a request can override it with ?compression=
+download_compression = os.environ.get('DOWNLOAD_COMPRESSION', 'deflate')
+download_compresslevel = os.environ.get('DOWNLOAD_COMPRESSLEVEL')
+if download_compresslevel is not None:
+    download_compresslevel = int(download_compresslevel)
+
 # Create necessary directories
-if not os.path.exists('input'):
-    os.makedirs('input')
-if not os.path.exists('output'):
-    os.makedirs('output')
 if not os.path.exists('static'):
     os.makedirs('static')
 if not os.path.exists('templates'):
@@ -52,74 +78,137 @@ def upload_file():
             return {'status': 'error', 'log': ['No file uploaded']}, 400
         file = request.files['file']
         use_mikes_way = request.form.get('use_mikes_way') == 'true'
+        max_alternate_images = request.form.get('max_alternate_images', type=int)
+        # /upload?profile=1 profiles the run; the download then also holds the profile
+        profile = request.values.get('profile') in ('1', 'true')
     except Exception as e:
         return {'status': 'error', 'log': [str(e)]}, 400
         
     if file.filename == '':
-        return {'status': 'error', 'log': ['No selected file']}
+        return {'status': 'error', 'log': ['No selected file']}, 400
 
     if file and file.filename.endswith('.csv'):
-        # Clear directories
-        for directory in ['input', 'output']:
-            for f in os.listdir(directory):
-                os.remove(os.path.join(directory, f))
-
-        # Save new file
-        file_path = os.path.join('input', file.filename)
-        file.save(file_path)
-
-        log_messages = []
-        try:
-            scripts = ["addvariants.py", "parentattributesonvarients.py", "variantattributes.py", "target_pts.py"]
-            for script in scripts:
-                log_messages.append(f"Running {script}...")
-                result = subprocess.run(['python', script], capture_output=True, text=True)
-                if result.returncode == 0:
-                    log_messages.append(f"✓ {script} completed successfully.")
-                    if result.stdout:
-                        log_messages.append(result.stdout)
-                else:
-                    log_messages.append(f"✗ Error in {script}:")
-                    log_messages.append(result.stderr)
-                    return {'status': 'error', 'log': log_messages}
-            
-            # Run Mike's Way processing if selected
-            if use_mikes_way:
-                log_messages.append("Running Mike's Way processing...")
-                try:
-                    import MikesWay
-                    logging.info(f"Starting Mike's Way processing for file: {file_path}")
-                    if MikesWay.process_mikes_way(file_path):
-                        log_messages.append("✓ Mike's Way processing completed successfully.")
-                    else:
-                        log_messages.append("✗ Error in Mike's Way processing. Check server logs for details.")
-                except Exception as e:
-                    import traceback
-                    error_trace = traceback.format_exc()
-                    logging.error(f"Mike's Way processing error: {str(e)}\n{error_trace}")
-                    log_messages.append(f"✗ Error in Mike's Way processing: {str(e)}")
-
-            # Create zip file
-            with zipfile.ZipFile('processed_files.zip', 'w') as zipf:
-                for root, dirs, files in os.walk('output'):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        arcname = os.path.relpath(file_path, 'output')
-                        zipf.write(file_path, arcname)
-
-            log_messages.append("All processing complete. Files ready for download.")
-            return {'status': 'success', 'log': log_messages}
-
-        except Exception as e:
-            log_messages.append(f"Error: {str(e)}")
-            return {'status': 'error', 'log': log_messages}
-
-    return {'status': 'error', 'log': ['Invalid file type']}
+        # Save the upload into a fresh job workspace and hand it to the worker pool
+        options = {'use_mikes_way': use_mikes_way, 'max_alternate_images': max_alternate_images}
+        if profile:
+            options['profile'] = True
+        job = job_queue.create_job(secure_filename(file.filename) or 'upload.csv', options)
+        file.save(job.workspace.input_file)
+        job_queue.enqueue(job)
+        return {'status': job.status, 'job_id': job.id, 'log': list(job.log)}, 202
+
+    return {'status': 'error', 'log': ['Invalid file type']}, 400
+
+# Many catalogs at once: CSV files and zips of them as 'files'. Each catalog is migrated on its own worker
+# process (BATCH_WORKERS, one per core by default); the job's download holds one directory per catalog
+# plus manifest.json with every catalog's status and timing
+@app.route('/batch', methods=['POST'])
+def upload_batch():
+    try:
+        files = [file for file in request.files.getlist('files') if file.filename]
+        use_mikes_way = request.form.get('use_mikes_way') == 'true'
+        max_alternate_images = request.form.get('max_alternate_images', type=int)
+    except Exception as e:
+        return {'status': 'error', 'log': [str(e)]}, 400
 
+    if not files:
+        return {'status': 'error', 'log': ['No files uploaded']}, 400
+    invalid = [file.filename for file in files if not file.filename.lower().endswith(('.csv', '.zip'))]
+    if invalid:
+        return {'status': 'error', 'log': [f"Invalid file type: {', '.join(invalid)}"]}, 400
+
+    job = job_queue.create_job('batch', {'use_mikes_way': use_mikes_way, 'max_alternate_images': max_alternate_images})
+    names = set()
+    for file in files:
+        name, extension = os.path.splitext(secure_filename(file.filename))
+        file.save(os.path.join(job.workspace.input_dir, batch.unique_name(name or 'upload', names) + extension))
+    job_queue.enqueue(job, batch.execute_batch)
+    return {'status': job.status, 'job_id': job.id, 'log': list(job.log)}, 202
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return {'status': 'error', 'log': ['Unknown job']}, 404
+    return job.to_dict()
+
+# How often the event stream looks for new events, and how long it stays quiet before a keep-alive comment
+EVENT_POLL_SECONDS = 0.25
+EVENT_KEEPALIVE_SECONDS = 15
+
+# Server-Sent Events: the job's progress events (pipeline.emit) as they happen, each as a JSON 'message'
+# with its position as the event id, then one 'done' event with the job's final status. A reconnecting
+# EventSource sends Last-Event-ID and picks up after the last event it got
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return {'status': 'error', 'log': ['Unknown job']}, 404
+    start = request.headers.get('Last-Event-ID', type=int)
+    position = start + 1 if start is not None else 0
+
+    def stream():
+        nonlocal position
+        quiet_since = time.monotonic()
+        while True:
+            # Read the result first, so no event appended before the job finished is missed
+            result = job.result
+            new_events = job.events[position:]
+            for event in new_events:
+                yield f"id: {position}\ndata: {json.dumps(event)}\n\n"
+                position += 1
+            if result is not None:
+                yield f"event: done\ndata: {json.dumps({'status': result, 'cached': job.cached})}\n\n"
+                return
+            if new_events:
+                quiet_since = time.monotonic()
+            elif time.monotonic() - quiet_since > EVENT_KEEPALIVE_SECONDS:
+                yield ": keep-alive\n\n"
+                quiet_since = time.monotonic()
+            time.sleep(EVENT_POLL_SECONDS)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Prometheus text format: step and stage timing histograms, rows and CPU time of the jobs run so far,
+# plus how many jobs are in each state now
+@app.route('/metrics')
+def metrics():
+    lines = ["# HELP migration_jobs Jobs the queue holds, by status", "# TYPE migration_jobs gauge"]
+    lines.extend(f'migration_jobs{{status="{status}"}} {count}' for status, count in job_queue.status_counts().items())
+    return Response(instrumentation.metrics.render() + '\n'.join(lines) + '\n',
+                    mimetype='text/plain; version=0.0.4')
+
+@app.route('/cache')
+def cache_stats():
+    if results is None:
+        return {'enabled': False}
+    return {'enabled': True, **results.stats()}
+
+# Stream a zip of `files` ((path, name in archive) pairs) as the response
+def zip_response(files, download_name):
+    compression = request.args.get('compression', download_compression)
+    if compression not in jobs.ZIP_COMPRESSION:
+        return {'status': 'error', 'log': [f"Unknown compression '{compression}', use one of: "
+                                           f"{', '.join(jobs.ZIP_COMPRESSION)}"]}, 400
+    compresslevel = download_compresslevel if compression == 'deflate' else None
+    return Response(jobs.stream_zip(files, compression, compresslevel),
+                    mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename={download_name}'})
+
+@app.route('/jobs/<job_id>/download')
+def job_download(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return {'status': 'error', 'log': ['Unknown job']}, 404
+    if job.status != 'finished':
+        return {'status': job.status, 'log': ['Job has not finished successfully yet']}, 409
+    return zip_response(jobs.output_files(job.workspace.output_dir), 'processed_files.zip')
+
+# Outputs of a command-line run in ./output
 @app.route('/download')
 def download():
     output_files = [
-        'input/processed_data.csv',
         'output/addvariants.csv',
         'output/group_skus.csv', 
         'output/parent_columns.txt',
@@ -130,51 +219,10 @@ def download():
         'output/target_pts.csv',
         'output/MikesWay.csv'
     ]
-    
-    # Create a zip of available files
-    with zipfile.ZipFile('output_files.zip', 'w') as zipf:
-        files_found = False
-        for file in output_files:
-            if os.path.exists(file):
-                zipf.write(file, os.path.basename(file))
-                files_found = True
-        
-        # If no files were found, add a README
-        if not files_found:
-            zipf.writestr('README.txt', 'No output files were generated during processing.')
-    
-    # Force cleanup of all files
-    for directory in ['input', 'output']:
-        for file in os.listdir(directory):
-            file_path = os.path.join(directory, file)
-            try:
-                if os.path.isfile(file_path):
-                    # Force close any open file handles
-                    import gc
-                    gc.collect()
-                    os.chmod(file_path, 0o777)  # Give full permissions
-                    os.remove(file_path)
-                    logging.info(f"Deleted {file_path}")
-            except Exception as e:
-                logging.error(f"Failed to delete {file_path}: {e}")
-                try:
-                    import signal
-                    os.kill(os.getpid(), signal.SIGINT)  # Force interrupt to release file handles
-                    os.remove(file_path)
-                except:
-                    pass
-    
-    # Send the zip file
-    response = send_file('output_files.zip', as_attachment=True)
-    
-    # Force cleanup of zip file
-    try:
-        os.remove('output_files.zip')
-        logging.info("Deleted output_files.zip")
-    except Exception as e:
-        logging.error(f"Failed to delete output_files.zip: {e}")
-        
-    return response
+    files = [(file, os.path.basename(file)) for file in output_files if os.path.exists(file)]
+    if not files:
+        return {'status': 'error', 'log': ['No output files were generated during processing.']}, 404
+    return zip_response(files, 'output_files.zip')
 
 @app.errorhandler(Exception)
 def handle_error(e):
@@ -197,6 +245,7 @@ def handle_error(e):
     }, status_code
 
 if __name__ == '__main__':
+    enable_copy_on_write()
     # Get port from environment variable or default to 8080
     port = int(os.environ.get('PORT', 8080))
     # In production, disable debug mode and use 0.0.0.0 to accept all incoming connections
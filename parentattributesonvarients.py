@@ -1,24 +1,24 @@
 
 import os
+import argparse
+import warnings
+from functools import cached_property
+import numpy as np
 import pandas as pd
 import logging
 
-# Set input and output directories
-input_directory = './input/'
-output_directory = './output/'
+from catalog_loader import MissingColumnError, enable_copy_on_write, load_catalog, read_header, select_columns
+from workspace import Workspace, add_workspace_arguments
+from intermediates import write_output
+from streaming import DEFAULT_CHUNKSIZE, DtypeScan, check_duplicate_skus, read_chunks, write_chunk
+from instrumentation import instrumented
+from validation import ValidationError, duplicate_skus_error
 
 # Set up logging configuration
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Check if input directory exists and fetch file
-def load_file_from_directory(input_directory):
-    files = os.listdir(input_directory)
-    if len(files) != 1:
-        logging.error("There are no files or more than one file in the directory.")
-        exit()
-    return pd.read_csv(os.path.join(input_directory, files[0]), low_memory=False)
-
 # Remove rows where 'variant.name' contains 'Sample product'
+@instrumented
 def filter_sample_product(df):
     logging.info("Filtering rows where 'variant.name' or 'name' contains 'Sample product'")
     
@@ -28,85 +28,99 @@ def filter_sample_product(df):
     
     return df
 
-def clean_parents(parents, children):
-    # Count how many children each parent has by checking how many times `parent.id` appears in `children.variant.product_id`
-    parent_child_count = children['variant.product_id'].value_counts()
-
-    # Filter parents to keep only those whose `id` has more than one corresponding child
-    parents_with_multiple_children = parents[parents['id'].isin(parent_child_count[parent_child_count > 1].index)]
-
-    # Ensure you're working on a copy to avoid the SettingWithCopyWarning
-    parents = parents_with_multiple_children.copy()
-
-    # Create new 'sku' column by combining 'variant.id' and 'variant.sku'
-    parents.loc[:, 'sku'] = 'variant-' + parents['id'].astype(int).astype(str)  
-
-
-    # Drop columns if they exist
-    columns_to_drop = ['variant.sku', 'id', 'variant.product_id']
-    if 'target_enabled' in parents.columns:
-        columns_to_drop.append('target_enabled')
-    parents = parents.drop(columns=[col for col in columns_to_drop if col in parents.columns])
-
-    # Reorder columns to make 'sku' the first column
-    columns = ['sku'] + [col for col in parents.columns if col != 'sku']
-    parents = parents[columns]
-
-   # Assuming df is the DataFrame you're working with
-    columns_to_export = [col for col in parents.columns if col != 'sku' and col != 'brand' and col != 'description'] 
-    column_string = ','.join(columns_to_export)
-
-    # Write the column names to a text file
-    with open('./output/parent_columns.txt', 'w') as f:
-        f.write(column_string)
-
-    # Rename columns to add 'fields.' prefix, except for 'sku'
-    parents.columns = ['fields.' + col if col != 'sku' else col for col in parents.columns]
-
-    # Add 'options.0' and 'options.1' columns with values 'size' and 'color', respectively
-    parents['options.0'] = 'size'
-    parents['options.1'] = 'color'
-
-    if not os.path.exists(output_directory):
-        os.makedirs(output_directory)
-    output_file = os.path.join(output_directory, 'parents.csv')
-    parents.to_csv(output_file, index=False)
-    return
-
-def final_link(parents, children):
-    # Count how many children each parent has by checking how many times `parent.id` appears in `children.variant.product_id`
-    parent_child_count = children['variant.product_id'].value_counts()
-
-    # Filter parents to keep only those whose `id` has more than one corresponding child
-    parents_with_multiple_children = parents[parents['id'].isin(parent_child_count[parent_child_count > 1].index)]
-
-    # Ensure you're working on a copy to avoid the SettingWithCopyWarning
-    parents = parents_with_multiple_children.copy()
-
-    # Merge all columns from parents and children based on 'variant.product_id' and 'id'
-    merged = children.merge(parents, left_on='variant.product_id', right_on='id', how='left')
-
-    # Create the 'sku' column (which contains all 'variant.sku' from the children)
-    merged['sku'] = merged['variant.sku_x']
-    
-    # Create the 'group_skus.0' column (which combines 'variant.id' and 'variant.sku')
-    merged['group_skus.0'] = 'variant-' + merged['variant.product_id_x'].astype(int).astype(str)
-
-    # Filter the merged dataframe to only include parents with multiple children
-    merged = merged[merged['variant.product_id_x'].isin(parent_child_count[parent_child_count > 1].index)]
-
-    # Select only the 'sku' and 'group_skus.0' columns
-    final_df = merged[['sku', 'group_skus.0']]
-
-    # Save the final result to a CSV file
-    output_file = './output/group_skus.csv'
-    final_df.to_csv(output_file, index=False)
-    
-    logging.info(f"Successfully linked parents and children. The data is saved to {output_file}")
-
-
-
-
+class ProductGraph:
+    """
+    How the child rows of an export link to its parent rows, worked out once from the ids and
+    shared by parents.csv, group_skus.csv and the filled children: the children per parent id,
+    the ids grouping more than one child, and which parent rows each child row links to.
+
+    Streaming passes `child_counts` for the whole file along with one chunk of `children`, and
+    no children at all when only parent_rows() is needed.
+    """
+
+    def __init__(self, parents, children, child_counts=None):
+        self.parents = parents
+        self.children = children
+        # Count how many children each parent has by checking how many times `parent.id` appears in `children.variant.product_id`
+        if child_counts is None:
+            child_counts = children['variant.product_id'].value_counts()
+        self.child_counts = child_counts
+        # Only parents with more than one child become products with variants
+        self.grouped_ids = child_counts.index[child_counts > 1]
+
+    @cached_property
+    def links(self):
+        """
+        Positions into `children` and `parents`, one row per child row and parent row with its id,
+        in child order; a child without a parent row gets one row with parent -1. This is the join
+        the outputs used to repeat as three merges of the whole frames.
+        """
+        child_ids = pd.DataFrame({'id': self.children['variant.product_id'].array,
+                                  'child': np.arange(len(self.children))})
+        parent_ids = pd.DataFrame({'id': self.parents['id'].array, 'parent': np.arange(len(self.parents))})
+        links = child_ids.merge(parent_ids, on='id', how='left')
+        return pd.DataFrame({'child': links['child'].to_numpy(),
+                             'parent': links['parent'].fillna(-1).to_numpy(dtype=np.int64)})
+
+    def parent_rows(self):
+        """parents.csv: the parents grouping more than one child, with 'variant-<id>' SKUs and 'fields.' columns."""
+        parents = self.parents[self.parents['id'].isin(self.grouped_ids)].copy()
+
+        # Create new 'sku' column by combining 'variant.id' and 'variant.sku'
+        parents.loc[:, 'sku'] = 'variant-' + parents['id'].astype(int).astype(str)  
+
+
+        # Drop columns if they exist
+        columns_to_drop = ['variant.sku', 'id', 'variant.product_id']
+        if 'target_enabled' in parents.columns:
+            columns_to_drop.append('target_enabled')
+        parents = parents.drop(columns=[col for col in columns_to_drop if col in parents.columns])
+
+        # Reorder columns to make 'sku' the first column
+        columns = ['sku'] + [col for col in parents.columns if col != 'sku']
+        parents = parents[columns]
+
+        # Rename columns to add 'fields.' prefix, except for 'sku'
+        parents.columns = ['fields.' + col if col != 'sku' else col for col in parents.columns]
+
+        # Add 'options.0' and 'options.1' columns with values 'size' and 'color', respectively
+        parents['options.0'] = 'size'
+        parents['options.1'] = 'color'
+
+        return parents
+
+    def group_skus(self):
+        """group_skus.csv: each child of a grouping parent with the parent's SKU, once per parent row with its id."""
+        grouped = self.children['variant.product_id'].isin(self.grouped_ids).to_numpy()
+        links = self.links[grouped[self.links['child'].to_numpy()]]
+        children = self.children[['variant.sku', 'variant.product_id']].iloc[links['child'].to_numpy()]
+        children.index = links.index
+
+        final_df = pd.DataFrame({'sku': children['variant.sku'],
+                                 'group_skus.0': 'variant-' + children['variant.product_id'].astype(int).astype(str)})
+
+        logging.info(f"Successfully linked {len(final_df)} children to their parents")
+        return final_df
+
+    def filled_children(self):
+        """
+        The children with their missing values filled from their parent row, once per parent row
+        with their id and without the id columns; children without a parent row are dropped.
+        """
+        links = self.links[self.links['parent'].to_numpy() >= 0]
+        children = self.children.iloc[links['child'].to_numpy()].reset_index(drop=True)
+        parents = self.parents.iloc[links['parent'].to_numpy()].reset_index(drop=True)
+
+        # Fill missing values in the children with the corresponding parent values, on all common columns
+        for col in children.columns:
+            if col in parents.columns and col not in ('variant.product_id', 'id'):
+                children[col] = children[col].fillna(parents[col])
+
+        # Drop the 'id' and 'variant.product_id' columns
+        return children.drop(columns=['id', 'variant.product_id'])
+
+
+@instrumented
 def link_parent_child(df):
     logging.info("Linking child rows to parent rows based on 'variant.product_id'")
 
@@ -117,60 +131,36 @@ def link_parent_child(df):
     parents = df[df['id'].notna()]  # Parents have an 'id' but no 'variant.product_id'
 
     # PARENTS STUFF FOR SEPARATE OUTPUT
-    clean_parents(parents, children)
-    final_link(parents.copy(), children.copy())
-    
-    # Perform the merge dynamically on all common columns, except for 'variant.product_id' and 'id'
-    columns_to_merge = list(set(children.columns) & set(parents.columns) - {'variant.product_id', 'id'})
-    children_filled = children.merge(parents[columns_to_merge + ['id']], 
-                                     left_on='variant.product_id', 
-                                     right_on='id', 
-                                     suffixes=('', '_parent'))
-
-    # Fill missing values in the children with the corresponding parent values
-    for col in columns_to_merge:
-        parent_col = col + '_parent'  # The corresponding parent column will have the '_parent' suffix
-        children_filled[col] = children_filled[col].fillna(children_filled[parent_col])
+    graph = ProductGraph(parents, children)
+    parent_rows = graph.parent_rows()
+    group_skus = graph.group_skus()
+    children_filled = graph.filled_children()
 
-    # Drop the extra columns added during the merge (with the '_parent' suffix)
-    children_filled = children_filled.drop(columns=[col + '_parent' for col in columns_to_merge])
-
-    # Drop the 'id' and 'variant.product_id' columns
-    children_filled = children_filled.drop(columns=['id', 'variant.product_id', 'id_parent'])
-
-    # Return the updated children DataFrame with parent values filled in
-    return children_filled
+    # Return the updated children with parent values filled in, plus the parents.csv and group_skus.csv frames
+    return children_filled, parent_rows, group_skus
 
 
 
 
 # Clean NaN or empty string 'variant.sku' and duplicates in 'variant.sku' 
+@instrumented
 def clean_sku_and_barcode(df):
     logging.info("Cleaning 'variant.sku' column")
     df = df[df['variant.sku'].notna() & (df['variant.sku'] != '')]  # Drop empty 'variant.sku'
     duplicated_skus = df['variant.sku'].dropna()[df['variant.sku'].duplicated(keep=False)]
     if not duplicated_skus.empty:
-        logging.error("Duplicates found in 'variant.sku'. Please contact management!")
-        logging.error(f"Duplicated 'variant.sku' values: {duplicated_skus.unique()}")
-        exit(1)
+        raise duplicate_skus_error(duplicated_skus)
 
     # Rename 'variant.sku' to 'sku'
     df = df.rename(columns={'variant.sku': 'sku'})
 
-    # Assuming df is the DataFrame you're working with
-    columns_to_export = [col for col in df.columns if col != 'sku' and col != 'brand' and col != 'description'] 
-    column_string = ','.join(columns_to_export)
-
-    # Write the column names to a text file
-    with open('./output/variant_columns.txt', 'w') as f:
-        f.write(column_string)
-
     # Loop through all columns and rename them, prefixing 'fields.' to all except 'sku'
     df.columns = ['fields.' + col if col != 'sku' else col for col in df.columns]
 
     return df
 
-def select_required_columns(df):
+@instrumented
+def select_required_columns(df, non_empty_columns=None):
     logging.info("Selecting required columns from 'variant.sku', 'brand', 'description', and from 'material' to 'variant.id', along with 'id' and 'variant.product_id'")
 
     # Strip any leading/trailing whitespaces from column names
@@ -186,9 +176,12 @@ def select_required_columns(df):
     # Select the columns
     df = df[columns_to_keep]
 
-    # Remove columns with all NaN or empty values
-    df = df.dropna(axis=1, how='all')  # Drop columns with all NaN values
-    df = df.loc[:, df.notna().any(axis=0)]  # Keep columns with at least one non-NaN value
+    # Remove columns with all NaN or empty values; in streaming mode, the columns with a value anywhere in the file
+    if non_empty_columns is None:
+        df = df.dropna(axis=1, how='all')  # Drop columns with all NaN values
+        df = df.loc[:, df.notna().any(axis=0)]  # Keep columns with at least one non-NaN value
+    else:
+        df = df[[col for col in df.columns if col in non_empty_columns]]
 
     return df
 
@@ -196,27 +189,154 @@ def select_required_columns(df):
 
 
 
-# Main function to run all steps
-def main():
-    logging.info("Starting data processing")
+# Comma-separated attribute names (without 'fields.', 'brand' and 'description') for the *_columns.txt files
+def export_columns(df):
+    columns_to_export = [col[len('fields.'):] for col in df.columns
+                         if col.startswith('fields.') and col not in ('fields.brand', 'fields.description')]
+    return ','.join(columns_to_export)
 
-    # Load the CSV file
-    df = load_file_from_directory(input_directory)
-    
-    # Apply transformations in sequence
+
+# Export columns transform() reads: the names, SKU, brand, description and ids plus 'material' through 'variant.id'
+def input_columns(header):
+    return select_columns(header, ['name', 'variant.name', 'variant.sku', 'brand', 'description', 'id',
+                                   'variant.product_id', 'variant.id'], [('material', 'variant.id')],
+                          stage='parentattributesonvarients')
+
+# Apply all transformations in sequence and return every file this script produces, keyed by file name
+def transform(df):
     df = filter_sample_product(df)
     df = select_required_columns(df)
-    df = link_parent_child(df)
+    df, parents, group_skus = link_parent_child(df)
     df = clean_sku_and_barcode(df)
 
-    # Ensure output directory exists and save the cleaned data
-    if not os.path.exists(output_directory):
-        os.makedirs(output_directory)
-    output_file = os.path.join(output_directory, 'parentattributesonvarients.csv')
-    df.to_csv(output_file, index=False)
+    return {
+        'parent_columns.txt': export_columns(parents),
+        'parents.csv': parents,
+        'group_skus.csv': group_skus,
+        'variant_columns.txt': export_columns(df),
+        'parentattributesonvarients.csv': df,
+    }
+
+
+# Rows filter_sample_product keeps. Before the dtypes are known a chunk can read a name column
+# as numeric (every name in it blank), hence astype(object)
+def kept_rows(chunk):
+    chunk = chunk[~chunk['variant.name'].astype(object).str.contains('Sample product', na=False)]
+    return chunk[chunk['name'] != 'Sample product']
+
+def scan_catalog(input_file, chunksize, usecols=None):
+    """
+    First streaming pass: the read dtypes, the columns with a value anywhere in the kept rows,
+    how many children each parent has and the parent rows themselves. Parents are a small
+    share of an export, so they are the only rows kept in memory.
+    """
+    logging.info("Collecting parent rows and child counts")
+    dtypes = DtypeScan()
+    non_empty_columns = set()
+    child_counts = []
+    parent_chunks = []
+    for chunk in read_chunks(input_file, chunksize, usecols=usecols):
+        dtypes.observe(chunk)
+        chunk = kept_rows(chunk)
+        non_empty_columns.update(chunk.columns[chunk.notna().any(axis=0)].str.strip())
+        parent_chunks.append(chunk[chunk['id'].notna()])
+        child_counts.append(chunk.loc[chunk['variant.product_id'].notna(), 'variant.product_id'].value_counts())
+
+    parent_child_count = pd.concat(child_counts).groupby(level=0).sum()
+    parent_child_count.index = parent_child_count.index.astype(dtypes.dtypes['variant.product_id'])
+
+    if dtypes.mixed:
+        # Some parent values were parsed differently than a whole-file read would; read the parents again
+        logging.info("Re-reading parent rows with the dtypes of the whole file")
+        parent_chunks = [chunk[chunk['id'].notna()]
+                         for chunk in map(filter_sample_product,
+                                           read_chunks(input_file, chunksize, dtypes.dtypes, usecols))]
+    parents = pd.concat(parent_chunks).astype(dtypes.dtypes)
+    return dtypes, non_empty_columns, parents, parent_child_count
+
+def transform_streaming(input_file, output_dir, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Write the same files as transform() to `output_dir`, holding the parent rows in memory but
+    only one chunk of child rows at a time. Returns the number of rows in parentattributesonvarients.csv.
+    """
+    usecols = input_columns(read_header(input_file))
+    dtypes, non_empty_columns, parents, parent_child_count = scan_catalog(input_file, chunksize, usecols)
+    parents = select_required_columns(parents, non_empty_columns)
+
+    # Every child row is repeated once per parent row with its 'variant.product_id', as ProductGraph.filled_children does
+    parent_multiplicity = parents['id'].value_counts()
+    def filled_children(chunk):
+        chunk = kept_rows(chunk)
+        chunk = chunk[chunk['variant.product_id'].notna()]
+        chunk = chunk.loc[chunk.index.repeat(chunk['variant.product_id'].map(parent_multiplicity).fillna(0).astype(int))]
+        return chunk[chunk['variant.sku'].notna() & (chunk['variant.sku'] != '')]
+    check_duplicate_skus(input_file, chunksize, dtypes, kept_rows=filled_children,
+                         key_columns=['name', 'variant.name', 'variant.sku', 'variant.product_id'])
+
+    parent_rows = ProductGraph(parents, None, parent_child_count).parent_rows()
+    parent_rows.to_csv(os.path.join(output_dir, 'parents.csv'), index=False)
+    with open(os.path.join(output_dir, 'parent_columns.txt'), 'w') as f:
+        f.write(export_columns(parent_rows))
+
+    rows = 0
+    for i, chunk in enumerate(read_chunks(input_file, chunksize, dtypes.dtypes, usecols)):
+        df = filter_sample_product(chunk)
+        df = select_required_columns(df, non_empty_columns)
+        children = df[df['variant.product_id'].notna()]
+        graph = ProductGraph(parents, children, parent_child_count)
+        write_chunk(graph.group_skus(), os.path.join(output_dir, 'group_skus.csv'), first=(i == 0))
+        with warnings.catch_warnings():
+            # A text column that is empty in every row of a chunk gets downcast by fillna; it is written blank either way
+            warnings.filterwarnings('ignore', 'Downcasting object dtype arrays', FutureWarning)
+            df = graph.filled_children()
+        df = clean_sku_and_barcode(df)
+        write_chunk(df, os.path.join(output_dir, 'parentattributesonvarients.csv'), first=(i == 0))
+        if i == 0:
+            with open(os.path.join(output_dir, 'variant_columns.txt'), 'w') as f:
+                f.write(export_columns(df))
+        rows += len(df)
+    return rows
+
+
+# Main function to run all steps
+def main(workspace=None, chunksize=None):
+    # Command-line runs name their input and output with --input/--output
+    if workspace is None:
+        parser = add_workspace_arguments(argparse.ArgumentParser(
+            description="Build parents.csv, group_skus.csv and parentattributesonvarients.csv from a catalog export"))
+        parser.add_argument('--chunksize', type=int,
+                            help=f"Stream the child rows this many at a time (e.g. {DEFAULT_CHUNKSIZE}) "
+                                 "instead of loading the whole export")
+        args = parser.parse_args()
+        workspace = Workspace.from_args(args)
+        chunksize = args.chunksize
+    logging.info("Starting data processing")
+
+    workspace.ensure_output_dir()
+    if chunksize:
+        transform_streaming(workspace.input_file, workspace.output_dir, chunksize)
+    else:
+        # Load the CSV file
+        df = load_catalog(workspace.input_file, input_columns(read_header(workspace.input_file)))
+
+        # Apply transformations in sequence
+        outputs = transform(df)
+
+        # Save every output
+        for file_name, data in outputs.items():
+            if isinstance(data, str):
+                with open(workspace.output_path(file_name), 'w') as f:
+                    f.write(data)
+            else:
+                write_output(workspace, file_name, data)
     
-    logging.info(f"Successfully filtered the data! The selected data is saved to {output_file}")
+    logging.info(f"Successfully filtered the data! The selected data is saved to {workspace.output_dir}")
 
 # Run the main function
 if __name__ == "__main__":
-    main()
+    enable_copy_on_write()
+    try:
+        main()
+    except (ValidationError, MissingColumnError) as e:
+        logging.error(str(e))
+        exit(1)
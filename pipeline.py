@@ -0,0 +1,274 @@
+import time
+import argparse
+import logging
+
+from catalog_loader import (MissingColumnError, catalog_cache, current_rss_bytes, enable_copy_on_write, format_parse_stats, load_catalog,
+                            read_header)
+import addvariants
+import parentattributesonvarients
+import variantattributes
+import target_pts
+import MikesWay
+from workspace import Workspace, add_workspace_arguments
+from intermediates import save_intermediate
+import delta
+import instrumentation
+import profiling
+import validation
+
+# Set up logging configuration
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+class PipelineError(Exception):
+    """Raised when a pipeline stage fails; `stage` names the stage that failed."""
+
+    def __init__(self, stage, message):
+        super().__init__(message)
+        self.stage = stage
+
+
+# Each stage takes a read-only view of the parsed input, the outputs produced so far and the run options,
+# and returns its own outputs keyed by file name
+def run_addvariants(df, outputs, options):
+    return {'addvariants.csv': addvariants.transform(df, options.get('max_alternate_images'))}
+
+def run_parentattributesonvarients(df, outputs, options):
+    return parentattributesonvarients.transform(df)
+
+def run_variantattributes(df, outputs, options):
+    return {'variantattributes.csv': variantattributes.transform(df)}
+
+def run_target_pts(df, outputs, options):
+    return {'target_pts.csv': target_pts.build_target_pts(outputs['parents.csv'],
+                                                          outputs['parentattributesonvarients.csv'])}
+
+def run_mikes_way(df, outputs, options):
+    return {'MikesWay.csv': MikesWay.build_mikes_way(outputs['group_skus.csv'],
+                                                     outputs['parentattributesonvarients.csv'],
+                                                     outputs['parents.csv'],
+                                                     outputs['variantattributes.csv'],
+                                                     df,
+                                                     outputs.get('addvariants.csv'),
+                                                     options.get('max_alternate_images'))}
+
+# Stages in the order /upload used to run the scripts
+STAGES = [
+    ('addvariants', run_addvariants),
+    ('parentattributesonvarients', run_parentattributesonvarients),
+    ('variantattributes', run_variantattributes),
+    ('target_pts', run_target_pts),
+]
+
+
+# The input columns any stage of this run reads, in file order; the rest of the export is never parsed
+def catalog_columns(input_file, use_mikes_way=False):
+    header = read_header(input_file)
+    modules = [validation, addvariants, parentattributesonvarients, variantattributes]
+    if use_mikes_way:
+        modules.append(MikesWay)
+    needed = set()
+    for module in modules:
+        needed.update(module.input_columns(header))
+    return [column for column in header if column in needed]
+
+
+# Write every output to the workspace's output directory; text outputs (the *_columns.txt files) are written
+# as-is. With `keep_intermediates` the frames later stages read also get their Parquet copy (intermediates.py)
+def write_outputs(outputs, workspace, keep_intermediates=False):
+    workspace.ensure_output_dir()
+    for file_name, data in outputs.items():
+        output_file = workspace.output_path(file_name)
+        if isinstance(data, str):
+            with open(output_file, 'w') as f:
+                f.write(data)
+        else:
+            with instrumentation.step(f'write {file_name}', len(data)) as record:
+                data.to_csv(output_file, index=False)
+                record['rows_out'] = len(data)
+            if keep_intermediates:
+                save_intermediate(workspace, file_name, data)
+
+
+# Process memory around a stage, e.g. 'RSS 412.3 MB -> 455.0 MB'; empty where it isn't reported
+def format_rss_change(before, after):
+    if before is None or after is None:
+        return ''
+    return f"RSS {before / 1024 ** 2:.1f} MB -> {after / 1024 ** 2:.1f} MB"
+
+
+# Record a progress event for listeners such as the upload page: a plain dict appended to `events` (a list,
+# or a list proxy shared with the process that serves the page). Stage events carry the stage name and,
+# once finished, rows in and out, seconds and throughput
+def emit(events, event, stage=None, **fields):
+    if events is not None:
+        events.append({'event': event, 'stage': stage, 'time': time.time(), **fields})
+
+
+# Rows in a stage's outputs; text outputs don't count
+def output_rows(outputs):
+    return sum(len(data) for data in outputs.values() if not isinstance(data, str))
+
+
+def emit_finished(events, stage, rows_in, rows_out, seconds):
+    emit(events, 'stage_finished', stage, rows_in=rows_in, rows_out=rows_out, seconds=seconds,
+         rows_per_second=rows_in / seconds if seconds > 0 else None)
+
+
+# The steps instrumentation recorded, into the job log and as 'step' events
+def report_steps(steps, log_messages, events):
+    for record in steps:
+        log_messages.append(f"  {instrumentation.format_step(record)}")
+        emit(events, 'step', record['step'], **{key: value for key, value in record.items() if key != 'step'})
+
+
+def run_stage(name, func, df, outputs, options, log_messages, events=None):
+    log_messages.append(f"Running {name}...")
+    emit(events, 'stage_started', name, rows_in=len(df))
+    rss_before = current_rss_bytes()
+    start = time.perf_counter()
+    try:
+        with instrumentation.collect() as steps:
+            result = func(df, outputs, options)
+    except validation.ValidationError as e:
+        emit(events, 'stage_failed', name, seconds=time.perf_counter() - start, error=str(e))
+        raise PipelineError(name, str(e)) from e
+    except SystemExit:
+        # Data errors raise validation.ValidationError; an exit() call still mustn't take down the worker
+        emit(events, 'stage_failed', name, seconds=time.perf_counter() - start)
+        raise PipelineError(name, f"{name} stopped on invalid data. Check server logs for details.")
+    except Exception as e:
+        logging.exception(f"Error in {name}")
+        emit(events, 'stage_failed', name, seconds=time.perf_counter() - start, error=str(e))
+        raise PipelineError(name, str(e)) from e
+    log_messages.append(f"✓ {name} completed successfully.")
+    report_steps(steps, log_messages, events)
+    emit_finished(events, name, len(df), output_rows(result), time.perf_counter() - start)
+    memory = format_rss_change(rss_before, current_rss_bytes())
+    if memory:
+        logging.info(f"{name} memory: {memory}")
+    return result
+
+
+def validate_catalog(df, workspace, log_messages, events=None):
+    """
+    Run validation.validate() on the parsed input and list its warnings in the log. Errors stop
+    the run here, before any stage, with every error in the PipelineError and the report written
+    to the workspace's validation.REPORT_FILE. Otherwise returns the report as that file's text.
+    """
+    emit(events, 'stage_started', 'validation', rows_in=len(df))
+    start = time.perf_counter()
+    report = validation.validate(df)
+    log_messages.extend(report.format_lines('warning'))
+    emit(events, 'validation', 'validation', errors=len(report.errors), warnings=len(report.warnings),
+         checks=sorted({issue['check'] for issue in report.issues}))
+    if report.errors:
+        workspace.ensure_output_dir()
+        with open(workspace.output_path(validation.REPORT_FILE), 'w') as f:
+            f.write(report.to_json())
+        emit(events, 'stage_failed', 'validation', seconds=time.perf_counter() - start)
+        raise PipelineError('validation', "Invalid catalog data, no stage was run:\n" +
+                            str(validation.ValidationError(report)))
+    log_messages.append(f"✓ Validated {len(df)} rows ({len(report.warnings)} warnings).")
+    emit_finished(events, 'validation', len(df), len(df), time.perf_counter() - start)
+    return report.to_json()
+
+
+def run_pipeline(workspace, use_mikes_way=False, log_messages=None, max_alternate_images=None,
+                 keep_intermediates=False, delta_state=None, events=None):
+    """
+    Run every stage in-process on a single parsed copy of the workspace's input file and
+    write the outputs to its output directory. Returns the outputs keyed by file name.
+
+    `max_alternate_images` caps the number of images.default.N.alternate.url columns.
+    The stages hand each other frames in memory; `keep_intermediates` also saves Parquet
+    copies for the standalone scripts that read these outputs afterwards.
+    With `delta_state`, a directory kept between runs of the same catalog, only the rows that
+    changed since the previous run are written (delta.write_delta) and no Parquet copies are kept.
+    The parsed input is validated first (validate_catalog()); invalid data fails the run before
+    any stage and the report is written as validation.REPORT_FILE with the outputs.
+    Progress events (see emit()) are appended to `events` as the run goes.
+    """
+    if log_messages is None:
+        log_messages = []
+    options = {'use_mikes_way': use_mikes_way, 'max_alternate_images': max_alternate_images}
+    input_file = workspace.input_file
+
+    logging.info(f"Starting pipeline for {input_file}")
+    stage_names = ['parse', 'validation'] + [name for name, func in STAGES] + (["Mike's Way processing"] if use_mikes_way else [])
+    emit(events, 'pipeline_started', stages=stage_names + ['write'])
+    emit(events, 'stage_started', 'parse')
+    start = time.perf_counter()
+    try:
+        columns = catalog_columns(input_file, use_mikes_way)
+    except MissingColumnError as e:
+        emit(events, 'stage_failed', 'parse', seconds=time.perf_counter() - start, error=str(e))
+        raise PipelineError('parse', str(e)) from e
+    rows = len(load_catalog(input_file, columns))
+    emit_finished(events, 'parse', rows, rows, time.perf_counter() - start)
+    log_messages.append(f"Parsed input: {format_parse_stats(catalog_cache.stats(input_file))}")
+
+    try:
+        # Invalid data fails the run before any stage; the report goes with the outputs
+        outputs = {validation.REPORT_FILE: validate_catalog(load_catalog(input_file, columns), workspace,
+                                                                log_messages, events)}
+        for name, func in STAGES:
+            outputs.update(run_stage(name, func, load_catalog(input_file, columns), outputs, options, log_messages,
+                                     events))
+
+        # Mike's Way failures are reported but don't fail the run, as before
+        if use_mikes_way:
+            try:
+                outputs.update(run_stage("Mike's Way processing", run_mikes_way, load_catalog(input_file, columns),
+                                         outputs, options, log_messages, events))
+            except PipelineError as e:
+                log_messages.append(f"✗ Error in Mike's Way processing: {e}")
+    finally:
+        # The parsed input is only needed while this run is going
+        catalog_cache.evict(input_file)
+
+    log_messages.append("Writing outputs...")
+    emit(events, 'stage_started', 'write', rows_in=output_rows(outputs))
+    start = time.perf_counter()
+    with instrumentation.collect() as steps:
+        if delta_state is not None:
+            delta.write_delta(outputs, workspace, delta_state, log_messages)
+        else:
+            write_outputs(outputs, workspace, keep_intermediates)
+    report_steps(steps, log_messages, events)
+    emit_finished(events, 'write', output_rows(outputs), output_rows(outputs), time.perf_counter() - start)
+    logging.info(f"Pipeline finished, outputs saved to {workspace.output_dir}")
+    return outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run every migration stage in a single process")
+    add_workspace_arguments(parser)
+    parser.add_argument('--mikes-way', action='store_true', help="Also build MikesWay.csv")
+    parser.add_argument('--max-alternate-images', type=int, help="Keep at most this many alternate image columns")
+    parser.add_argument('--delta-state', help="Directory remembering this catalog's last run; only changed rows are written")
+    parser.add_argument('--profile', action='store_true',
+                        help=f"Profile the run and save {profiling.PROFILE_STATS_FILE} and {profiling.PROFILE_STACKS_FILE} with the outputs")
+    args = parser.parse_args()
+
+    enable_copy_on_write()
+    workspace = Workspace.from_args(args)
+
+    log_messages = []
+    try:
+        if args.profile:
+            profiling.run_profiled(workspace.output_dir, log_messages, run_pipeline, workspace, args.mikes_way,
+                                   log_messages, args.max_alternate_images, keep_intermediates=True,
+                                   delta_state=args.delta_state)
+        else:
+            run_pipeline(workspace, args.mikes_way, log_messages, args.max_alternate_images, keep_intermediates=True,
+                         delta_state=args.delta_state)
+    except PipelineError as e:
+        log_messages.append(f"✗ Error in {e.stage}: {e}")
+        print('\n'.join(log_messages))
+        exit(1)
+    print('\n'.join(log_messages))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+import io
+import os
+import sys
+import time
+import pstats
+import cProfile
+import logging
+import threading
+from collections import Counter
+
+# Files a profiled run adds to its output directory: cProfile statistics (for pstats, snakeviz...) and
+# sampled call stacks in the collapsed format flamegraph.pl, speedscope and inferno read
+PROFILE_STATS_FILE = 'profile.pstats'
+PROFILE_STACKS_FILE = 'profile.collapsed'
+
+# Seconds between stack samples
+SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL', 0.005))
+
+# Functions listed in the job log, by cumulative time
+LOG_TOP_FUNCTIONS = 10
+
+# One profiled run at a time per process: from Python 3.12 a second cProfile can't be enabled while
+# another is active, so concurrent profiled jobs on worker threads wait for each other instead
+_profile_lock = threading.Lock()
+
+
+# 'module.qualified_name' of a frame's function; module-level code is 'module.<module>'
+def _frame_name(frame):
+    return f"{frame.f_globals.get('__name__', '?')}.{frame.f_code.co_qualname}"
+
+
+class StackSampler(threading.Thread):
+    """
+    Samples the call stack of thread `thread_id` every `interval` seconds, from just below
+    `base_frame` down. Each sample is weighted by the microseconds since the previous one, so
+    time spent in C code that holds the GIL still goes to the stack that was running it.
+    """
+
+    def __init__(self, thread_id, base_frame, interval=SAMPLE_INTERVAL):
+        super().__init__(name='profile-sampler', daemon=True)
+        self.thread_id = thread_id
+        self.base_frame = base_frame
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        last = time.perf_counter()
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            now = time.perf_counter()
+            names = []
+            while frame is not None and frame is not self.base_frame:
+                names.append(_frame_name(frame))
+                frame = frame.f_back
+            if names:
+                self.stacks[';'.join(reversed(names))] += int((now - last) * 1_000_000)
+                self.samples += 1
+            last = now
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            for stack, microseconds in sorted(self.stacks.items()):
+                f.write(f"{stack} {microseconds}\n")
+
+
+# The `count` functions with the most cumulative time, as pstats prints them
+def top_functions(profiler, count=LOG_TOP_FUNCTIONS):
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.strip_dirs().sort_stats('cumulative').print_stats(count)
+    lines = stream.getvalue().splitlines()
+    # Keep the table only, from its 'ncalls tottime ...' header on
+    header = next((i for i, line in enumerate(lines) if line.lstrip().startswith('ncalls')), 0)
+    return [line for line in lines[header:] if line.strip()]
+
+
+def run_profiled(output_dir, log_messages, func, *args, **kwargs):
+    """
+    Call func(*args, **kwargs) under cProfile and the stack sampler, then write PROFILE_STATS_FILE
+    and PROFILE_STACKS_FILE to `output_dir` and list the slowest functions in `log_messages`.
+    The profile is written even when the call fails; its exception is re-raised afterwards.
+    Runs wait for any other profiled run of this process to finish first.
+    """
+    if not _profile_lock.acquire(blocking=False):
+        log_messages.append("Waiting for another profiled run to finish...")
+        _profile_lock.acquire()
+    try:
+        return _run_profiled(output_dir, log_messages, func, *args, **kwargs)
+    finally:
+        _profile_lock.release()
+
+
+def _run_profiled(output_dir, log_messages, func, *args, **kwargs):
+    profiler = cProfile.Profile()
+    sampler = StackSampler(threading.get_ident(), sys._getframe())
+    sampler.start()
+    start = time.perf_counter()
+    profiler.enable()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profiler.disable()
+        sampler.stop()
+        seconds = time.perf_counter() - start
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        profiler.dump_stats(os.path.join(output_dir, PROFILE_STATS_FILE))
+        sampler.write(os.path.join(output_dir, PROFILE_STACKS_FILE))
+        log_messages.append(f"Profiled run: {seconds:.2f}s, {sampler.samples} stack samples. "
+                            f"Saved {PROFILE_STATS_FILE} and {PROFILE_STACKS_FILE}; slowest functions (cumulative):")
+        log_messages.extend(f"  {line}" for line in top_functions(profiler))
+        logging.info(f"Saved profile to {output_dir}")
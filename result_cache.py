@@ -0,0 +1,126 @@
+import os
+import json
+import uuid
+import shutil
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+# Cached outputs live here, one directory per input hash + options
+cache_directory = './cache/'
+
+# Bump when a change to the stages would make earlier cached outputs wrong
+CACHE_VERSION = 2
+
+
+def directory_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            total += os.path.getsize(os.path.join(root, file))
+    return total
+
+
+# Hardlink when possible so hits don't copy the outputs; entries are never modified in place
+def link_or_copy(src, dst):
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+class ResultCache:
+    """
+    Pipeline outputs keyed by the SHA-256 of the uploaded file plus the run options, kept on
+    disk under `root` and evicted least-recently-used first once they take more than
+    `max_bytes`. Counts hits and misses for stats().
+    """
+
+    def __init__(self, root=cache_directory, max_bytes=1024 ** 3):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # key -> size in bytes, least recently used first
+        self._entries = OrderedDict()
+        if not os.path.exists(root):
+            os.makedirs(root)
+        self._load_index()
+
+    def _load_index(self):
+        entries = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.startswith('tmp-'):
+                # Left over from a put() that didn't finish
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.isdir(path):
+                entries.append((os.path.getmtime(path), name, directory_size(path)))
+        for mtime, key, size in sorted(entries):
+            self._entries[key] = size
+
+    def key(self, input_file, options):
+        digest = hashlib.sha256()
+        with open(input_file, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        digest.update(json.dumps({'version': CACHE_VERSION, 'options': options}, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def get(self, key, output_dir):
+        """Copy the cached outputs for `key` into `output_dir`; returns False on a miss."""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return False
+            self._entries.move_to_end(key)
+            self.hits += 1
+            entry = os.path.join(self.root, key)
+            os.utime(entry)
+            if not os.path.exists(output_dir):
+                os.makedirs(output_dir)
+            for name in os.listdir(entry):
+                link_or_copy(os.path.join(entry, name), os.path.join(output_dir, name))
+        return True
+
+    def put(self, key, output_dir):
+        """Store a finished run's outputs under `key`, then evict old entries to stay under max_bytes."""
+        size = directory_size(output_dir)
+        if size > self.max_bytes:
+            logging.info(f"Not caching {key[:12]}: {size} bytes is more than the cache holds")
+            return
+        # Fill a temporary directory first so a half-written entry is never served
+        staging = os.path.join(self.root, f'tmp-{uuid.uuid4().hex}')
+        os.makedirs(staging)
+        for name in os.listdir(output_dir):
+            link_or_copy(os.path.join(output_dir, name), os.path.join(staging, name))
+
+        with self._lock:
+            entry = os.path.join(self.root, key)
+            if key in self._entries:
+                shutil.rmtree(staging, ignore_errors=True)
+                return
+            os.rename(staging, entry)
+            self._entries[key] = size
+            expired = []
+            while sum(self._entries.values()) > self.max_bytes:
+                expired.append(self._entries.popitem(last=False)[0])
+        for old_key in expired:
+            shutil.rmtree(os.path.join(self.root, old_key), ignore_errors=True)
+            logging.info(f"Evicted cached results {old_key[:12]}")
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+                'entries': len(self._entries),
+                'bytes': sum(self._entries.values()),
+                'max_bytes': self.max_bytes,
+            }
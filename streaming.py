@@ -0,0 +1,120 @@
+import logging
+import numpy as np
+import pandas as pd
+
+from validation import duplicate_skus_error
+
+# Rows per chunk when a catalog is streamed instead of loaded whole
+DEFAULT_CHUNKSIZE = 100_000
+
+
+def read_chunks(path, chunksize=DEFAULT_CHUNKSIZE, dtype=None, usecols=None):
+    if dtype is not None and usecols is not None:
+        dtype = {column: dtype[column] for column in usecols}
+    return pd.read_csv(path, chunksize=chunksize, dtype=dtype, usecols=usecols)
+
+
+# The dtype one read_csv call infers for a column whose chunks came back as `a` and `b`
+def promote_dtype(a, b):
+    if a == b:
+        return a
+    if a.kind in 'iuf' and b.kind in 'iuf':
+        return np.dtype('float64')
+    return np.dtype(object)
+
+
+class DtypeScan:
+    """
+    Work out, chunk by chunk, the dtypes read_csv infers when it reads the whole file at once.
+    A chunk without blanks comes back int64 where the whole file is float64, or numeric where
+    it is text; reading every chunk with these dtypes makes each one parse like the full file.
+    """
+
+    def __init__(self):
+        self.dtypes = {}
+        # Dtypes of each column in the chunks where it has a value
+        self._seen = {}
+
+    def observe(self, chunk):
+        has_values = chunk.notna().any(axis=0)
+        for column, dtype in chunk.dtypes.items():
+            previous = self.dtypes.get(column)
+            self.dtypes[column] = dtype if previous is None else promote_dtype(previous, dtype)
+            if has_values[column]:
+                self._seen.setdefault(column, set()).add(dtype)
+
+    @property
+    def mixed(self):
+        """Columns whose values were parsed differently in some chunk than the whole file parses them."""
+        return {column for column, seen in self._seen.items() if seen != {self.dtypes[column]}}
+
+
+class HashedValues:
+    """
+    Compact record of a column's values for duplicate checks across a file read in chunks:
+    a 64-bit hash of each value's text (8 bytes per row) instead of the values themselves.
+    """
+
+    def __init__(self):
+        self._hashes = []
+
+    def add(self, values):
+        self._hashes.append(hash_values(values))
+
+    def duplicate_hashes(self):
+        if not self._hashes:
+            return np.empty(0, dtype=np.uint64)
+        hashes = np.sort(np.concatenate(self._hashes))
+        return np.unique(hashes[1:][hashes[1:] == hashes[:-1]])
+
+
+def hash_values(values):
+    return pd.util.hash_array(values.astype(str).to_numpy(dtype=object))
+
+
+def confirm_duplicates(chunks, duplicate_hashes):
+    """
+    Second pass of a HashedValues check: from the same values again (`chunks` yields one Series
+    per chunk), return the ones that really occur more than once, in order of first appearance.
+    Hash collisions are ruled out here, and only values with a repeated hash are kept in memory.
+    """
+    candidates = [values[np.isin(hash_values(values), duplicate_hashes)] for values in chunks]
+    candidates = pd.concat(candidates) if candidates else pd.Series(dtype=object)
+    candidates = candidates.astype(str)
+    return candidates[candidates.duplicated(keep=False)].unique()
+
+
+# Rows the variant stages keep: no sample products and a non-empty 'variant.sku'. Before the dtypes are
+# known a chunk can read 'variant.name' as numeric (every name in it blank), hence astype(object)
+def kept_variant_rows(chunk):
+    chunk = chunk[~chunk['variant.name'].astype(object).str.contains('Sample product', na=False)]
+    return chunk[chunk['variant.sku'].notna() & (chunk['variant.sku'] != '')]
+
+
+def check_duplicate_skus(input_file, chunksize, dtype_scan, skus=None, kept_rows=kept_variant_rows,
+                         key_columns=('variant.name', 'variant.sku')):
+    """
+    Fail like clean_sku_and_barcode (validation.ValidationError) when a 'variant.sku' occurs twice in the rows
+    `kept_rows` keeps, given the file's DtypeScan. `skus` are the HashedValues of those SKUs
+    from a first pass; without them the SKUs are hashed in a pass over `key_columns`.
+    """
+    key_columns = list(key_columns)
+    # SKUs read as numbers in some chunks and text in others hash differently than in a whole-file
+    # read; hash them again as the whole file reads them
+    if skus is None or dtype_scan.mixed.intersection(key_columns):
+        skus = HashedValues()
+        for chunk in read_chunks(input_file, chunksize, dtype_scan.dtypes, key_columns):
+            skus.add(kept_rows(chunk)['variant.sku'])
+
+    duplicate_hashes = skus.duplicate_hashes()
+    if len(duplicate_hashes):
+        duplicated_skus = confirm_duplicates((kept_rows(chunk)['variant.sku'] for chunk in
+                                              read_chunks(input_file, chunksize, dtype_scan.dtypes, key_columns)),
+                                             duplicate_hashes)
+        if len(duplicated_skus):
+            raise duplicate_skus_error(duplicated_skus)
+
+
+# Write a frame to `output_file`, replacing the file for the first chunk and appending after that
+def write_chunk(df, output_file, first):
+    df.to_csv(output_file, index=False, mode='w' if first else 'a', header=first)
@@ -0,0 +1,181 @@
+import time
+import argparse
+import logging
+import numpy as np
+import pandas as pd
+
+# Set up logging configuration
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Product-level columns of a catalog export, then its attribute columns (names from a real export), then
+# the variant columns. 85 in all, in the order the stages expect: the attributes run from 'material' up
+# to 'variant.id', and variantattributes keeps everything from 'variant.package_height' on
+PRODUCT_COLUMNS = ['id', 'name', 'description', 'brand', 'status', 'target_enabled', 'material']
+ATTRIBUTE_COLUMNS = [
+    'pattern', 'bullet_1', 'bullet_2', 'bullet_3', 'bullet_4', 'bullet_5', 'country_of_origin',
+    'cpsc_choking_hazard_warnings', 'care_and_cleaning', 'gender', 'piece_1_apparel_material_1', 'piece_1_pattern',
+    'piece_1_pattern_group', 'piece_2_apparel_material_1', 'piece_2_pattern', 'piece_2_pattern_group',
+    'targeted_audience', 'apparel_and_accessories_subtype', 'number_of_pieces', 'bag_linear_inches',
+    'number_of_wheels', 'protective_qualities', 'pattern_group', 'warranty_description', 'bag_structure',
+    'primary_item_placement', 'maximum_weight_capacity', 'health_and_beauty_subtype', 'trial_or_travel_size',
+    'fabric_weight_type', 'theme', 'material_textiles_1', 'material_textiles_percentage_1',
+    'textile_dry_recommendation', 'textile_wash_recommendation', 'textile_construction', 'thread_count',
+    'exterior_features', 'import_description', 'prop_65', 'closure_type', 'closure_style_main_compartment',
+    'handle_type', 'material_handle', 'material_shell', 'shape', 'construction_method', 'package_quantity',
+    'product_thickness', 'indoor_outdoor_use', 'color_tone', 'garment_neckline_type', 'garment_sleeve_length_type',
+    'size_grouping', 'garment_fit', 'garment_collar_type', 'target_posting_template', 'target_listing_action',
+]
+VARIANT_COLUMNS = [
+    'variant.id', 'variant.product_id', 'variant.name', 'variant.sku', 'variant.barcode', 'variant.price',
+    'variant.compare_price', 'variant.images', 'variant.weight', 'variant.height', 'variant.width', 'variant.length',
+    'variant.package_height', 'variant.package_width', 'variant.package_length', 'variant.package_weight',
+    'variant.size', 'variant.color', 'variant.target_listing_action', 'variant.empty',
+]
+COLUMNS = PRODUCT_COLUMNS + ATTRIBUTE_COLUMNS + VARIANT_COLUMNS
+
+SIZES = np.array(['XS', 'S', 'M', 'L', 'XL', '2XL'], dtype=object)
+BRANDS = np.array(['Acme', 'Pardon My Fro', 'Vapor Apparel', 'Northwind', 'Zed & Co'], dtype=object)
+
+# Parents generated at a time; each block has its own random stream, so the output only depends on the arguments
+BLOCK_PARENTS = 50_000
+
+
+# `values` as text, empty where `keep` is False
+def _text(values, keep=None):
+    text = pd.Series(values).astype(str).to_numpy(dtype=object, copy=True)
+    if keep is not None:
+        text[~keep] = ''
+    return text
+
+
+# `cardinality` distinct values of a column, picked at random for `n` rows
+def _values(rng, name, cardinality, n):
+    labels = np.array([f'{name} {i}' for i in range(cardinality)], dtype=object)
+    return labels[rng.integers(0, cardinality, n)]
+
+
+# Prices in cents as '12.50'-style text
+def _price_text(cents):
+    cents = pd.Series(cents)
+    return ((cents // 100).astype(str) + '.' + (cents % 100).astype(str).str.zfill(2)).to_numpy(dtype=object)
+
+
+def _image_urls(skus, counts, max_images):
+    """Comma-separated image URLs, `counts[i]` of them for row i."""
+    base = 'https://images.example.com/' + pd.Series(skus, dtype=object)
+    urls = pd.Series('', index=base.index, dtype=object)
+    for i in range(max_images):
+        url = base + f'/{i}.jpg'
+        urls = urls.mask(counts > i, urls + ',' + url if i else url)
+    return urls.to_numpy(dtype=object)
+
+
+def _block(rng, first_parent, first_variant, counts, images, cardinality, fill):
+    """
+    One block of an export: each parent row followed by its `counts` variant rows. Parent ids
+    start at `first_parent`, variant ids (and SKUs) at `first_variant`.
+    """
+    n_parents, n_variants = len(counts), int(counts.sum())
+    n_rows = n_parents + n_variants
+    parent_rows = np.arange(n_parents) + np.concatenate([[0], np.cumsum(counts)[:-1]])
+    is_variant = np.ones(n_rows, dtype=bool)
+    is_variant[parent_rows] = False
+    variant_rows = np.flatnonzero(is_variant)
+
+    columns = {column: np.full(n_rows, '', dtype=object) for column in COLUMNS}
+
+    def put(column, rows, values):
+        columns[column][rows] = values
+
+    parent_ids = np.arange(first_parent, first_parent + n_parents)
+    put('id', parent_rows, _text(parent_ids))
+    names = 'Product ' + pd.Series(_text(parent_ids))
+    put('name', parent_rows, names.to_numpy(dtype=object))
+    put('description', parent_rows, (names + ', "soft" and\nmachine washable').to_numpy(dtype=object))
+    put('brand', parent_rows, BRANDS[rng.integers(0, len(BRANDS), n_parents)])
+    put('status', parent_rows, 'active')
+    put('target_enabled', parent_rows, 'true')
+    put('material', parent_rows, _values(rng, 'material', cardinality, n_parents))
+    for column in ATTRIBUTE_COLUMNS:
+        put(column, parent_rows, np.where(rng.random(n_parents) < fill, _values(rng, column, cardinality, n_parents), ''))
+
+    # Variants, with their parent's id and name
+    parent_of = np.repeat(np.arange(n_parents), counts)
+    variant_ids = np.arange(first_variant, first_variant + n_variants)
+    skus = 'SKU' + pd.Series(variant_ids).astype(str)
+    sizes = SIZES[rng.integers(0, len(SIZES), n_variants)]
+    put('variant.id', variant_rows, _text(variant_ids))
+    put('variant.product_id', variant_rows, _text(parent_ids[parent_of]))
+    put('variant.name', variant_rows, (names.to_numpy(dtype=object)[parent_of] + ' - ' + sizes))
+    put('variant.sku', variant_rows, skus.to_numpy(dtype=object))
+    put('variant.barcode', variant_rows, _text(10 ** 11 + variant_ids, rng.random(n_variants) < 0.9))
+    cents = rng.integers(199, 19_999, n_variants)
+    put('variant.price', variant_rows, _price_text(cents))
+    put('variant.compare_price', variant_rows,
+        np.where(rng.random(n_variants) < 0.5, _price_text(cents * 6 // 5), ''))
+    put('variant.images', variant_rows, _image_urls(skus, rng.integers(0, images + 1, n_variants), images))
+    put('variant.weight', variant_rows, _text(rng.integers(1, 50, n_variants) / 10))
+    for column in ('variant.package_height', 'variant.package_width', 'variant.package_length', 'variant.package_weight'):
+        put(column, variant_rows, _text(rng.integers(1, 30, n_variants), rng.random(n_variants) < 0.6))
+    put('variant.size', variant_rows, sizes)
+    put('variant.color', variant_rows, _values(rng, 'color', cardinality, n_variants))
+    put('variant.target_listing_action', variant_rows, 'list')
+    # A few variants override their parent's material
+    put('material', variant_rows, np.where(rng.random(n_variants) < 0.1, 'material override', ''))
+    return pd.DataFrame(columns, columns=COLUMNS)
+
+
+def generate_catalog(path, variants, variants_per_parent=3.0, images=4, cardinality=20, fill=0.3, seed=0):
+    """
+    Write a synthetic catalog export to `path` and return its row counts and the seconds taken.
+    - `variants` variant rows, under parents with 1 + Poisson(`variants_per_parent` - 1) variants each
+      (1.0 gives products with a single variant only, none of which are grouped).
+    - Each variant has 0 to `images` image URLs.
+    - Attribute, material and color columns take `cardinality` distinct values. A parent has a
+      value in a given attribute column with probability `fill`.
+    The same arguments always produce the same file.
+    """
+    if variants_per_parent < 1:
+        raise ValueError("variants_per_parent must be at least 1")
+    start = time.perf_counter()
+    parents = written = 0
+    block = 0
+    with open(path, 'w', newline='') as f:
+        while written < variants or block == 0:
+            rng = np.random.default_rng([seed, block])
+            counts = 1 + rng.poisson(variants_per_parent - 1, BLOCK_PARENTS)
+            # The last block stops at exactly `variants` variants
+            total = np.cumsum(counts)
+            if total[-1] >= variants - written:
+                last = int(np.searchsorted(total, variants - written))
+                counts = counts[:last + 1]
+                counts[-1] -= total[last] - (variants - written)
+                counts = counts[counts > 0]
+            frame = _block(rng, parents + 1, 10_000 + written, counts, images, cardinality, fill)
+            frame.to_csv(f, header=block == 0, index=False)
+            parents += len(counts)
+            written += int(counts.sum())
+            block += 1
+
+    stats = {'path': path, 'rows': parents + written, 'parents': parents, 'variants': written,
+             'columns': len(COLUMNS), 'seconds': time.perf_counter() - start}
+    logging.info(f"Generated {path}: {stats['rows']} rows ({parents} parents, {written} variants) in {stats['seconds']:.2f}s")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a deterministic synthetic catalog export for benchmarks")
+    parser.add_argument('output', help="CSV file to write")
+    parser.add_argument('--variants', type=int, default=100_000, help="Number of variant rows")
+    parser.add_argument('--variants-per-parent', type=float, default=3.0, help="Mean variants per parent (at least 1)")
+    parser.add_argument('--images', type=int, default=4, help="Most image URLs on a variant")
+    parser.add_argument('--cardinality', type=int, default=20, help="Distinct values per attribute column")
+    parser.add_argument('--fill', type=float, default=0.3, help="Share of parent attribute cells with a value")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    generate_catalog(args.output, args.variants, args.variants_per_parent, args.images, args.cardinality, args.fill,
+                     args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,49 +3,39 @@ import os
 import pandas as pd
 import logging
 
-# Set input and output directories
-input_directory = './input/'
-output_directory = './output/'
+from workspace import parse_workspace
+from intermediates import read_output
+from instrumentation import instrumented
 
 # Set up logging configuration
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def main():
-    logging.info("Starting target PTS data extraction")
-    
-    # Check if output files exist
-    parents_file = os.path.join(output_directory, 'parents.csv')
-    variants_file = os.path.join(output_directory, 'parentattributesonvarients.csv')
-    
-    if not os.path.exists(parents_file) or not os.path.exists(variants_file):
-        logging.error("Required input files missing. Please run parentattributesonvarients.py first.")
-        return
-    
-    # Load the CSV files
-    try:
-        parents_df = pd.read_csv(parents_file)
-        variants_df = pd.read_csv(variants_file)
-        
-        logging.info(f"Loaded {len(parents_df)} parent records and {len(variants_df)} variant records")
-    except Exception as e:
-        logging.error(f"Error loading CSV files: {str(e)}")
-        return
-    
-    # Initialize the target dataframe with columns we need
-    target_cols = ['sku', 'fields.target_posting_template', 'fields.target_listing_action']
-    target_df = pd.DataFrame(columns=target_cols)
+# The columns target_pts.csv is built from
+TARGET_COLUMNS = ['sku', 'fields.target_posting_template', 'fields.target_listing_action']
+
+@instrumented
+def build_target_pts(parents_df, variants_df):
+    """
+    Build the target PTS frame from the parents.csv and parentattributesonvarients.csv frames.
+    """
+    # The columns we need, from whichever of the two files has them
+    target_cols = TARGET_COLUMNS
+    subsets = []
     
     # Extract target information from parents
     if 'fields.target_posting_template' in parents_df.columns or 'fields.target_listing_action' in parents_df.columns:
         parents_subset = parents_df[['sku'] + [col for col in target_cols[1:] if col in parents_df.columns]]
         logging.info(f"Found {len(parents_subset)} parent records with target information")
-        target_df = pd.concat([target_df, parents_subset], ignore_index=True)
+        subsets.append(parents_subset)
     
     # Extract target information from variants
     if 'fields.target_posting_template' in variants_df.columns or 'fields.target_listing_action' in variants_df.columns:
         variants_subset = variants_df[['sku'] + [col for col in target_cols[1:] if col in variants_df.columns]]
         logging.info(f"Found {len(variants_subset)} variant records with target information")
-        target_df = pd.concat([target_df, variants_subset], ignore_index=True)
+        subsets.append(variants_subset)
+
+    # Concatenated in one go: pandas is changing how an empty frame to start from affects the dtypes
+    target_df = pd.concat(subsets, ignore_index=True) if subsets else pd.DataFrame(columns=target_cols)
     
     # Fill missing columns if they don't exist in one of the files
     for col in target_cols:
@@ -91,12 +81,41 @@ def main():
     cols.remove('pts')
     new_cols = cols[:3] + ['pts'] + cols[3:]
     target_df = target_df[new_cols]
+
+    return target_df
+
+def main(workspace=None):
+    # Command-line runs name their output directory with --output; the input file isn't read
+    if workspace is None:
+        workspace = parse_workspace("Build target_pts.csv from parents.csv and parentattributesonvarients.csv",
+                                    needs_input=False)
+    logging.info("Starting target PTS data extraction")
+    
+    # Check if output files exist
+    parents_file = workspace.output_path('parents.csv')
+    variants_file = workspace.output_path('parentattributesonvarients.csv')
+    
+    if not os.path.exists(parents_file) or not os.path.exists(variants_file):
+        logging.error("Required input files missing. Please run parentattributesonvarients.py first.")
+        return
     
+    # Load the CSV files
+    try:
+        # Only the target columns are read; the rest of these files is never used here
+        parents_df = read_output(workspace, 'parents.csv', TARGET_COLUMNS)
+        variants_df = read_output(workspace, 'parentattributesonvarients.csv', TARGET_COLUMNS)
+        
+        logging.info(f"Loaded {len(parents_df)} parent records and {len(variants_df)} variant records")
+    except Exception as e:
+        logging.error(f"Error loading CSV files: {str(e)}")
+        return
+    
+    target_df = build_target_pts(parents_df, variants_df)
+
     # Save the output
-    if not os.path.exists(output_directory):
-        os.makedirs(output_directory)
+    workspace.ensure_output_dir()
         
-    output_file = os.path.join(output_directory, 'target_pts.csv')
+    output_file = workspace.output_path('target_pts.csv')
     target_df.to_csv(output_file, index=False)
     
     logging.info(f"Successfully created target PTS file with {len(target_df)} records. Saved to {output_file}")
@@ -0,0 +1,15 @@
+import os
+import sys
+
+import pytest
+
+# The modules live at the top level of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from catalog_loader import enable_copy_on_write  # noqa: E402
+
+
+# The stages expect Copy-on-Write, as every entry point turns it on
+@pytest.fixture(autouse=True, scope='session')
+def copy_on_write():
+    enable_copy_on_write()
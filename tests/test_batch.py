@@ -0,0 +1,41 @@
+import json
+import os
+import shutil
+import time
+
+import batch
+import jobs
+import synthetic_catalog
+
+
+# A batch as the web app runs it: uploaded into a job's workspace and migrated from a JobQueue worker thread
+def test_invalid_catalog_is_recorded_in_manifest(tmp_path):
+    synthetic_catalog.generate_catalog(str(tmp_path / 'good.csv'), 200)
+    (tmp_path / 'bad.csv').write_text('id,name\n1,Tee\n')
+
+    queue = jobs.JobQueue(workers=1, root=str(tmp_path / 'jobs'))
+    try:
+        job = queue.create_job('batch', {'use_mikes_way': False, 'max_alternate_images': None})
+        for name in ('good.csv', 'bad.csv'):
+            shutil.copy(tmp_path / name, os.path.join(job.workspace.input_dir, name))
+        queue.enqueue(job, batch.execute_batch)
+        # job.result is set by the future's done callback, which may run after result() returns
+        deadline = time.monotonic() + 120
+        while job.result is None and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        assert job.status == 'finished'
+        with open(job.workspace.output_path(batch.MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+        assert (manifest['finished'], manifest['failed']) == (1, 1)
+        entries = {entry['name']: entry for entry in manifest['catalogs']}
+        assert entries['good']['status'] == 'finished'
+        assert 'addvariants.csv' in entries['good']['files']
+        assert entries['bad']['status'] == 'failed'
+        assert "missing required column" in entries['bad']['log'][-1]
+    finally:
+        queue.shutdown()
+
+
+def test_workers_are_not_forked():
+    assert batch.worker_context().get_start_method() in ('forkserver', 'spawn')
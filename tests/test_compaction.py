@@ -0,0 +1,54 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import pipeline
+import synthetic_catalog
+from catalog_loader import FREE_TEXT_COLUMNS, compact_dtypes
+from workspace import Workspace
+
+
+# A synthetic catalog whose variants share a few image lists, names (just the size) and barcodes, with blanks
+@pytest.fixture(scope='module')
+def repetitive_catalog(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('catalog') / 'catalog.csv')
+    synthetic_catalog.generate_catalog(path, 2_000, variants_per_parent=10)
+    df = pd.read_csv(path, dtype=str, keep_default_na=False)
+    variants = (df['variant.sku'] != '').to_numpy()
+    rng = np.random.default_rng(0)
+    n = variants.sum()
+    blank = rng.random(n) < 0.2
+    images = np.array(['https://cdn.example.com/a.jpg,https://cdn.example.com/b.jpg', 'https://cdn.example.com/c.jpg'])
+    df.loc[variants, 'variant.images'] = np.where(blank, '', images[rng.integers(0, 2, n)])
+    df.loc[variants, 'variant.name'] = np.where(rng.random(n) < 0.1, '', synthetic_catalog.SIZES[rng.integers(0, 3, n)])
+    barcodes = df.loc[variants, 'variant.barcode'].to_numpy()
+    df.loc[variants, 'variant.barcode'] = np.where(rng.random(n) < 0.5, '', barcodes[rng.integers(0, 5, n)])
+    df.loc[~variants, 'name'] = np.array(['Tee', 'Hoodie'], dtype=object)[rng.integers(0, 2, (~variants).sum())]
+    df.to_csv(path, index=False)
+    return path
+
+
+def run(input_file, output_dir):
+    pipeline.run_pipeline(Workspace(input_file, str(output_dir)), use_mikes_way=True, log_messages=[])
+    return {name: open(os.path.join(output_dir, name), 'rb').read()
+            for name in sorted(os.listdir(output_dir)) if not name.startswith('.')}
+
+
+def test_free_text_columns_stay_object(repetitive_catalog):
+    df = pd.read_csv(repetitive_catalog, low_memory=False)
+    compacted, stats = compact_dtypes(df, ratio=5.0)
+    assert stats['compacted_columns']
+    for column in FREE_TEXT_COLUMNS:
+        assert not isinstance(compacted[column].dtype, pd.CategoricalDtype), column
+
+
+def test_compaction_keeps_outputs(repetitive_catalog, tmp_path, monkeypatch):
+    compacted = run(repetitive_catalog, tmp_path / 'compacted')
+    monkeypatch.setenv('CATALOG_CATEGORY_RATIO', '0')
+    plain = run(repetitive_catalog, tmp_path / 'plain')
+    assert 'MikesWay.csv' in compacted
+    assert compacted.keys() == plain.keys()
+    for name in plain:
+        assert compacted[name] == plain[name], name
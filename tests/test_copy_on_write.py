@@ -0,0 +1,25 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# A fresh interpreter, as the session fixture has already turned Copy-on-Write on in this one
+def copy_on_write_after(code):
+    env = dict(os.environ, RESULT_CACHE_MAX_MB='0')
+    result = subprocess.run([sys.executable, '-c', f"{code}\nimport pandas as pd\nprint(pd.get_option('mode.copy_on_write'))"],
+                            cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    return result.stdout.strip().splitlines()[-1]
+
+
+def test_importing_main_leaves_pandas_options_alone():
+    assert copy_on_write_after("import main") == 'False'
+
+
+def test_job_workers_enable_copy_on_write():
+    code = ("import jobs\n"
+            "queue = jobs.JobQueue(workers=1)\n"
+            "queue._executor.submit(int).result()\n"
+            "queue.shutdown()")
+    assert copy_on_write_after(code) == 'True'
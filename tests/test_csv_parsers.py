@@ -0,0 +1,70 @@
+import pandas as pd
+import pytest
+
+pytest.importorskip('pyarrow')
+
+from catalog_loader import NA_VALUES, read_csv_pyarrow  # noqa: E402
+
+# CSV files on which read_csv_pyarrow has to return exactly the frame of the pandas C parser
+CASES = {
+    'ints': 'a,b\n1,2\n3,4\n',
+    'ints_with_blanks': 'a,b\n1,\n,4\n5,6\n',
+    'ints_past_2_53': 'a\n9007199254740993\n1\n',
+    'ints_past_2_53_with_blanks': 'a\n9007199254740993\n\n1\n',
+    'ints_past_int64': 'a\n99999999999999999999\n1\n',
+    'negative_ints': 'a\n-1\n-20\n',
+    'leading_zeros': 'a\n007\n010\n',
+    'leading_plus': 'a\n+5\n6\n',
+    'floats': 'a\n1.5\n2.25\n',
+    'floats_with_blanks': 'a\n1.5\n\n2.25\n',
+    'whole_floats': 'a\n1.0\n2.0\n',
+    'floats_losing_precision': 'a\n0.12345678901234567\n1.1\n',
+    'float_digits_past_15th': 'a\n3.141592653589793238\n2.5\n',
+    'floats_past_2_53': 'a\n12345678901234567.5\n1.5\n',
+    'tiny_floats': 'a\n1e-9\n0.5\n',
+    'exponents': 'a\n1.5e3\n2E-2\n',
+    'negative_zero': 'a\n-0.0\n1.5\n',
+    'inf': 'a\ninf\n-inf\n1.5\n',
+    'infinity': 'a\nInfinity\n1.5\n',
+    'prices': 'variant.price\n8.70\n12.50\n\n0.99\n',
+    'booleans': 'a\nTrue\nFalse\n',
+    'booleans_with_blanks': 'a\ntrue\n\nFALSE\n',
+    'ones_and_zeros': 'a\n1\n0\n1\n',
+    'na_strings': 'a,b\n' + '\n'.join(f'{value},x' for value in NA_VALUES) + '\n',
+    'text_and_numbers': 'a\n12\nabc\n3.5\n',
+    'repeated_text': 'a\nred\nred\nblue\n\nred\n',
+    'unicode': 'name\nCafé\n日本\nnaïve\n',
+    'bom': '﻿id,name\n1,a\n2,b\n',
+    'crlf': 'id,name\r\n1,a\r\n2,b\r\n',
+    'quoted_newlines': 'id,description\n1,"line one\nline two"\n2,plain\n',
+    'quoted_commas': 'id,images\n1,"https://x/a.jpg,https://x/b.jpg"\n2,\n',
+    'header_only': 'a,b\n',
+    'empty_column': 'a,b\n1,\n2,\n',
+    'hex_fields': 'a,b\n0x1F,1\n0x20,2\n',
+    'dates': 'a\n2024-01-31\n2024-02-01\n',
+    'times': 'a\n12:30:00\n08:15:00\n',
+    'spaces_around_numbers': 'a\n 5\n6 \n',
+    'short_rows': 'a,b,c\n1,2\n3,4,5\n',
+    'duplicate_headers': 'a,a\n1,2\n',
+}
+
+
+@pytest.mark.parametrize('name', sorted(CASES))
+def test_matches_c_parser(name, tmp_path):
+    path = tmp_path / f'{name}.csv'
+    path.write_bytes(CASES[name].encode('utf-8'))
+    pd.testing.assert_frame_equal(read_csv_pyarrow(str(path)), pd.read_csv(path, low_memory=False))
+
+
+def test_usecols(tmp_path):
+    path = tmp_path / 'catalog.csv'
+    path.write_text('id,name,variant.price,variant.sku\n1,Tee,8.70,A\n2,,9.00,B\n')
+    usecols = ['variant.sku', 'id']
+    pd.testing.assert_frame_equal(read_csv_pyarrow(str(path), usecols),
+                                  pd.read_csv(path, low_memory=False, usecols=usecols))
+
+
+# NA_VALUES is a copy of the pandas parser's defaults; this catches a pandas release that changes them
+def test_na_values_match_pandas():
+    parsers = pytest.importorskip('pandas._libs.parsers')
+    assert sorted(NA_VALUES) == sorted(parsers.STR_NA_VALUES)
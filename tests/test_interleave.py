@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from MikesWay import interleave_variants
+from benchmark import legacy_interleave, make_parent_variant_frames, scaling_exponent, time_call
+
+
+def random_layout(seed):
+    """
+    Parents and shuffled variants with the awkward cases mixed in: parent SKUs on several rows
+    (ties), parents without variants (empty groups) and variants of no parent (orphans).
+    """
+    rng = np.random.default_rng(seed)
+    n_parents = int(rng.integers(1, 30))
+    skus = np.array([f'variant-{i}' for i in range(n_parents)], dtype=object)
+    # Some SKUs appear again further down, as in exports that repeat a parent row
+    parent_skus = np.concatenate([skus, rng.choice(skus, int(rng.integers(0, 5)))])
+    rng.shuffle(parent_skus)
+    parent_rows = pd.DataFrame({'sku': parent_skus, 'group': 'product',
+                                'fields.attr': rng.integers(0, 3, len(parent_skus)).astype(str)})
+
+    # Only some parents get variants; the rest of the groups stay empty
+    with_variants = rng.choice(skus, max(1, n_parents // 2), replace=False)
+    n_variants = int(rng.integers(0, 100))
+    group = rng.choice(np.append(with_variants, 'variant-orphan'), n_variants).astype(object)
+    variant_rows = pd.DataFrame({'sku': [f'SKU{i}' for i in range(n_variants)], 'group_skus.0': group,
+                                 'group': 'variant',
+                                 'fields.attr': rng.integers(0, 3, n_variants).astype(str)})
+    return parent_rows, variant_rows
+
+
+def assert_same_order(parent_rows, variant_rows):
+    ordered, orphans = interleave_variants(parent_rows, variant_rows)
+    legacy = legacy_interleave(parent_rows, variant_rows)
+    pd.testing.assert_frame_equal(ordered, legacy, check_dtype=False)
+    np.testing.assert_array_equal(orphans, ~variant_rows['group_skus.0'].isin(parent_rows['sku']).to_numpy())
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_matches_legacy_order(seed):
+    assert_same_order(*random_layout(seed))
+
+
+def test_no_variants():
+    parent_rows, variant_rows = random_layout(0)
+    assert_same_order(parent_rows, variant_rows.iloc[:0])
+
+
+def test_only_orphans():
+    parent_rows, variant_rows = random_layout(1)
+    assert_same_order(parent_rows, variant_rows.assign(**{'group_skus.0': 'variant-orphan'}))
+
+
+def test_no_parents():
+    parent_rows, variant_rows = random_layout(2)
+    ordered, orphans = interleave_variants(parent_rows.iloc[:0], variant_rows)
+    assert ordered.empty
+    assert orphans.all()
+
+
+def test_benchmark_frames_match_legacy():
+    assert_same_order(*make_parent_variant_frames(2_000))
+
+
+# Coarse: the legacy loop grows quadratically, so a linear-ish sort stays well under the limit
+def test_scales_near_linearly():
+    sizes = [20_000, 200_000]
+    seconds = [time_call(interleave_variants, *make_parent_variant_frames(n)) for n in sizes]
+    assert scaling_exponent(sizes, seconds) < 1.5
@@ -0,0 +1,150 @@
+import json
+import logging
+import pandas as pd
+
+from catalog_loader import select_columns
+
+# The report of every run, saved with its outputs
+REPORT_FILE = 'validation.json'
+
+# Values of an issue listed in the job log; the report keeps all of them
+LOG_EXAMPLES = 20
+
+DUPLICATE_SKUS = "Duplicated 'variant.sku' values"
+
+
+class ValidationReport:
+    """
+    Every integrity issue found in a catalog. Each issue is a dict with the check that found it,
+    its severity ('error' stops the pipeline, 'warning' is only reported), a message and every
+    offending value.
+    """
+
+    def __init__(self, rows=0):
+        self.rows = rows
+        self.issues = []
+
+    def add(self, check, severity, message, values):
+        """Record an issue for the distinct `values`, if there are any."""
+        values = pd.Series(values).dropna()
+        # Whole numbers read as floats (barcodes, ids) are listed as written in the export
+        if pd.api.types.is_float_dtype(values) and (values % 1 == 0).all():
+            values = values.astype('int64')
+        values = values.astype(str).unique().tolist()
+        if values:
+            self.issues.append({'check': check, 'severity': severity, 'message': message,
+                                'count': len(values), 'values': values})
+
+    @property
+    def errors(self):
+        return [issue for issue in self.issues if issue['severity'] == 'error']
+
+    @property
+    def warnings(self):
+        return [issue for issue in self.issues if issue['severity'] == 'warning']
+
+    def format_lines(self, severity=None):
+        """One log line per issue (of `severity`, or all), with its first LOG_EXAMPLES values."""
+        lines = []
+        for issue in self.issues:
+            if severity is not None and issue['severity'] != severity:
+                continue
+            examples = ', '.join(issue['values'][:LOG_EXAMPLES])
+            if issue['count'] > LOG_EXAMPLES:
+                examples += f", ... ({issue['count'] - LOG_EXAMPLES} more in {REPORT_FILE})"
+            mark = '✗' if issue['severity'] == 'error' else '!'
+            lines.append(f"{mark} {issue['message']} ({issue['count']}): {examples}")
+        return lines
+
+    def to_dict(self):
+        return {'rows': self.rows, 'errors': len(self.errors), 'warnings': len(self.warnings), 'issues': self.issues}
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    @classmethod
+    def load(cls, path):
+        """The report saved as REPORT_FILE at `path`."""
+        with open(path) as f:
+            data = json.load(f)
+        report = cls(data['rows'])
+        report.issues = data['issues']
+        return report
+
+
+class ValidationError(Exception):
+    """A catalog failed validation; `report` holds every issue found."""
+
+    def __init__(self, report):
+        super().__init__('\n'.join(report.format_lines('error')))
+        self.report = report
+
+
+def duplicate_skus_error(skus):
+    """The ValidationError of a stage whose kept rows repeat the SKUs in `skus`."""
+    logging.error("Duplicates found in 'variant.sku'. Please contact management!")
+    report = ValidationReport()
+    report.add('duplicate_skus', 'error', DUPLICATE_SKUS, skus)
+    return ValidationError(report)
+
+
+# Export columns validate() reads
+def input_columns(header):
+    return select_columns(header, ['name', 'variant.name', 'variant.sku', 'variant.barcode', 'variant.price',
+                                   'variant.compare_price', 'id', 'variant.product_id'])
+
+
+def validate(df):
+    """
+    Check a loaded export in one pass, before any stage runs, against what the stages would
+    stop on or silently drop. The rows each check looks at are the ones the stages keep
+    (no sample products, a non-empty 'variant.sku'):
+    - errors: duplicated SKUs, and parent ids on several rows whose children would each be
+      repeated (and so get duplicated SKUs) in parentattributesonvarients.csv.
+    - warnings: duplicated barcodes (left empty), 'variant.product_id' values matching no parent
+      row (those children are dropped), parents with a single child (not grouped) and prices
+      that aren't numbers (left empty).
+    Checks whose columns the export lacks are skipped. Returns a ValidationReport.
+    """
+    report = ValidationReport(len(df))
+    kept = ~df['variant.name'].str.contains('Sample product', na=False)
+    skus = df['variant.sku']
+    variants = kept & skus.notna() & (skus != '')
+
+    variant_skus = skus[variants]
+    report.add('duplicate_skus', 'error', DUPLICATE_SKUS, variant_skus[variant_skus.duplicated(keep=False)])
+
+    if 'variant.barcode' in df:
+        barcodes = df['variant.barcode'][variants]
+        numbers = pd.to_numeric(barcodes, errors='coerce')
+        report.add('duplicate_barcodes', 'warning', "Duplicated 'variant.barcode' values, left empty",
+                   barcodes[numbers.notna() & numbers.duplicated(keep=False)])
+
+    for column in ('variant.price', 'variant.compare_price'):
+        if column in df:
+            values = df[column][variants]
+            report.add('malformed_prices', 'warning', f"Malformed '{column}' values, left empty",
+                       values[pd.to_numeric(values, errors='coerce').isna() & values.notna()])
+
+    if 'id' in df and 'variant.product_id' in df:
+        # parentattributesonvarients also drops rows named 'Sample product' before linking children to parents
+        linked = kept & (df['name'] != 'Sample product') if 'name' in df else kept
+        parent_ids = df['id'][linked & df['id'].notna()]
+        children = df[linked & df['variant.product_id'].notna()]
+        product_ids = children['variant.product_id']
+        child_counts = product_ids.value_counts()
+        parent_rows = parent_ids.value_counts()
+        repeated = parent_rows.index[parent_rows > 1]
+
+        child_skus = children['variant.sku']
+        repeated_children = product_ids.isin(repeated) & child_skus.notna() & (child_skus != '')
+        report.add('duplicate_parent_ids', 'error',
+                   "Parent 'id' values on several rows, whose children would get duplicated SKUs",
+                   product_ids[repeated_children])
+        report.add('orphan_children', 'warning',
+                   "'variant.product_id' values matching no parent 'id' (their rows are dropped)",
+                   product_ids[~product_ids.isin(parent_ids)])
+        single = child_counts.index[(child_counts == 1) & child_counts.index.isin(parent_ids)]
+        report.add('single_child_parents', 'warning', "Parents with a single child (not grouped as a product)",
+                   product_ids[product_ids.isin(single)])
+    return report
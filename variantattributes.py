@@ -1,40 +1,37 @@
 
-import os
+import argparse
 import pandas as pd
 import logging
 
-# Set input and output directories
-input_directory = './input/'
-output_directory = './output/'
+from catalog_loader import MissingColumnError, enable_copy_on_write, load_catalog, read_header, select_columns
+from workspace import Workspace, add_workspace_arguments
+from intermediates import write_output
+from streaming import (DEFAULT_CHUNKSIZE, DtypeScan, HashedValues, check_duplicate_skus, kept_variant_rows,
+                       read_chunks, write_chunk)
+from instrumentation import instrumented
+from validation import ValidationError, duplicate_skus_error
 
 # Set up logging configuration
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Check if input directory exists and fetch file
-def load_file_from_directory(input_directory):
-    files = os.listdir(input_directory)
-    if len(files) != 1:
-        logging.error("There are no files or more than one file in the directory.")
-        exit()
-    return pd.read_csv(os.path.join(input_directory, files[0]), low_memory=False)
-
 # Remove rows where 'variant.name' contains 'Sample product'
+@instrumented
 def filter_sample_product(df):
     logging.info("Filtering rows where 'variant.name' contains 'Sample product'")
     return df[~df['variant.name'].str.contains('Sample product', na=False)]
 
 # Clean NaN or empty string 'variant.sku' and duplicates in 'variant.sku' and 'variant.barcode'
+@instrumented
 def clean_sku_and_barcode(df):
     logging.info("Cleaning 'variant.sku' column")
     df = df[df['variant.sku'].notna() & (df['variant.sku'] != '')]  # Drop empty 'variant.sku'
     duplicated_skus = df['variant.sku'].dropna()[df['variant.sku'].duplicated(keep=False)]
     if not duplicated_skus.empty:
-        logging.error("Duplicates found in 'variant.sku'. Please contact management!")
-        logging.error(f"Duplicated 'variant.sku' values: {duplicated_skus.unique()}")
-        exit(1)
+        raise duplicate_skus_error(duplicated_skus)
     return df
 
-def select_required_columns(df):
+@instrumented
+def select_required_columns(df, non_empty_columns=None):
     logging.info("Selecting required columns")
 
     # Strip any leading/trailing whitespaces from column names
@@ -55,12 +52,16 @@ def select_required_columns(df):
     if existing_columns_to_drop:
         df = df.drop(columns=existing_columns_to_drop)
 
-    # Remove columns with all NaN or empty values
-    df = df.dropna(axis=1, how='all')  # Drop columns with all NaN values
-    df = df.loc[:, df.notna().any(axis=0)]  # Keep columns with at least one non-NaN value
+    # Remove columns with all NaN or empty values; in streaming mode, the columns with a value anywhere in the file
+    if non_empty_columns is None:
+        df = df.dropna(axis=1, how='all')  # Drop columns with all NaN values
+        df = df.loc[:, df.notna().any(axis=0)]  # Keep columns with at least one non-NaN value
+    else:
+        df = df[[col for col in df.columns if col in non_empty_columns]]
 
     return df
 
+@instrumented
 def rename_columns(df):
     # Rename 'variant.sku' to 'sku'
     df = df.rename(columns={'variant.sku': 'sku'})
@@ -86,27 +87,89 @@ def rename_columns(df):
     
     return df
 
-# Main function to run all steps
-def main():
-    logging.info("Starting data processing")
+# Export columns transform() reads: the SKU, name and weight plus everything from 'variant.package_height' on
+def input_columns(header):
+    return select_columns(header, ['variant.name', 'variant.sku', 'variant.weight'], [('variant.package_height', None)],
+                          stage='variantattributes')
 
-    # Load the CSV file
-    df = load_file_from_directory(input_directory)
-    
-    # Apply transformations in sequence
+# Apply all transformations in sequence to a loaded export
+def transform(df):
     df = filter_sample_product(df)
     df = clean_sku_and_barcode(df)
     df = select_required_columns(df)
     df = rename_columns(df)
+    return df
+
+def scan_catalog(input_file, chunksize, usecols=None):
+    """
+    First streaming pass: the read dtypes, a duplicate-SKU check and the columns that have a
+    value somewhere in the kept rows. Only a 64-bit SKU hash per row is kept.
+    """
+    logging.info("Scanning for duplicate SKUs and empty columns")
+    dtypes = DtypeScan()
+    skus = HashedValues()
+    non_empty_columns = set()
+    for chunk in read_chunks(input_file, chunksize, usecols=usecols):
+        dtypes.observe(chunk)
+        chunk = kept_variant_rows(chunk)
+        skus.add(chunk['variant.sku'])
+        non_empty_columns.update(chunk.columns[chunk.notna().any(axis=0)].str.strip())
+
+    check_duplicate_skus(input_file, chunksize, dtypes, skus)
+    return dtypes.dtypes, non_empty_columns
+
+def transform_streaming(input_file, output_file, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Write the same variantattributes.csv as transform() while holding only one chunk of rows at a time.
+    """
+    usecols = input_columns(read_header(input_file))
+    dtypes, non_empty_columns = scan_catalog(input_file, chunksize, usecols)
+
+    rows = 0
+    for i, chunk in enumerate(read_chunks(input_file, chunksize, dtypes, usecols)):
+        df = filter_sample_product(chunk)
+        df = df[df['variant.sku'].notna() & (df['variant.sku'] != '')]
+        df = select_required_columns(df, non_empty_columns)
+        df = rename_columns(df)
+        write_chunk(df, output_file, first=(i == 0))
+        rows += len(df)
+    return rows
 
-    # Ensure output directory exists and save the cleaned data
-    if not os.path.exists(output_directory):
-        os.makedirs(output_directory)
-    output_file = os.path.join(output_directory, 'variantattributes.csv')
-    df.to_csv(output_file, index=False)
+# Main function to run all steps
+def main(workspace=None, chunksize=None):
+    # Command-line runs name their input and output with --input/--output
+    if workspace is None:
+        parser = add_workspace_arguments(argparse.ArgumentParser(description="Build variantattributes.csv from a catalog export"))
+        parser.add_argument('--chunksize', type=int,
+                            help=f"Stream the input this many rows at a time (e.g. {DEFAULT_CHUNKSIZE}) "
+                                 "instead of loading it whole")
+        args = parser.parse_args()
+        workspace = Workspace.from_args(args)
+        chunksize = args.chunksize
+    logging.info("Starting data processing")
+
+    workspace.ensure_output_dir()
+    output_file = workspace.output_path('variantattributes.csv')
+
+    if chunksize:
+        transform_streaming(workspace.input_file, output_file, chunksize)
+    else:
+        # Load the CSV file
+        df = load_catalog(workspace.input_file, input_columns(read_header(workspace.input_file)))
+
+        # Apply transformations in sequence
+        df = transform(df)
+
+        # Save the cleaned data
+        write_output(workspace, 'variantattributes.csv', df)
     
     logging.info(f"Successfully filtered the data! The filtered data is saved to {output_file}")
 
 # Run the main function
 if __name__ == "__main__":
-    main()
+    enable_copy_on_write()
+    try:
+        main()
+    except (ValidationError, MissingColumnError) as e:
+        logging.error(str(e))
+        exit(1)
@@ -0,0 +1,88 @@
+import os
+import shutil
+import logging
+import argparse
+import tempfile
+
+# Defaults for command-line runs; the web app gives every job its own workspace instead
+input_directory = './input/'
+output_directory = './output/'
+# Parquet copies of the outputs later stages read back (see intermediates.py), in this hidden directory
+# of the output directory, so each output directory has its own
+intermediate_subdirectory = '.intermediate'
+
+
+class Workspace:
+    """
+    The input file and output directory of one migration run. Stages read and write only
+    through their workspace, so concurrent runs never see each other's files. Intermediate
+    files that aren't part of the download go to `intermediate_dir`.
+    """
+
+    def __init__(self, input_file, output_dir, root=None, intermediate_dir=None):
+        self.input_file = input_file
+        self.output_dir = output_dir
+        # Set for temporary workspaces; cleanup() removes this whole directory
+        self.root = root
+        if intermediate_dir is None:
+            intermediate_dir = (os.path.join(root, 'intermediate') if root is not None
+                                else os.path.join(output_dir, intermediate_subdirectory))
+        self.intermediate_dir = intermediate_dir
+
+    # Directory of the input file; a batch saves all of its uploads here
+    @property
+    def input_dir(self):
+        return os.path.dirname(self.input_file)
+
+    def output_path(self, file_name):
+        return os.path.join(self.output_dir, file_name)
+
+    def ensure_output_dir(self):
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+
+    @classmethod
+    def temporary(cls, filename, parent=None, prefix='migration-'):
+        """Create a unique workspace under `parent` (the system temp directory by default); save the upload to .input_file."""
+        if parent is not None and not os.path.exists(parent):
+            os.makedirs(parent)
+        root = tempfile.mkdtemp(prefix=prefix, dir=parent)
+        os.makedirs(os.path.join(root, 'input'))
+        os.makedirs(os.path.join(root, 'output'))
+        return cls(os.path.join(root, 'input', os.path.basename(filename)), os.path.join(root, 'output'), root)
+
+    @classmethod
+    def from_directory(cls, input_dir=input_directory, output_dir=output_directory):
+        """The old layout: exactly one input file in `input_dir`."""
+        files = os.listdir(input_dir) if os.path.exists(input_dir) else []
+        if len(files) != 1:
+            logging.error("There are no files or more than one file in the directory.")
+            exit(1)
+        return cls(os.path.join(input_dir, files[0]), output_dir)
+
+    @classmethod
+    def from_args(cls, args, needs_input=True):
+        """Workspace for the --input/--output options added by add_workspace_arguments."""
+        if args.input is None and needs_input:
+            return cls.from_directory(output_dir=args.output)
+        return cls(args.input, args.output)
+
+    def cleanup(self):
+        if self.root is not None:
+            shutil.rmtree(self.root, ignore_errors=True)
+
+    def __repr__(self):
+        return f"Workspace(input_file={self.input_file!r}, output_dir={self.output_dir!r})"
+
+
+# Add the --input/--output options every stage's command line accepts
+def add_workspace_arguments(parser):
+    parser.add_argument('--input', help=f"Input CSV (defaults to the single file in {input_directory})")
+    parser.add_argument('--output', default=output_directory, help="Output directory")
+    return parser
+
+
+# Build a stage's command line and return the workspace it names
+def parse_workspace(description, needs_input=True):
+    parser = add_workspace_arguments(argparse.ArgumentParser(description=description))
+    return Workspace.from_args(parser.parse_args(), needs_input)